@@ -0,0 +1,166 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compare allocating N addresses with N calls to allocate() and with one call
+to IPAMClient.allocate_many().
+
+The datastore is an in-memory stand-in for etcd.Client that sleeps for a
+fixed latency on each request, to stand in for an etcd round trip, and counts
+the requests.  Each case starts from a pool with ASSIGNED addresses already
+assigned in blocks owned by the host.
+
+Cases:
+ - sequential: N calls to SequentialAssignment.allocate().
+ - block:      N calls to BlockAssignment.allocate().
+ - many:       allocate_many(pool, N).
+
+Usage:
+  bulk_allocation.py [--etcd-ms=<MS>] [<COUNT>...]
+
+Options:
+ --etcd-ms=<MS>   Latency of each datastore request [default: 2]
+"""
+import os
+import sys
+import threading
+import time
+
+from docopt import docopt
+from etcd import EtcdResult, EtcdKeyNotFound, EtcdAlreadyExist
+from netaddr import IPNetwork
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from pycalico.ipam import AllocationBlock, BlockAssignment, IPAMClient, \
+    SequentialAssignment, BLOCK_PREFIXLEN, IP_BLOCK_KEY, \
+    IP_HOST_AFFINITY_KEY, IP_USAGE_KEY
+
+POOL = IPNetwork("10.0.0.0/16")
+HOSTNAME = "host1"
+ASSIGNED = 1000
+COUNTS = [8, 32, 128]
+
+
+class MemoryEtcdClient(object):
+    """
+    Stands in for etcd.Client, holding the keys in memory.  Only supports
+    what the allocators use: reads of keys and of directories of keys, and
+    writes with prevExist or prevIndex.  Every request sleeps for the
+    configured latency.
+    """
+    def __init__(self, latency):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.values = {}
+        self.dirs = {}
+        self.index = 0
+        self.requests = 0
+
+    def _node(self, key):
+        value, index = self.values[key]
+        return {"key": key, "value": value, "modifiedIndex": index,
+                "createdIndex": index}
+
+    def read(self, key, **kwargs):
+        time.sleep(self.latency)
+        with self.lock:
+            self.requests += 1
+            key = key.rstrip("/")
+            if key in self.values:
+                return EtcdResult("get", self._node(key))
+            if key not in self.dirs:
+                raise EtcdKeyNotFound("Key not found : %s" % key)
+            nodes = [self._node(child) for child in self.dirs[key]]
+            return EtcdResult("get", {"key": key, "dir": True,
+                                      "nodes": nodes})
+
+    def write(self, key, value, prevExist=None, prevIndex=None, **kwargs):
+        time.sleep(self.latency)
+        with self.lock:
+            self.requests += 1
+            if prevExist is False and key in self.values:
+                raise EtcdAlreadyExist("Key already exists : %s" % key)
+            if prevIndex is not None and self.values[key][1] != prevIndex:
+                raise ValueError("Compare failed")
+            self.index += 1
+            self.values[key] = (value, self.index)
+            child = key
+            while child.count("/") > 1:
+                parent = child.rsplit("/", 1)[0]
+                self.dirs.setdefault(parent, set()).add(child)
+                child = parent
+            return EtcdResult("set", self._node(key))
+
+
+def fill(etcd):
+    """
+    Assign the lowest ASSIGNED addresses, in blocks owned by the host.
+    """
+    latency, etcd.latency = etcd.latency, 0
+    blocks = POOL.subnet(BLOCK_PREFIXLEN[4])
+    assigned = 0
+    while assigned < ASSIGNED:
+        block = AllocationBlock(next(blocks), POOL, host_affinity=HOSTNAME)
+        while assigned < ASSIGNED and block.auto_assign() is not None:
+            assigned += 1
+        block_id = str(block.cidr).replace("/", "-")
+        etcd.write(IP_BLOCK_KEY % {"version": "v4",
+                                   "pool": str(POOL).replace("/", "-"),
+                                   "block": block_id}, block.to_json())
+        etcd.write(IP_HOST_AFFINITY_KEY % {"version": "v4",
+                                           "hostname": HOSTNAME,
+                                           "pool": str(POOL).replace("/", "-"),
+                                           "block": block_id}, "")
+    etcd.write(IP_USAGE_KEY % {"version": "v4",
+                               "pool": str(POOL).replace("/", "-")},
+               str(ASSIGNED))
+    etcd.latency = latency
+
+
+def sequential(client, count):
+    assigner = SequentialAssignment()
+    assigner.etcd = client
+    return [assigner.allocate(POOL) for _ in range(count)]
+
+
+def block(client, count):
+    assigner = BlockAssignment(HOSTNAME, client)
+    return [assigner.allocate(POOL) for _ in range(count)]
+
+
+def many(client, count):
+    return client.allocate_many(POOL, count)
+
+
+def main(arguments):
+    latency = float(arguments["--etcd-ms"]) / 1000
+    counts = [int(count) for count in arguments["<COUNT>"]] or COUNTS
+    cases = [("sequential", sequential), ("block", block), ("many", many)]
+    print "%6s %-10s %10s %10s" % ("count", "case", "ms", "requests")
+    for count in counts:
+        for name, case in cases:
+            client = IPAMClient()
+            client.etcd_client = MemoryEtcdClient(latency)
+            fill(client.etcd_client)
+            client.etcd_client.requests = 0
+            start = time.time()
+            addresses = case(client, count)
+            elapsed = time.time() - start
+            assert len(addresses) == count and None not in addresses
+            print "%6d %-10s %10.1f %10d" % (count, name, elapsed * 1000,
+                                             client.etcd_client.requests)
+
+
+if __name__ == '__main__':
+    main(docopt(__doc__))
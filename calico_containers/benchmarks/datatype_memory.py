@@ -0,0 +1,129 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measure the memory used to hold the datastore datatypes.
+
+Each case creates N objects in its own process and keeps them, and reports
+the increase in peak RSS divided by N.  Endpoints are parsed from JSON that
+is built before the measurement starts, as it would already be held in the
+etcd response.
+
+Cases:
+ - endpoint:      Endpoint.from_json(), without using the addresses.
+ - endpoint+addr: Endpoint.from_json(), then read the addresses.
+ - rule:          Rule(action="allow", src_tag=..., dst_ports=[...]).
+ - pool:          IPPool(cidr).
+
+Usage:
+  python benchmarks/datatype_memory.py [<COUNT>...]
+"""
+import json
+import os
+import resource
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from pycalico.datastore import ENDPOINT_PATH
+from pycalico.datastore_datatypes import Endpoint, Rule, IPPool
+
+COUNTS = [10000, 100000]
+ENDPOINTS_PER_HOST = 50
+
+
+def endpoint_data(count):
+    data = []
+    for index in range(count):
+        hostname = "host%d" % (index / ENDPOINTS_PER_HOST)
+        endpoint_id = "%012x" % index
+        json_dict = {"state": "active",
+                     "name": "cali" + endpoint_id[:11],
+                     "mac": "11-22-33-44-55-66",
+                     "container:if_name": "eth1",
+                     "profile_ids": ["profile%d" % (index % 10)],
+                     "ipv4_nets": ["10.%d.%d.%d/32" % (index / 65536,
+                                                       index / 256 % 256,
+                                                       index % 256)],
+                     "ipv6_nets": ["fd80::%x:%x/128" % (index / 65536,
+                                                        index % 65536)],
+                     "ipv4_gateway": "192.168.0.1",
+                     "ipv6_gateway": "fd00::1"}
+        key = ENDPOINT_PATH % {"hostname": hostname,
+                               "orchestrator_id": "docker",
+                               "workload_id": "workload%d" % index,
+                               "endpoint_id": endpoint_id}
+        # Keys and values are unicode, as decoded from the etcd response.
+        data.append((unicode(key), unicode(json.dumps(json_dict))))
+    return data
+
+
+def endpoints(data):
+    return [Endpoint.from_json(key, value) for key, value in data]
+
+
+def endpoints_with_addresses(data):
+    eps = endpoints(data)
+    for endpoint in eps:
+        endpoint.ipv4_nets
+    return eps
+
+
+def rules(data):
+    return [Rule(action="allow", src_tag="profile%d" % (index % 10),
+                 dst_ports=[80, 443]) for index in range(len(data))]
+
+
+def pools(data):
+    return [IPPool("10.%d.%d.0/24" % (index / 256 % 256, index % 256))
+            for index in range(len(data))]
+
+
+def measure(case, data):
+    """
+    Run a case in a child process, returning the increase in peak RSS in
+    bytes.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # ru_maxrss is the peak, so the objects needn't be kept alive.
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        case(data)
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(write_fd, str((after - before) * 1024))
+        os._exit(0)
+
+    os.close(write_fd)
+    output = os.read(read_fd, 1024)
+    os.waitpid(pid, 0)
+    return int(output)
+
+
+def main(counts):
+    cases = [("endpoint", endpoints),
+             ("endpoint+addr", endpoints_with_addresses),
+             ("rule", rules),
+             ("pool", pools)]
+    print "%8s %-14s %10s %12s" % ("count", "case", "MB", "bytes/object")
+    for count in counts:
+        data = endpoint_data(count)
+        for name, case in cases:
+            memory = measure(case, data)
+            print "%8d %-14s %10.1f %12d" % (count, name,
+                                             memory / 1048576.0,
+                                             memory / count)
+
+
+if __name__ == '__main__':
+    main([int(count) for count in sys.argv[1:]] or COUNTS)
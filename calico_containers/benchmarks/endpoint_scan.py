@@ -0,0 +1,149 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Time and measure the memory used by a scan of every endpoint in the cluster.
+
+The etcd response for a recursive read of /calico/v1/host is built and
+serialized once, then decoded in the same way as python-etcd does for each
+case, so the timings cover JSON decoding and endpoint parsing but not the
+network.  Each case runs in its own process, and the memory is the increase
+in peak RSS over the process before the scan.
+
+Cases:
+ - eager:    list every endpoint and convert its addresses, which is what
+             get_endpoints() did for every endpoint before parsing was lazy.
+ - lazy:     list every endpoint, without using the addresses.
+ - stream:   count the endpoints from iter_endpoints() without keeping them.
+ - filtered: find one workload's endpoint by scanning (iter_endpoints() with
+             a workload ID), which only parses the matching endpoint.
+
+Usage:
+  python benchmarks/endpoint_scan.py [<COUNT>...]
+"""
+import json
+import os
+import resource
+import sys
+import time
+
+from etcd import EtcdResult
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from pycalico.datastore import DatastoreClient, HOSTS_PATH, ENDPOINT_PATH
+from pycalico.datastore_datatypes import Endpoint
+
+COUNTS = [1000, 10000, 50000]
+ENDPOINTS_PER_HOST = 50
+
+
+class ReplayEtcdClient(object):
+    """
+    Stands in for etcd.Client, answering every read by decoding a
+    pre-serialized response.
+    """
+    def __init__(self, body):
+        self.body = body
+
+    def read(self, key, **kwargs):
+        return EtcdResult(**json.loads(self.body))
+
+
+def hosts_response(count):
+    hosts = {}
+    for index in range(count):
+        hostname = "host%d" % (index / ENDPOINTS_PER_HOST)
+        endpoint = Endpoint(hostname, "docker", "workload%d" % index,
+                            "%012x" % index, "active", "11-22-33-44-55-66")
+        endpoint.ipv4_nets.add("10.%d.%d.%d/32" % (index / 65536,
+                                                   index / 256 % 256,
+                                                   index % 256))
+        endpoint.ipv6_nets.add("fd80::%x/128" % index)
+        endpoint.ipv4_gateway = "192.168.0.1"
+        endpoint.ipv6_gateway = "fd00::1"
+        endpoint.profile_ids = ["profile%d" % (index % 10)]
+        key = ENDPOINT_PATH % {"hostname": hostname,
+                               "orchestrator_id": "docker",
+                               "workload_id": endpoint.workload_id,
+                               "endpoint_id": endpoint.endpoint_id}
+        hosts.setdefault(hostname, []).append(
+            {"key": key, "value": endpoint.to_json(),
+             "modifiedIndex": index, "createdIndex": index})
+    nodes = [{"key": HOSTS_PATH + host, "dir": True, "nodes": endpoints}
+             for host, endpoints in hosts.iteritems()]
+    return json.dumps({"action": "get",
+                       "node": {"key": HOSTS_PATH, "dir": True,
+                                "nodes": nodes}})
+
+
+def eager(client):
+    endpoints = list(client.iter_endpoints())
+    for endpoint in endpoints:
+        endpoint.ipv4_nets
+    return endpoints
+
+
+def lazy(client):
+    return list(client.iter_endpoints())
+
+
+def stream(client):
+    return sum(1 for _ in client.iter_endpoints())
+
+
+def filtered(client):
+    return list(client.iter_endpoints(workload_id="workload7"))
+
+
+def measure(case, body):
+    """
+    Run a case in a child process, returning the time in ms and the increase
+    in peak RSS in MB.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        client = DatastoreClient()
+        client.etcd_client = ReplayEtcdClient(body)
+        # Decode a response first, so its cost isn't counted as part of the
+        # first case.
+        client.etcd_client.read(None)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        case(client)
+        elapsed = time.time() - start
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(write_fd, json.dumps([elapsed * 1000,
+                                       (after - before) / 1024.0]))
+        os._exit(0)
+
+    os.close(write_fd)
+    output = os.read(read_fd, 1024)
+    os.waitpid(pid, 0)
+    return json.loads(output)
+
+
+def main(counts):
+    cases = [("eager", eager), ("lazy", lazy), ("stream", stream),
+             ("filtered", filtered)]
+    print "%8s %-10s %10s %10s" % ("count", "case", "ms", "MB")
+    for count in counts:
+        body = hosts_response(count)
+        for name, case in cases:
+            elapsed, memory = measure(case, body)
+            print "%8d %-10s %10.1f %10.1f" % (count, name, elapsed, memory)
+
+
+if __name__ == '__main__':
+    main([int(count) for count in sys.argv[1:]] or COUNTS)
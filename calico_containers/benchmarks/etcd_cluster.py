@@ -0,0 +1,148 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compare the read and write throughput of DatastoreClient against one member
+of a local etcd cluster and against all of its members.
+
+Starts a cluster of N etcd processes on this machine, each in its own
+temporary data directory, then for each case runs THREADS threads that
+share one DatastoreClient, each reading (or writing) a key in a loop, for
+the given duration.  Needs an etcd 2.x binary.
+
+Cases:
+ - single:     ETCD_AUTHORITY is the first member.
+ - cluster:    ETCD_AUTHORITY lists every member, with quorum reads.
+ - stale:      as cluster, with ETCD_QUORUM_READS=false.
+
+Usage:
+  etcd_cluster.py [--etcd=<ETCD>] [--members=<N>] [--threads=<N>]
+                  [--seconds=<S>]
+
+Options:
+ --etcd=<ETCD>    The etcd binary [default: etcd]
+ --members=<N>    Number of etcd members [default: 3]
+ --threads=<N>    Number of threads making requests [default: 32]
+ --seconds=<S>    How long to run each case for [default: 5]
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from docopt import docopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from pycalico.datastore import DatastoreClient, ETCD_AUTHORITY_ENV, \
+    ETCD_QUORUM_READS_ENV
+
+KEY = "/calico/v1/benchmark"
+CLIENT_PORT = 23790
+PEER_PORT = 23800
+
+
+def start_cluster(etcd, count, data_dir):
+    """
+    Start a cluster of etcd members on localhost.
+    :return: The list of processes, and the list of client host:ports.
+    """
+    peers = ",".join("member%d=http://127.0.0.1:%d" % (i, PEER_PORT + i)
+                     for i in range(count))
+    processes = []
+    for i in range(count):
+        processes.append(subprocess.Popen(
+            [etcd,
+             "-name", "member%d" % i,
+             "-data-dir", os.path.join(data_dir, "member%d" % i),
+             "-listen-client-urls", "http://127.0.0.1:%d" % (CLIENT_PORT + i),
+             "-advertise-client-urls",
+             "http://127.0.0.1:%d" % (CLIENT_PORT + i),
+             "-listen-peer-urls", "http://127.0.0.1:%d" % (PEER_PORT + i),
+             "-initial-advertise-peer-urls",
+             "http://127.0.0.1:%d" % (PEER_PORT + i),
+             "-initial-cluster", peers,
+             "-initial-cluster-state", "new"],
+            stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT))
+    return processes, ["127.0.0.1:%d" % (CLIENT_PORT + i)
+                       for i in range(count)]
+
+
+def make_client(authority, quorum_reads, threads):
+    os.environ[ETCD_AUTHORITY_ENV] = authority
+    os.environ[ETCD_QUORUM_READS_ENV] = str(quorum_reads).lower()
+    client = DatastoreClient(max_connections=threads)
+    # Wait for the cluster to elect a leader and take writes.
+    for _ in range(100):
+        try:
+            client.etcd_client.write(KEY, "0")
+            return client
+        except Exception:
+            time.sleep(0.1)
+    raise Exception("etcd cluster didn't start")
+
+
+def run(client, operation, threads, seconds):
+    """
+    Make requests from a number of threads for a time.
+    :return: The number of requests per second.
+    """
+    counts = [0] * threads
+    deadline = time.time() + seconds
+
+    def worker(index):
+        while time.time() < deadline:
+            if operation == "read":
+                client.etcd_client.read(KEY)
+            else:
+                client.etcd_client.write(KEY, str(counts[index]))
+            counts[index] += 1
+
+    workers = [threading.Thread(target=worker, args=(i,))
+               for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return sum(counts) / float(seconds)
+
+
+def main(arguments):
+    members = int(arguments["--members"])
+    threads = int(arguments["--threads"])
+    seconds = float(arguments["--seconds"])
+    data_dir = tempfile.mkdtemp()
+    processes, authorities = start_cluster(arguments["--etcd"], members,
+                                           data_dir)
+    try:
+        cases = [("single", authorities[0], True),
+                 ("cluster", ",".join(authorities), True),
+                 ("stale", ",".join(authorities), False)]
+        print "%-10s %12s %12s" % ("case", "reads/s", "writes/s")
+        for name, authority, quorum_reads in cases:
+            client = make_client(authority, quorum_reads, threads)
+            reads = run(client, "read", threads, seconds)
+            writes = run(client, "write", threads, seconds)
+            print "%-10s %12.0f %12.0f" % (name, reads, writes)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+        shutil.rmtree(data_dir)
+
+
+if __name__ == '__main__':
+    main(docopt(__doc__))
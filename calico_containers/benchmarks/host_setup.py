@@ -0,0 +1,128 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Time the DatastoreClient calls that bring up a node and create a profile,
+against an etcd stand-in that sleeps for a fixed latency on each request.
+The time of each call is also shown in round trips, which is how many
+requests it would take if they were made one after another.
+
+Cases:
+ - ensure_global_config
+ - create_host
+ - create_profile
+ - set_endpoint:  an endpoint in two profiles.
+ - remove_endpoint
+
+Usage:
+  host_setup.py [--etcd-ms=<MS>]
+
+Options:
+ --etcd-ms=<MS>   Latency of each datastore request [default: 20]
+"""
+import os
+import sys
+import threading
+import time
+
+from docopt import docopt
+from etcd import EtcdResult, EtcdKeyNotFound, EtcdAlreadyExist
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from pycalico.datastore import DatastoreClient
+from pycalico.datastore_datatypes import Endpoint
+
+HOSTNAME = "host1"
+REPEATS = 5
+
+
+class LatencyEtcdClient(object):
+    """
+    Stands in for etcd.Client, keeping the keys in memory.  Supports reads of
+    single keys, writes, with prevExist, and deletes, which is all that the
+    cases need.  Every request sleeps for the configured latency.
+    """
+    def __init__(self, latency):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.values = {}
+        self.requests = 0
+
+    def _request(self):
+        time.sleep(self.latency)
+        with self.lock:
+            self.requests += 1
+
+    def read(self, key, **kwargs):
+        self._request()
+        with self.lock:
+            if key not in self.values:
+                raise EtcdKeyNotFound("Key not found : %s" % key)
+            return EtcdResult("get", {"key": key, "value": self.values[key]})
+
+    def write(self, key, value, prevExist=None, **kwargs):
+        self._request()
+        with self.lock:
+            if prevExist is False and key in self.values:
+                raise EtcdAlreadyExist("Key already exists : %s" % key)
+            self.values[key] = value
+            return EtcdResult("set", {"key": key, "value": value})
+
+    def delete(self, key, **kwargs):
+        self._request()
+        with self.lock:
+            prefix = key.rstrip("/") + "/"
+            doomed = [k for k in self.values
+                      if k == key or k.startswith(prefix)]
+            if not doomed:
+                raise EtcdKeyNotFound("Key not found : %s" % key)
+            for k in doomed:
+                del self.values[k]
+            return EtcdResult("delete", {"key": key})
+
+
+def main(arguments):
+    latency = float(arguments["--etcd-ms"]) / 1000
+    client = DatastoreClient()
+    client.etcd_client = LatencyEtcdClient(latency)
+    endpoint = Endpoint(HOSTNAME, "docker", "workload1", "1234567890ab",
+                        "active", "aa:22:aa:22:aa:22")
+    endpoint.profile_ids = ["PROF1", "PROF2"]
+    cases = [
+        ("ensure_global_config", client.ensure_global_config, ()),
+        ("create_host", client.create_host,
+         (HOSTNAME, "192.168.1.1", "fd80::1", None)),
+        ("create_profile", client.create_profile, ("PROF1",)),
+        ("set_endpoint", client.set_endpoint, (endpoint,)),
+        ("remove_endpoint", client.remove_endpoint, (endpoint,)),
+    ]
+    elapsed = dict((name, 0) for name, _, _ in cases)
+    requests = dict((name, 0) for name, _, _ in cases)
+    for _ in range(REPEATS):
+        for name, function, args in cases:
+            client.etcd_client.requests = 0
+            start = time.time()
+            function(*args)
+            elapsed[name] += (time.time() - start) / REPEATS
+            requests[name] = client.etcd_client.requests
+
+    print "%-22s %10s %10s %12s" % ("case", "ms", "requests", "round trips")
+    for name, _, _ in cases:
+        print "%-22s %10.1f %10d %12.1f" % (name, elapsed[name] * 1000,
+                                            requests[name],
+                                            elapsed[name] / latency)
+
+
+if __name__ == '__main__':
+    main(docopt(__doc__))
@@ -0,0 +1,154 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compare the cost of finding a free address with the old per-address
+assignment keys and with allocation block bitmaps.
+
+For each layout, the etcd response for the data an allocation reads is
+built and serialized once, then decoded and parsed in the same way as
+python-etcd does on each iteration, so the timings cover JSON decoding,
+building the EtcdResult and the free address search, but not the network.
+
+Three cases are timed:
+ - keys:       read every assignment key in the pool and scan for a free
+               address (the old SequentialAssignment).
+ - blocks:     read every allocation block in the pool and bit scan them
+               (SequentialAssignment).
+ - host block: read the one block a host has an affinity to and bit scan it
+               (BlockAssignment).
+
+Usage:
+  python benchmarks/ipam_layout.py [<COUNT>...]
+"""
+import json
+import os
+import sys
+import timeit
+
+from etcd import EtcdResult
+from netaddr import IPNetwork
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from pycalico.ipam import AllocationBlock, SequentialAssignment, \
+    IPAMClient, IP_ASSIGNMENT_PATH, IP_BLOCK_PATH, BLOCK_PREFIXLEN
+
+POOL = IPNetwork("10.0.0.0/16")
+COUNTS = [1000, 10000, 60000]
+REPEAT = 5
+
+
+class ReplayEtcdClient(object):
+    """
+    Stands in for etcd.Client, answering every read by decoding a
+    pre-serialized response.
+    """
+    def __init__(self, body):
+        self.body = body
+
+    def read(self, key, **kwargs):
+        return EtcdResult(**json.loads(self.body))
+
+
+def response(directory, nodes):
+    return json.dumps({"action": "get",
+                       "node": {"key": directory, "dir": True,
+                                "nodes": nodes}})
+
+
+def keys_response(count):
+    directory = IP_ASSIGNMENT_PATH % {"version": "v4",
+                                      "pool": str(POOL).replace("/", "-")}
+    nodes = []
+    for index, address in enumerate(POOL.iter_hosts()):
+        if index == count:
+            break
+        nodes.append({"key": "%s/%s" % (directory, address), "value": "",
+                      "modifiedIndex": index, "createdIndex": index})
+    return response(directory, nodes)
+
+
+def blocks_response(count):
+    directory = IP_BLOCK_PATH % {"version": "v4",
+                                 "pool": str(POOL).replace("/", "-")}
+    nodes = []
+    remaining = count
+    for block_cidr in POOL.subnet(BLOCK_PREFIXLEN[4]):
+        if remaining <= 0:
+            break
+        block = AllocationBlock(block_cidr, POOL, host_affinity="host1")
+        while remaining > 0 and block.auto_assign() is not None:
+            remaining -= 1
+        nodes.append({"key": directory + str(block_cidr).replace("/", "-"),
+                      "value": block.to_json(),
+                      "modifiedIndex": len(nodes),
+                      "createdIndex": len(nodes)})
+    return response(directory, nodes)
+
+
+def find_free_keys(client):
+    """The free address search from before allocation blocks."""
+    nodes = client.read(None).children
+    assigned = {}
+    for child in nodes:
+        if not child.dir:
+            assigned[child.key.split("/")[-1]] = ""
+    for addr in POOL.iter_hosts():
+        addr_string = str(addr)
+        if addr_string not in assigned:
+            return addr_string
+
+
+def time_per_call(func):
+    return min(timeit.repeat(func, number=1, repeat=REPEAT)) * 1000
+
+
+def main(counts):
+    client = IPAMClient()
+    assigner = SequentialAssignment()
+
+    print "%8s %12s %12s %12s %12s %12s" % ("assigned", "keys ms",
+                                            "blocks ms", "host blk ms",
+                                            "keys KB", "blocks KB")
+    for count in counts:
+        keys_body = keys_response(count)
+        keys_client = ReplayEtcdClient(keys_body)
+        keys_ms = time_per_call(lambda: find_free_keys(keys_client))
+
+        blocks_body = blocks_response(count)
+        client.etcd_client = ReplayEtcdClient(blocks_body)
+
+        def find_free_blocks():
+            blocks = dict((block.cidr, block)
+                          for block in client.get_allocation_blocks(POOL))
+            return assigner._get_next(POOL, blocks)
+        blocks_ms = time_per_call(find_free_blocks)
+
+        host_body = json.dumps({"action": "get",
+                                "node": json.loads(blocks_body)
+                                        ["node"]["nodes"][-1]})
+        host_client = ReplayEtcdClient(host_body)
+
+        def find_free_host_block():
+            result = host_client.read(None)
+            return AllocationBlock.from_json(result.value, POOL).auto_assign()
+        host_ms = time_per_call(find_free_host_block)
+
+        print "%8d %12.2f %12.2f %12.3f %12.1f %12.1f" % (
+            count, keys_ms, blocks_ms, host_ms,
+            len(keys_body) / 1024.0, len(blocks_body) / 1024.0)
+
+
+if __name__ == '__main__':
+    main([int(count) for count in sys.argv[1:]] or COUNTS)
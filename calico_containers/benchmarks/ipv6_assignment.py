@@ -0,0 +1,180 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compare the cost of assigning an address from the default IPv6 /64 pool as
+the number of assigned addresses grows.
+
+The datastore is an in-memory stand-in for etcd.Client, which counts the
+requests made and the keys returned by reads.  For each count, the pool is
+filled with that many addresses, laid out as each allocator would leave
+them, and then ALLOCATIONS more addresses are allocated.
+
+Cases:
+ - sequential: SequentialAssignment, which reads every block in the pool and
+               takes the lowest free address.
+ - block:      BlockAssignment, which tries each of the host's blocks in
+               turn, here all owned by one host.
+ - random:     RandomAssignment, which assigns a random address.
+
+Usage:
+  python benchmarks/ipv6_assignment.py [<COUNT>...]
+"""
+import os
+import random
+import sys
+import time
+
+from etcd import EtcdResult, EtcdKeyNotFound, EtcdAlreadyExist
+from netaddr import IPAddress, IPNetwork
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from pycalico.ipam import AllocationBlock, BlockAssignment, IPAMClient, \
+    RandomAssignment, SequentialAssignment, BLOCK_PREFIXLEN, IP_BLOCK_KEY, \
+    IP_HOST_AFFINITY_KEY, IP_USAGE_KEY
+
+POOL = IPNetwork("fd80:24e2:f998:72d6::/64")
+HOSTNAME = "host1"
+COUNTS = [1000, 10000, 50000]
+ALLOCATIONS = 20
+
+
+class MemoryEtcdClient(object):
+    """
+    Stands in for etcd.Client, holding the keys in memory.  Only supports
+    what the allocators use: reads of keys and of directories of keys, and
+    writes with prevExist or prevIndex.
+    """
+    def __init__(self):
+        self.values = {}
+        self.dirs = {}
+        self.index = 0
+        self.requests = 0
+        self.nodes_read = 0
+
+    def _node(self, key):
+        value, index = self.values[key]
+        return {"key": key, "value": value, "modifiedIndex": index,
+                "createdIndex": index}
+
+    def read(self, key, **kwargs):
+        self.requests += 1
+        key = key.rstrip("/")
+        if key in self.values:
+            self.nodes_read += 1
+            return EtcdResult("get", self._node(key))
+        if key not in self.dirs:
+            raise EtcdKeyNotFound("Key not found : %s" % key)
+        nodes = [self._node(child) for child in self.dirs[key]]
+        self.nodes_read += len(nodes)
+        return EtcdResult("get", {"key": key, "dir": True, "nodes": nodes})
+
+    def write(self, key, value, prevExist=None, prevIndex=None, **kwargs):
+        self.requests += 1
+        if prevExist is False and key in self.values:
+            raise EtcdAlreadyExist("Key already exists : %s" % key)
+        if prevIndex is not None and self.values[key][1] != prevIndex:
+            raise ValueError("Compare failed")
+        self.index += 1
+        self.values[key] = (value, self.index)
+        child = key
+        while child.count("/") > 1:
+            parent = child.rsplit("/", 1)[0]
+            self.dirs.setdefault(parent, set()).add(child)
+            child = parent
+        return EtcdResult("set", self._node(key))
+
+
+def block_key(block):
+    return IP_BLOCK_KEY % {"version": "v6",
+                           "pool": str(POOL).replace("/", "-"),
+                           "block": str(block.cidr).replace("/", "-")}
+
+
+def fill_blocks(etcd, count):
+    """
+    Assign the lowest count addresses, in full blocks owned by the host, as
+    SequentialAssignment and BlockAssignment leave them.
+    """
+    blocks = POOL.subnet(BLOCK_PREFIXLEN[6])
+    assigned = 0
+    while assigned < count:
+        block = AllocationBlock(next(blocks), POOL, host_affinity=HOSTNAME)
+        while assigned < count and block.auto_assign() is not None:
+            assigned += 1
+        etcd.write(block_key(block), block.to_json())
+        etcd.write(IP_HOST_AFFINITY_KEY % {
+                        "version": "v6",
+                        "hostname": HOSTNAME,
+                        "pool": str(POOL).replace("/", "-"),
+                        "block": str(block.cidr).replace("/", "-")}, "")
+
+
+def fill_random(etcd, count):
+    """
+    Assign count random addresses, as RandomAssignment leaves them.
+    """
+    blocks = {}
+    for _ in range(count):
+        address = IPAddress(POOL.first + random.randrange(POOL.size), 6)
+        cidr = IPNetwork("%s/%d" % (address, BLOCK_PREFIXLEN[6])).cidr
+        block = blocks.setdefault(cidr, AllocationBlock(cidr, POOL))
+        block.assign(address)
+    for block in blocks.itervalues():
+        etcd.write(block_key(block), block.to_json())
+
+
+def measure(assigner_class, fill, count):
+    """
+    :return: The time in ms, the number of requests and the number of keys
+    read, per allocation.
+    """
+    client = IPAMClient()
+    client.etcd_client = MemoryEtcdClient()
+    fill(client.etcd_client, count)
+    client.etcd_client.write(IP_USAGE_KEY % {
+                                "version": "v6",
+                                "pool": str(POOL).replace("/", "-")},
+                             str(count))
+    if assigner_class is SequentialAssignment:
+        assigner = SequentialAssignment()
+        assigner.etcd = client
+    else:
+        assigner = assigner_class(HOSTNAME, client)
+
+    client.etcd_client.requests = client.etcd_client.nodes_read = 0
+    start = time.time()
+    for _ in range(ALLOCATIONS):
+        assert assigner.allocate(POOL) is not None
+    elapsed = time.time() - start
+    return (elapsed * 1000 / ALLOCATIONS,
+            float(client.etcd_client.requests) / ALLOCATIONS,
+            float(client.etcd_client.nodes_read) / ALLOCATIONS)
+
+
+def main(counts):
+    cases = [("sequential", SequentialAssignment, fill_blocks),
+             ("block", BlockAssignment, fill_blocks),
+             ("random", RandomAssignment, fill_random)]
+    print "%8s %-10s %10s %10s %10s" % ("count", "case", "ms", "requests",
+                                        "keys read")
+    for count in counts:
+        for name, assigner_class, fill in cases:
+            elapsed, requests, nodes = measure(assigner_class, fill, count)
+            print "%8d %-10s %10.2f %10.1f %10.1f" % (count, name, elapsed,
+                                                      requests, nodes)
+
+
+if __name__ == '__main__':
+    main([int(count) for count in sys.argv[1:]] or COUNTS)
@@ -0,0 +1,85 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Time netns.set_up_endpoint() with the `ip` command and netlink backends.
+
+Each iteration sets up an endpoint in a scratch network namespace (held open
+by a `sleep` process started with `unshare --net`) and then removes it.  Only
+the set up is timed.
+
+This must be run as root, and creates veths in the namespace it is run in, so
+run it in a scratch namespace too:
+
+  sudo unshare --net python benchmarks/netns_setup.py [<ITERATIONS>]
+"""
+import os
+import subprocess
+import sys
+import time
+
+from netaddr import IPAddress
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from pycalico import netns
+
+ITERATIONS = 50
+NEXT_HOPS = {4: IPAddress("169.254.1.1"), 6: IPAddress("fd00::1")}
+
+
+def percentile(times, percent):
+    times = sorted(times)
+    return times[int(round(percent / 100.0 * (len(times) - 1)))]
+
+
+def time_setup(iterations, pid):
+    times = []
+    for index in range(iterations):
+        ip = IPAddress("10.0.%d.%d" % (index / 250, index % 250 + 1))
+        start = time.time()
+        endpoint = netns.set_up_endpoint(ip=ip,
+                                         hostname="bench",
+                                         orchestrator_id="bench",
+                                         workload_id="bench",
+                                         cpid=pid,
+                                         next_hop_ips=NEXT_HOPS,
+                                         proc_alias="/proc")
+        times.append(time.time() - start)
+        netns.remove_endpoint(endpoint.endpoint_id)
+    return times
+
+
+def main(iterations):
+    container = subprocess.Popen(["unshare", "--net", "sleep", "3600"])
+    try:
+        # Wait for the namespace to be created.
+        time.sleep(0.5)
+
+        backends = [("ip", False)]
+        if netns.IPRoute is not None:
+            backends.append(("netlink", True))
+
+        print "%-8s %10s %10s" % ("backend", "p50 ms", "p99 ms")
+        for name, use_netlink in backends:
+            netns.NETLINK_AVAILABLE = use_netlink
+            times = time_setup(iterations, container.pid)
+            print "%-8s %10.2f %10.2f" % (name,
+                                         percentile(times, 50) * 1000,
+                                         percentile(times, 99) * 1000)
+    finally:
+        container.kill()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else ITERATIONS)
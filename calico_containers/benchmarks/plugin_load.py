@@ -0,0 +1,259 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Load test for the libnetwork plugin.
+
+Fires CreateEndpoint, Join and DeleteEndpoint requests for N endpoints at
+once against the Flask app and reports the latency of each type of request.
+The datastore, the `ip` commands and the netlink veth creation are replaced
+with stubs that sleep for a fixed time to stand in for an etcd round trip and
+a subprocess.
+
+Each endpoint's requests are made from its own thread, as they would be by a
+threaded gunicorn worker.  With --serial, requests are handled one at a time,
+as they were by the sync worker.
+
+With --reserve, the plugin keeps a reserve of that many addresses of each
+version, which is filled before the requests start.
+
+Usage:
+  plugin_load.py [--endpoints=<N>] [--etcd-ms=<MS>] [--ip-ms=<MS>]
+                 [--reserve=<N>] [--serial]
+
+Options:
+ --endpoints=<N>  Number of endpoints to create concurrently [default: 200]
+ --etcd-ms=<MS>   Latency of each datastore request [default: 2]
+ --ip-ms=<MS>     Latency of each ip command [default: 5]
+ --reserve=<N>    Number of addresses to keep in reserve [default: 0]
+ --serial         Handle one request at a time.
+"""
+import json
+import os
+import sys
+import threading
+import time
+
+from docopt import docopt
+from netaddr import IPAddress
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import docker_plugin
+from pycalico import ipam
+from pycalico.datastore_datatypes import IPPool
+
+NETWORK_ID = "load-test-network"
+
+
+class StubDatastore(object):
+    """
+    Stands in for the IPAMClient used by the plugin, keeping its data in
+    memory.  Every call sleeps for the configured etcd latency.
+    """
+    # Dual-stack allocation runs as it does in IPAMClient, using the stubs.
+    allocate_dual_stack = ipam.IPAMClient.allocate_dual_stack.im_func
+    _allocate_for_host = ipam.IPAMClient._allocate_for_host.im_func
+    _release_for_host = ipam.IPAMClient._release_for_host.im_func
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.reserved = {}
+        self.handles = {}
+        self.next_address = {4: IPAddress("10.0.0.1"),
+                             6: IPAddress("fd80::1")}
+
+    def _request(self):
+        time.sleep(self.latency)
+
+    def get_default_next_hops(self, hostname):
+        self._request()
+        return {4: IPAddress("192.168.0.1"), 6: IPAddress("fd00::1")}
+
+    def get_ip_pools(self, version):
+        self._request()
+        return [IPPool("10.0.0.0/8") if version == "v4" else
+                IPPool("fd80::/64")]
+
+    def get_free_ip_pools(self, version):
+        return self.get_ip_pools(version)
+
+    def allocate(self, pool):
+        self._request()
+        with self.lock:
+            address = self.next_address[pool.version]
+            self.next_address[pool.version] += 1
+        return str(address)
+
+    def unassign_address(self, pool, address, handle=None):
+        self._request()
+        return True
+
+    def get_reserved_addresses(self, hostname, version):
+        self._request()
+        with self.lock:
+            return [(address, pool)
+                    for address, pool in self.reserved.iteritems()
+                    if "v%d" % address.version == version]
+
+    def reserve_address(self, hostname, address, pool):
+        self._request()
+        with self.lock:
+            self.reserved[address] = pool
+
+    def unreserve_address(self, hostname, address):
+        self._request()
+        with self.lock:
+            self.reserved.pop(address, None)
+        return True
+
+    def add_to_handle(self, handle, pool, address):
+        self._request()
+        with self.lock:
+            self.handles.setdefault(handle, []).append((pool, address))
+
+    def remove_from_handle(self, handle, address):
+        self._request()
+        with self.lock:
+            entries = self.handles.get(handle, [])
+            self.handles[handle] = [(pool, entry) for pool, entry in entries
+                                    if entry != address]
+        return True
+
+    def get_handle(self, handle):
+        self._request()
+        with self.lock:
+            return list(self.handles.get(handle, []))
+
+    def remove_handle(self, handle):
+        self._request()
+        with self.lock:
+            self.handles.pop(handle, None)
+
+    def set_endpoint(self, endpoint):
+        self._request()
+        with self.lock:
+            self.endpoints[endpoint.endpoint_id] = endpoint
+
+    def get_endpoint(self, endpoint_id, **kwargs):
+        self._request()
+        with self.lock:
+            return self.endpoints[endpoint_id]
+
+    def remove_endpoint(self, endpoint):
+        self._request()
+        with self.lock:
+            del self.endpoints[endpoint.endpoint_id]
+
+
+class StubAssignment(object):
+    def __init__(self, hostname, client):
+        self.client = client
+
+    def allocate(self, pool, handle=None):
+        if isinstance(pool, IPPool):
+            pool = pool.cidr
+        address = self.client.allocate(pool)
+        if handle is not None:
+            self.client.add_to_handle(handle, pool, IPAddress(address))
+        return address
+
+
+def stub_ip_command(latency):
+    def ip_command(args, timeout=None):
+        time.sleep(latency)
+        return 0
+    return ip_command
+
+
+def stub_create_veth(latency):
+    def create_veth(name, peer_name, peer_mac=None):
+        time.sleep(latency)
+    return create_veth
+
+
+def percentile(latencies, percent):
+    latencies = sorted(latencies)
+    index = int(round(percent / 100.0 * (len(latencies) - 1)))
+    return latencies[index]
+
+
+def run(endpoints, serial):
+    app = docker_plugin.app.test_client()
+    latencies = {"CreateEndpoint": [], "Join": [], "DeleteEndpoint": []}
+    serial_lock = threading.Lock()
+    start_event = threading.Event()
+
+    def request(method, ep_id):
+        body = json.dumps({"EndpointID": ep_id, "NetworkID": NETWORK_ID})
+        start = time.time()
+        if serial:
+            with serial_lock:
+                rv = app.post("/NetworkDriver.%s" % method, data=body)
+        else:
+            rv = app.post("/NetworkDriver.%s" % method, data=body)
+        latencies[method].append(time.time() - start)
+        assert rv.status_code == 200, rv.data
+
+    def endpoint_lifecycle(ep_id):
+        start_event.wait()
+        for method in ("CreateEndpoint", "Join", "DeleteEndpoint"):
+            request(method, ep_id)
+
+    threads = [threading.Thread(target=endpoint_lifecycle,
+                                args=("endpoint%d" % index,))
+               for index in range(endpoints)]
+    for thread in threads:
+        thread.start()
+    start = time.time()
+    start_event.set()
+    for thread in threads:
+        thread.join()
+    return latencies, time.time() - start
+
+
+def main(arguments):
+    endpoints = int(arguments["--endpoints"])
+    etcd_latency = float(arguments["--etcd-ms"]) / 1000
+    ip_latency = float(arguments["--ip-ms"]) / 1000
+
+    docker_plugin.app.logger.disabled = True
+    docker_plugin.client = StubDatastore(etcd_latency)
+    ipam.RandomAssignment = StubAssignment
+    docker_plugin.check_call = stub_ip_command(ip_latency)
+    docker_plugin.call = stub_ip_command(ip_latency)
+    docker_plugin.netns.create_veth = stub_create_veth(ip_latency)
+
+    reserve_size = int(arguments["--reserve"])
+    for version in ("v4", "v6"):
+        reserve = docker_plugin.AddressReserve(docker_plugin.hostname, version,
+                                               reserve_size,
+                                               docker_plugin.client)
+        reserve.refill()
+        docker_plugin.ip_reserves[version] = reserve
+
+    latencies, elapsed = run(endpoints, arguments["--serial"])
+
+    print "%d endpoints in %.2fs (%s)" % (
+        endpoints, elapsed, "serial" if arguments["--serial"] else "threaded")
+    print "%-16s %10s %10s" % ("request", "p50 ms", "p99 ms")
+    for method in ("CreateEndpoint", "Join", "DeleteEndpoint"):
+        print "%-16s %10.1f %10.1f" % (method,
+                                      percentile(latencies[method], 50) * 1000,
+                                      percentile(latencies[method], 99) * 1000)
+
+
+if __name__ == '__main__':
+    main(docopt(__doc__))
@@ -0,0 +1,85 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Time finding the pool that an address is in, with N /24 pools configured.
+The times are per lookup, or for the build case per pool.
+
+Cases:
+ - linear: check each pool in turn with `ip in pool`, which is what
+           get_pool_or_exit() and unassign_ip() did before IPPoolSet.
+ - trie:   IPPoolSet.get_pool().
+ - build:  build the IPPoolSet from the pools, which is only repeated when
+           the pools change.
+
+Each lookup is for an address in a random pool.
+
+Usage:
+  python benchmarks/pool_lookup.py [<COUNT>...]
+"""
+import os
+import random
+import sys
+import time
+
+from netaddr import IPAddress
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from pycalico.datastore_datatypes import IPPool, IPPoolSet
+
+COUNTS = [10, 100, 1000]
+LOOKUPS = 2000
+
+
+def linear(pools, addresses):
+    for address in addresses:
+        for pool in pools:
+            if address in pool:
+                break
+
+
+def trie(pools, addresses):
+    pool_set = IPPoolSet(pools)
+    start = time.time()
+    for address in addresses:
+        pool_set.get_pool(address)
+    return time.time() - start
+
+
+def main(counts):
+    print "%6s %-8s %10s" % ("pools", "case", "us")
+    for count in counts:
+        pools = [IPPool("10.%d.%d.0/24" % (index / 256, index % 256))
+                 for index in range(count)]
+        addresses = [IPAddress(random.choice(pools).cidr.first + 10)
+                     for _ in range(LOOKUPS)]
+
+        start = time.time()
+        linear(pools, addresses)
+        elapsed = time.time() - start
+        print "%6d %-8s %10.1f" % (count, "linear",
+                                   elapsed * 1000000 / LOOKUPS)
+
+        elapsed = trie(pools, addresses)
+        print "%6d %-8s %10.1f" % (count, "trie",
+                                   elapsed * 1000000 / LOOKUPS)
+
+        start = time.time()
+        IPPoolSet(pools)
+        elapsed = time.time() - start
+        print "%6d %-8s %10.1f" % (count, "build", elapsed * 1000000 / count)
+
+
+if __name__ == '__main__':
+    main([int(count) for count in sys.argv[1:]] or COUNTS)
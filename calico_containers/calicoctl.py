@@ -17,7 +17,8 @@
 """calicoctl
 
 Override the host:port of the ETCD server by setting the environment variable
-ETCD_AUTHORITY [default: 127.0.0.1:4001]
+ETCD_AUTHORITY [default: 127.0.0.1:4001].  For a cluster, set it to a
+comma-separated list of the host:port of each member.
 
 Usage:
   calicoctl node [--ip=<IP>] [--ip6=<IP6>] [--node-image=<DOCKER_IMAGE_NAME>]
@@ -40,6 +41,9 @@ Usage:
   calicoctl profile <PROFILE> rule update
   calicoctl pool (add|remove) <CIDR> [--ipip] [--nat-outgoing]
   calicoctl pool show [--ipv4 | --ipv6]
+  calicoctl pool usage [--ipv4 | --ipv6] [--detailed] [--recount]
+  calicoctl ipam migrate
+  calicoctl ipam gc [--dry-run]
   calicoctl default-node-as [<AS_NUM>]
   calicoctl bgppeer add <PEER_IP> as <AS_NUM>
   calicoctl bgppeer remove <PEER_IP>
@@ -52,6 +56,7 @@ Usage:
   calicoctl endpoint show [--host=<HOSTNAME>] [--orchestrator=<ORCHESTRATOR_ID>] [--workload=<WORKLOAD_ID>] [--endpoint=<ENDPOINT_ID>] [--detailed]
   calicoctl endpoint <ENDPOINT_ID> profile (append|remove|set) [--host=<HOSTNAME>] [--orchestrator=<ORCHESTRATOR_ID>] [--workload=<WORKLOAD_ID>]  [<PROFILES>...]
   calicoctl endpoint <ENDPOINT_ID> profile show [--host=<HOSTNAME>] [--orchestrator=<ORCHESTRATOR_ID>] [--workload=<WORKLOAD_ID>]
+  calicoctl endpoint index (verify|rebuild)
   calicoctl diags [--log-dir=<LOG_DIR>] [--upload]
   calicoctl checksystem [--fix]
 
@@ -71,6 +76,9 @@ Options:
  --workload=<WORKLOAD_ID> Filters endpoints on a specific workload.
  --endpoint=<ENDPOINT_ID> Filters endpoints with a specific endpoint ID.
  --as=<AS_NUM>            The AS number to assign to the node.
+ --dry-run                List the leaked addresses without releasing them.
+ --recount                Count the allocated addresses from the allocation
+                          blocks, and correct the pools' usage counters.
 """
 __doc__ = __doc__ % {"rule_spec": """    (allow|deny) [(
       (tcp|udp) [(from [(ports <SRCPORTS>)] [(tag <SRCTAG>)] [<SRCCIDR>])]
@@ -112,7 +120,8 @@ from pycalico.datastore_errors import DataStoreError, \
     ProfileNotInEndpoint, ProfileAlreadyInEndpoint, MultipleEndpointsMatch
 from pycalico.datastore_datatypes import Rules, BGPPeer, IPPool, \
     Rule
-from pycalico.ipam import IPAMClient
+from pycalico.ipam import IPAMClient, GC_GRACE_PERIOD
+from pycalico.snapshot import Snapshot
 
 hostname = socket.gethostname()
 client = IPAMClient()
@@ -183,17 +192,13 @@ def enforce_root():
 
 def get_pool_or_exit(ip):
     """
-    Get the first allocation pool that an IP is in.
+    Get the allocation pool that an IP is in.  If the IP is in more than one
+    pool, the pool with the longest prefix is used.
 
     :param ip: The IPAddress to find the pool for.
     :return: The pool or sys.exit
     """
-    pools = client.get_ip_pools("v%s" % ip.version)
-    pool = None
-    for candidate_pool in pools:
-        if ip in candidate_pool:
-            pool = candidate_pool
-            break
+    pool = client.get_ip_pool_set("v%s" % ip.version).get_pool(ip)
     if pool is None:
         print "%s is not in any configured pools" % ip
         sys.exit(1)
@@ -248,8 +253,8 @@ def container_add(container_name, ip, interface):
         print "This node is not configured for IPv%d." % ip.version
         sys.exit(1)
 
-    # Assign the IP
-    if not client.assign_address(pool, ip):
+    # Assign the IP, recording it under the container's allocation handle.
+    if not client.assign_address(pool, ip, handle=container_id):
         print "IP address is already assigned in pool %s " % pool
         sys.exit(1)
 
@@ -296,13 +301,15 @@ def container_remove(container_name):
         print "Container %s doesn't contain any endpoints" % container_name
         sys.exit(1)
 
-    # Remove any IP address assignments that this endpoint has
-    for net in endpoint.ipv4_nets | endpoint.ipv6_nets:
-        assert(net.size == 1)
-        ip = net.ip
-        pools = client.get_ip_pools("v%s" % ip.version)
-        for pool in pools:
-            if ip in pool:
+    # Remove any IP address assignments that this endpoint has.  These are
+    # recorded under the container's allocation handle, unless the container
+    # was added before handles were recorded.
+    if not client.release_by_handle(workload_id):
+        for net in endpoint.ipv4_nets | endpoint.ipv6_nets:
+            assert(net.size == 1)
+            ip = net.ip
+            pool = client.get_ip_pool_set("v%s" % ip.version).get_pool(ip)
+            if pool is not None:
                 # Ignore failure to unassign address, since we're not
                 # enforcing assignments strictly in datastore.py.
                 client.unassign_address(pool, ip)
@@ -391,7 +398,10 @@ def node(node_image, log_dir, ip="", ip6="", as_num=None):
         if err.response.status_code != 404:
             raise
 
-    etcd_authority = os.getenv(ETCD_AUTHORITY_ENV, ETCD_AUTHORITY_DEFAULT)
+    # The services in the node container each connect to a single etcd
+    # member, so give them the first one.
+    etcd_authority = os.getenv(ETCD_AUTHORITY_ENV,
+                               ETCD_AUTHORITY_DEFAULT).split(",")[0].strip()
 
     environment = [
         "HOSTNAME=%s" % hostname,
@@ -412,6 +422,13 @@ def node(node_image, log_dir, ip="", ip6="", as_num=None):
                 "bind": "/var/log/calico",
                 "ro": False
             },
+        # The plugin's journal of endpoints to tear down, which needs to
+        # survive the node container being replaced.
+        "/var/lib/calico":
+            {
+                "bind": "/var/lib/calico",
+                "ro": False
+            },
         "/usr/share/docker/plugins/": #TODO make this an optional node
         # parameter like log_dir
         #"/run/docker/plugins/":
@@ -436,6 +453,7 @@ def node(node_image, log_dir, ip="", ip6="", as_num=None):
         host_config=host_config,
         volumes=["/proc_host",
                  "/var/log/calico",
+                 "/var/lib/calico",
                  "/usr/share/docker/plugins"])
     cid = container["Id"]
 
@@ -686,13 +704,15 @@ def profile_remove(profile_name):
 
 
 def profile_show(detailed):
-    profiles = client.get_profile_names()
-
     if detailed:
+        # Read everything at once rather than reading each profile's members.
+        snapshot = Snapshot.load(client)
+        profiles = snapshot.get_profile_names()
         x = PrettyTable(["Name", "Host", "Orchestrator ID", "Workload ID",
                          "Endpoint ID", "State"])
+        all_members = snapshot.get_all_profile_members()
         for name in profiles:
-            members = client.get_profile_members(name)
+            members = all_members.get(name)
             if not members:
                 x.add_row([name, "None", "None", "None", "None", "None"])
                 continue
@@ -705,6 +725,7 @@ def profile_show(detailed):
                            endpoint.endpoint_id,
                            endpoint.state])
     else:
+        profiles = client.get_profile_names()
         x = PrettyTable(["Name"])
         for name in profiles:
             x.add_row([name])
@@ -906,6 +927,18 @@ def ip_pool_add(cidr_pool, version, ipip, masquerade):
 
     cidr = check_ip_version(cidr_pool, version, IPNetwork)
     pool = IPPool(cidr, ipip=ipip, masquerade=masquerade)
+
+    # Re-adding an existing pool updates its options, but a pool can't
+    # overlap any other pool.
+    pool_set = client.get_ip_pool_set(version)
+    overlapping = [str(existing.cidr)
+                   for existing in pool_set.get_overlapping_pools(pool.cidr)
+                   if existing.cidr != pool.cidr]
+    if overlapping:
+        print "Cannot add pool %s, as it overlaps with existing pools: %s" % \
+              (pool.cidr, ", ".join(sorted(overlapping)))
+        sys.exit(1)
+
     client.add_ip_pool(version, pool)
 
 
@@ -945,6 +978,90 @@ def ip_pool_show(version):
         x.add_row(row)
     print x.get_string(sortby=headings[0])
 
+
+def ip_pool_usage(version, detailed, recount):
+    """
+    Print the number of allocated and free addresses in each IP allocation
+    pool, from the pools' usage counters.
+    :param version: "v4" or "v6"
+    :param detailed: Whether to also print the usage of each pool by host,
+    which reads the pool's allocation blocks.
+    :param recount: Whether to recount the pools' allocated addresses from
+    their allocation blocks first, correcting the counters.
+    :return: None
+    """
+    assert version in ("v4", "v6")
+    if recount:
+        for pool in client.get_ip_pools(version):
+            client.recount_pool_usage(pool)
+    headings = ["IP%s CIDR" % version, "Allocated", "Free", "Used"]
+    x = PrettyTable(headings)
+    usage = client.get_ip_pools_usage(version)
+    for pool, allocated, free in usage:
+        x.add_row([str(pool.cidr), allocated, free,
+                   _percentage(allocated, allocated + free)])
+    print x.get_string(sortby=headings[0])
+
+    if not detailed:
+        return
+
+    headings = ["IP%s CIDR" % version, "Host", "Blocks", "Full blocks",
+                "Allocated", "Free in blocks", "Used"]
+    x = PrettyTable(headings)
+    for pool, _, _ in usage:
+        host_usage = client.get_host_usage(pool)
+        for host, (blocks, full, allocated, free) in host_usage.iteritems():
+            x.add_row([str(pool.cidr), host or "(no affinity)", blocks, full,
+                       allocated, free,
+                       _percentage(allocated, allocated + free)])
+    print x.get_string(sortby=headings[0])
+
+
+def _percentage(part, total):
+    """
+    Format a fraction as a percentage, for the usage tables.
+    """
+    if not total:
+        return "-"
+    return "%.1f%%" % (100.0 * part / total)
+
+
+def ipam_migrate():
+    """
+    Convert the per-address IP assignments written by earlier versions of
+    Calico into allocation blocks.
+    :return: None
+    """
+    for version in ("v4", "v6"):
+        for pool in client.get_ip_pools(version):
+            count = client.migrate_assignments(pool)
+            print "Migrated %d assigned addresses in pool %s" % (count,
+                                                                  pool.cidr)
+
+
+def ipam_gc(dry_run):
+    """
+    Release IP addresses that are assigned but not used by any endpoint or
+    host reserve, for example because a host was removed with
+    `calicoctl node stop --force`, and release the blocks of removed hosts.
+    :param dry_run: Whether to only list the leaked addresses.
+    :return: None
+    """
+    if not dry_run:
+        print "Waiting %d seconds to check the leaked addresses are unused." \
+              % GC_GRACE_PERIOD
+    leaked = client.release_leaked_addresses(dry_run=dry_run)
+    for pool, address in sorted(leaked):
+        print "Leaked address %s in pool %s" % (address, pool)
+
+    if dry_run:
+        print "Found %d leaked addresses." % len(leaked)
+        if leaked:
+            print "Run `calicoctl ipam gc` to release them."
+    else:
+        print "Released %d leaked addresses." % len(leaked)
+
+
 def set_bgp_node_mesh(enable):
     """
     Set the BGP node mesh setting.
@@ -1152,7 +1269,7 @@ def container_ip_add(container_name, ip, version, interface):
 
     # From here, this method starts having side effects. If something
     # fails then at least try to leave the system in a clean state.
-    if not client.assign_address(pool, ip):
+    if not client.assign_address(pool, address, handle=container_id):
         print "IP address is already assigned in pool %s " % pool
         sys.exit(1)
 
@@ -1163,7 +1280,7 @@ def container_ip_add(container_name, ip, version, interface):
             endpoint.ipv6_nets.add(IPNetwork(address))
         client.update_endpoint(endpoint)
     except (KeyError, ValueError):
-        client.unassign_address(pool, ip)
+        client.unassign_address(pool, address, handle=container_id)
         print "Error updating datastore. Aborting."
         sys.exit(1)
 
@@ -1180,7 +1297,7 @@ def container_ip_add(container_name, ip, version, interface):
         else:
             endpoint.ipv6_nets.remove(IPNetwork(address))
         client.update_endpoint(endpoint)
-        client.unassign_address(pool, ip)
+        client.unassign_address(pool, address, handle=container_id)
         sys.exit(1)
 
     print "IP %s added to %s" % (ip, container_id)
@@ -1248,11 +1365,34 @@ def container_ip_remove(container_name, ip, version, interface):
         print "Error updating networking in container. Aborting."
         sys.exit(1)
 
-    client.unassign_address(pool, ip)
+    client.unassign_address(pool, address, handle=container_id)
 
     print "IP %s removed from %s" % (ip, container_name)
 
 
+def endpoint_index_check(rebuild):
+    """
+    Check that the indexes used to look up endpoints by endpoint ID, workload
+    ID and profile are consistent with the endpoints, and optionally fix them.
+
+    :param rebuild: Whether to fix any inconsistencies.
+    :return: None
+    """
+    missing, stale = client.check_endpoint_index(repair=rebuild)
+    for key in missing:
+        print "Missing or incorrect index entry: %s" % key
+    for key in stale:
+        print "Stale index entry: %s" % key
+
+    if not (missing or stale):
+        print "Endpoint index is consistent."
+    elif rebuild:
+        print "Endpoint index rebuilt."
+    else:
+        print "Run `calicoctl endpoint index rebuild` to fix the endpoint index."
+        sys.exit(1)
+
+
 def endpoint_show(hostname, orchestrator_id, workload_id, endpoint_id,
                   detailed):
     """
@@ -1749,7 +1889,9 @@ if __name__ == '__main__':
         elif arguments["checksystem"]:
             checksystem(arguments["--fix"], quit_if_error=True)
         elif arguments["endpoint"]:
-            if arguments["profile"]:
+            if arguments["index"]:
+                endpoint_index_check(arguments["rebuild"])
+            elif arguments["profile"]:
                 if arguments["append"]:
                     endpoint_profile_append(arguments["--host"],
                                             arguments["--orchestrator"],
@@ -1858,6 +2000,20 @@ if __name__ == '__main__':
                     ip_pool_show("v6")
                 else:
                     ip_pool_show(ip_version)
+            elif arguments["usage"]:
+                if not ip_version:
+                    ip_pool_usage("v4", arguments["--detailed"],
+                                  arguments["--recount"])
+                    ip_pool_usage("v6", arguments["--detailed"],
+                                  arguments["--recount"])
+                else:
+                    ip_pool_usage(ip_version, arguments["--detailed"],
+                                  arguments["--recount"])
+        elif arguments["ipam"]:
+            if arguments["migrate"]:
+                ipam_migrate()
+            elif arguments["gc"]:
+                ipam_gc(arguments["--dry-run"])
         elif arguments["bgppeer"]:
             if arguments["add"]:
                 bgppeer_add(arguments["<PEER_IP>"], ip_version,
@@ -12,20 +12,28 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from flask import Flask, jsonify, abort, request
+from flask import Flask, Response, jsonify, abort, g, request
 import os
 import socket
 import logging
 import sys
+import threading
+import time
+from wsgiref.simple_server import make_server, WSGIRequestHandler
 
 from subprocess32 import check_call, CalledProcessError, call
 from werkzeug.exceptions import HTTPException, default_exceptions
-from netaddr import IPAddress, IPNetwork
+from netaddr import IPNetwork
 
+from pycalico import datastore_stats, netns
+from pycalico.metrics import Counter, DatastoreMetrics, Gauge, Histogram, \
+    format_metrics, CONTENT_TYPE
 from pycalico.datastore import IF_PREFIX
 from pycalico.datastore_errors import DataStoreError
 from pycalico.datastore_datatypes import Endpoint
-from pycalico.ipam import SequentialAssignment, IPAMClient
+from pycalico.endpoint_cache import EndpointCache
+from pycalico.journal import Journal
+from pycalico.ipam import AddressReserve, IPAMClient
 
 FIXED_MAC = "EE:EE:EE:EE:EE:EE"
 
@@ -35,8 +43,48 @@ ORCHESTRATOR_ID = "docker"
 # How long to wait (seconds) for IP commands to complete.
 IP_CMD_TIMEOUT = 5
 
+# The plugin runs in a threaded gunicorn worker, so requests are handled
+# concurrently.  This should match the --threads setting of the worker.
+MAX_CONCURRENT_REQUESTS = int(os.getenv("CALICO_PLUGIN_THREADS", "32"))
+
 hostname = socket.gethostname()
-client = IPAMClient()
+client = IPAMClient(cached=True, max_connections=MAX_CONCURRENT_REQUESTS)
+
+# The number of addresses of each version to keep assigned to this host, ready
+# for new endpoints.  0 disables the reserve.
+IP_RESERVE_SIZE = int(os.getenv("CALICO_IP_RESERVE_SIZE", "16"))
+ip_reserves = {"v4": AddressReserve(hostname, "v4", IP_RESERVE_SIZE, client),
+               "v6": AddressReserve(hostname, "v6", IP_RESERVE_SIZE, client)}
+
+# The endpoints we've created, so that Join doesn't need to read them back.
+endpoint_cache = EndpointCache(client)
+
+# The directory of the journal of endpoints waiting to be torn down.
+TEARDOWN_DIR = os.getenv("CALICO_TEARDOWN_DIR", "/var/lib/calico/teardown")
+
+# The stages of tearing down an endpoint, as recorded in the journal.  The IPs
+# are released at most once, so a teardown that is retried after that stage
+# only removes the endpoint and its veth.
+STAGE_RELEASE_IPS = "release_ips"
+STAGE_REMOVE_ENDPOINT = "remove_endpoint"
+
+# If set, /metrics is also served on this TCP port, on all addresses.
+METRICS_PORT = os.getenv("CALICO_METRICS_PORT")
+
+REQUESTS = Counter("calico_plugin_requests_total",
+                   "Requests handled, by route and HTTP status.",
+                   ("route", "status"))
+REQUEST_SECONDS = Histogram("calico_plugin_request_duration_seconds",
+                            "How long requests took, by route.", ("route",))
+REQUESTS_IN_FLIGHT = Gauge("calico_plugin_requests_in_flight",
+                           "Requests being handled, by route.", ("route",))
+PHASE_SECONDS = Histogram("calico_plugin_phase_duration_seconds",
+                          "How long each phase of creating, joining and "
+                          "deleting endpoints took.", ("phase",))
+SUBPROCESSES = Counter("calico_plugin_subprocesses_total",
+                       "Subprocesses run, by command.", ("command",))
+METRICS = [REQUESTS, REQUEST_SECONDS, REQUESTS_IN_FLIGHT, PHASE_SECONDS,
+           SUBPROCESSES, DatastoreMetrics()]
 
 # Return all errors as JSON. From http://flask.pocoo.org/snippets/83/
 def make_json_app(import_name, **kwargs):
@@ -69,6 +117,31 @@ app.logger.setLevel(logging.INFO)
 
 app.logger.info("Application started")
 
+
+@app.before_request
+def start_request():
+    g.start_time = time.time()
+    g.route = request.url_rule.rule if request.url_rule else "unknown"
+    REQUESTS_IN_FLIGHT.inc(g.route)
+
+
+@app.after_request
+def record_status(response):
+    g.status = response.status_code
+    return response
+
+
+@app.teardown_request
+def finish_request(exc):
+    # This runs even if the request raised an exception, in which case
+    # after_request() isn't called and the response is a 500.
+    route = getattr(g, "route", None)
+    if route is None:
+        return
+    REQUESTS_IN_FLIGHT.dec(route)
+    REQUEST_SECONDS.observe(time.time() - g.start_time, route)
+    REQUESTS.inc(route, str(getattr(g, "status", 500)))
+
 @app.route('/Plugin.Activate', methods=['POST'])
 def activate():
     return jsonify({"Implements": ["NetworkDriver"]})
@@ -127,16 +200,35 @@ def create_endpoint():
     # the earlier phases.
 
     # First up is IP assignment. By default we assign both IPv4 and IPv6
-    # addresses.
-    # IPv4 failures may abort the request if the address couldn't be assigned.
-    ipv4_and_gateway(ep)
-    # IPv6 is currently best effort and won't abort the request.
-    ipv6_and_gateway(ep)
+    # addresses, in parallel.  IPv6 is currently best effort, but if the IPv4
+    # address can't be assigned both are backed out and the request aborted.
+    try:
+        with PHASE_SECONDS.time("ip_assignment"):
+            allocation = client.allocate_dual_stack(hostname, ep_id,
+                                                    reserves=ip_reserves)
+    except KeyError as e:
+        # The host's IPv4 address isn't configured.
+        app.logger.exception(e)
+        abort(500)
+
+    if allocation is None:
+        app.logger.error("Failed to allocate IPv4 for endpoint %s", ep_id)
+        abort(500)
+
+    app.logger.info("Assigned IPv4 %s", allocation.ipv4)
+    ep.ipv4_nets.add(IPNetwork(allocation.ipv4))
+    ep.ipv4_gateway = allocation.ipv4_gateway
+    if allocation.ipv6 is not None:
+        ep.ipv6_nets.add(IPNetwork(allocation.ipv6))
+        ep.ipv6_gateway = allocation.ipv6_gateway
+    else:
+        app.logger.info("No IPv6 address assigned for endpoint %s", ep_id)
 
     # Next, create the veth.
     try:
-        create_veth(ep)
-    except CalledProcessError as e:
+        with PHASE_SECONDS.time("veth_creation"):
+            create_veth(ep)
+    except (CalledProcessError, netns.NamespaceError) as e:
         # Failed to create or configure the veth.
         # Back out the IP assignments and the veth creation.
         app.logger.exception(e)
@@ -146,7 +238,8 @@ def create_endpoint():
 
     # Finally, write the endpoint to the datastore.
     try:
-        client.set_endpoint(ep)
+        with PHASE_SECONDS.time("endpoint_write"):
+            index = client.set_endpoint(ep)
     except DataStoreError as e:
         # We've failed to write the endpoint to the datastore.
         # Back out the IP assignments and the veth creation.
@@ -155,6 +248,8 @@ def create_endpoint():
         remove_veth(ep)
         abort(500)
 
+    endpoint_cache.put(ep, index)
+
     # Everything worked, create the JSON and return it to libnetwork.
     assert len(ep.ipv4_nets) == 1
     assert len(ep.ipv6_nets) <= 1
@@ -173,34 +268,77 @@ def delete_endpoint():
     json_data = request.get_json(force=True)
     ep_id = json_data["EndpointID"]
     app.logger.info("Removing endpoint %s", ep_id)
+    endpoint_cache.invalidate(hostname, "docker", CONTAINER_NAME, ep_id)
 
-    # Remove the endpoint from the datastore, the IPs that were assigned to
-    # it and the veth. Even if one fails, try to do the others.
+    # The endpoint is torn down in the background, so that Docker isn't kept
+    # waiting.  Once it's in the journal, it will be torn down even if we
+    # restart.
+    teardowns.record(ep_id, {"stage": STAGE_RELEASE_IPS})
+
+    return jsonify({})
+
+
+def teardown_endpoint(ep_id, teardown):
+    """
+    Tear down an endpoint from the teardown journal: release the IPs that were
+    assigned to it, remove it from the datastore and remove its veth.
+    :param ep_id: The endpoint ID.
+    :param teardown: The journal entry, a dict of the "stage" reached.
+    :return: True if the teardown is finished, False if it should be retried
+    because the datastore couldn't be reached.
+    """
     ep = None
     try:
-        ep = client.get_endpoint(hostname=hostname,
-                                 orchestrator_id="docker",
-                                 workload_id=CONTAINER_NAME,
-                                 endpoint_id=ep_id)
-        backout_ip_assignments(ep)
-    except (KeyError, DataStoreError) as e:
-        app.logger.exception(e)
-        app.logger.warning("Failed to unassign IPs for endpoint %s", ep_id)
+        with PHASE_SECONDS.time("endpoint_read"):
+            ep = client.get_endpoint(hostname=hostname,
+                                     orchestrator_id="docker",
+                                     workload_id=CONTAINER_NAME,
+                                     endpoint_id=ep_id)
+    except KeyError:
+        # Already removed from the datastore.
+        app.logger.warning("Endpoint %s not found", ep_id)
+    except DataStoreError as e:
+        app.logger.warning("Failed to read endpoint %s: %s", ep_id, e)
+        return False
+
+    if teardown["stage"] == STAGE_RELEASE_IPS:
+        # Record that we've moved on before releasing the IPs, so that they
+        # can't be released twice, even if we restart.
+        teardown["stage"] = STAGE_REMOVE_ENDPOINT
+        teardowns.update(ep_id, teardown)
+        try:
+            with PHASE_SECONDS.time("ip_release"):
+                if ep:
+                    backout_ip_assignments(ep)
+                else:
+                    # The endpoint has gone, but its IPs are still recorded
+                    # under its allocation handle.
+                    client.release_by_handle(ep_id)
+        except (KeyError, DataStoreError) as e:
+            app.logger.exception(e)
+            app.logger.warning("Failed to unassign IPs for endpoint %s", ep_id)
 
     if ep:
         try:
-            client.remove_endpoint(ep)
+            with PHASE_SECONDS.time("endpoint_remove"):
+                client.remove_endpoint(ep)
         except DataStoreError as e:
-            app.logger.exception(e)
-            app.logger.warning("Failed to remove endpoint %s from datastore",
-                               ep_id)
+            app.logger.warning("Failed to remove endpoint %s from "
+                               "datastore: %s", ep_id, e)
+            return False
 
     # libnetwork expects us to delete the veth pair.  (Note that we only need
-    # to delete one end).
-    if ep:
+    # to delete one end).  Its name only depends on the endpoint ID, so we can
+    # remove it even if the endpoint has gone from the datastore.
+    if not ep:
+        ep = Endpoint(hostname, "docker", CONTAINER_NAME, ep_id, "active",
+                      FIXED_MAC)
+    with PHASE_SECONDS.time("veth_removal"):
         remove_veth(ep)
+    return True
 
-    return jsonify({})
+
+teardowns = Journal(TEARDOWN_DIR, teardown_endpoint)
 
 
 @app.route('/NetworkDriver.EndpointOperInfo', methods=['POST'])
@@ -219,10 +357,9 @@ def join():
     ep_id = json_data["EndpointID"]
     app.logger.info("Joining endpoint %s", ep_id)
 
-    ep = client.get_endpoint(hostname=hostname,
-                             orchestrator_id="docker",
-                             workload_id=CONTAINER_NAME,
-                             endpoint_id=ep_id)
+    with PHASE_SECONDS.time("endpoint_read"):
+        ep = endpoint_cache.get_endpoint(hostname, "docker", CONTAINER_NAME,
+                                         ep_id)
     ret_json = {
         "InterfaceNames": [{
             "SrcName": ep.temp_interface_name(),
@@ -259,90 +396,77 @@ def leave():
     return jsonify({})
 
 
-def assign_ip(version):
+@app.route('/stats', methods=['GET'])
+def stats():
     """
-    Assign a IP address from the configured pools.
-    :param version: "v4" for IPv4, "v6" for IPv6.
-    :return: An IPAddress, or None if an IP couldn't be
-             assigned
+    Report the statistics of the datastore calls that the plugin has made,
+    as returned by datastore_stats.get_stats().  calicoctl diags saves them.
     """
-    ip = None
+    return jsonify(datastore_stats.get_stats())
 
-    assert version in ["v4", "v6"]
-    # For each configured pool, attempt to assign an IP before giving up.
-    for pool in client.get_ip_pools(version):
-        assigner = SequentialAssignment()
-        ip = assigner.allocate(pool)
-        if ip is not None:
-            ip = IPAddress(ip)
-            break
-    return ip
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Report the plugin's metrics in the Prometheus text format.
+    """
+    return Response(format_metrics(METRICS), content_type=CONTENT_TYPE)
 
 
 def unassign_ip(ip):
     """
-    Unassign a IP address from the configured pools.
+    Unassign a IP address from the configured pools, or return it to the
+    host's reserve if the reserve isn't full.  Only used for endpoints that
+    were created without an allocation handle.
     :param ip: IPAddress to unassign.
     :return: True if the unassignment succeeded. False otherwise.
     """
-    # For each configured pool, attempt to unassign the IP before giving up.
-    version = "v%d" % ip.version
-    for pool in client.get_ip_pools(version):
-        if ip in pool:
-            if client.unassign_address(pool, ip):
-                return True
-    return False
-
-
-def ipv4_and_gateway(ep):
-    # Get the gateway before trying to assign an address. This will avoid
-    # needing to backout the assignment if fetching the gateway fails.
-    try:
-        next_hop = client.get_default_next_hops(hostname)[4]
-    except KeyError as e:
-        app.logger.exception(e)
-        abort(500)
-
-    ip = assign_ip("v4")
-    app.logger.info("Assigned IPv4 %s", ip)
-
-    if not ip:
-        app.logger.error("Failed to allocate IPv4 for endpoint %s",
-                         ep.endpoint_id)
-        abort(500)
+    pool = client.get_ip_pool_set("v%d" % ip.version).get_pool(ip)
+    if pool is None:
+        return False
+    return release_ip(pool.cidr, ip)
 
-    ip = IPNetwork(ip)
-    ep.ipv4_nets.add(ip)
-    ep.ipv4_gateway = next_hop
 
-
-def ipv6_and_gateway(ep):
-    try:
-        next_hop6 = client.get_default_next_hops(hostname)[6]
-    except KeyError:
-        app.logger.info("Couldn't find IPv6 gateway for endpoint %s. "
-                        "Skipping IPv6 assignment.",
-                        ep.endpoint_id)
-    else:
-        ip6 = assign_ip("v6")
-        if ip6:
-            ip6 = IPNetwork(ip6)
-            ep.ipv6_gateway = next_hop6
-            ep.ipv6_nets.add(ip6)
-        else:
-            app.logger.info("Failed to allocate IPv6 address for endpoint %s",
-                            ep.endpoint_id)
+def release_ip(pool, ip):
+    """
+    Return an IP address to the host's reserve if the reserve isn't full, or
+    unassign it.
+    :param pool: IPNetwork of the pool that the IP is in.
+    :param ip: IPAddress to release.
+    :return: True if the release succeeded. False otherwise.
+    """
+    if ip_reserves["v%d" % ip.version].put(ip, pool):
+        return True
+    return client.unassign_address(pool, ip)
 
 
 def backout_ip_assignments(ep):
-    for net in ep.ipv4_nets.union(ep.ipv6_nets):
+    # The endpoint's allocation handle lists its IPs and their pools, so the
+    # pools don't need to be read.
+    assignments = client.get_handle(ep.endpoint_id)
+    if not assignments:
+        # The endpoint was created before allocation handles were recorded.
+        for net in ep.ipv4_nets.union(ep.ipv6_nets):
+            # The unassignment is best effort. Just log if it fails.
+            if not unassign_ip(net.ip):
+                app.logger.warn("Failed to unassign IP %s", net.ip)
+        return
+
+    for pool, ip in assignments:
         # The unassignment is best effort. Just log if it fails.
-        if not unassign_ip(net.ip):
-            app.logger.warn("Failed to unassign IP %s", net.ip)
+        if not release_ip(pool, ip):
+            app.logger.warn("Failed to unassign IP %s", ip)
+    client.remove_handle(ep.endpoint_id)
 
 
 def create_veth(ep):
+    if netns.NETLINK_AVAILABLE:
+        netns.create_veth(ep.name, ep.temp_interface_name(),
+                          peer_mac=FIXED_MAC)
+        return
+
     # Create the veth
+    SUBPROCESSES.inc("ip link add")
     check_call(['ip', 'link',
                 'add', ep.name,
                 'type', 'veth',
@@ -350,10 +474,12 @@ def create_veth(ep):
                timeout=IP_CMD_TIMEOUT)
 
     # Set the host end of the veth to 'up' so felix notices it.
+    SUBPROCESSES.inc("ip link set")
     check_call(['ip', 'link', 'set', ep.name, 'up'],
                timeout=IP_CMD_TIMEOUT)
 
     # Set the mac as libnetwork doesn't do this for us.
+    SUBPROCESSES.inc("ip link set")
     check_call(['ip', 'link', 'set',
                 'dev', ep.temp_interface_name(),
                 'address', FIXED_MAC],
@@ -362,11 +488,45 @@ def create_veth(ep):
 
 def remove_veth(ep):
     # The veth removal is best effort. If it fails then just log.
+    SUBPROCESSES.inc("ip link del")
     rc = call(['ip', 'link', 'del', ep.name], timeout=IP_CMD_TIMEOUT)
     if rc != 0:
         app.logger.warn("Failed to delete veth %s", ep.name)
 
 
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port):
+    """
+    Serve /metrics on a TCP port, from a background thread.
+    :param port: The port to listen on, on all addresses.
+    :return: The server.
+    """
+    def metrics_app(environ, start_response):
+        if environ.get("PATH_INFO") != "/metrics":
+            start_response("404 Not Found", [("Content-Type", "text/plain")])
+            return ["Not found\n"]
+        start_response("200 OK", [("Content-Type", CONTENT_TYPE)])
+        return [format_metrics(METRICS)]
+
+    server = make_server("", port, metrics_app, handler_class=_QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics")
+    thread.daemon = True
+    thread.start()
+    app.logger.info("Serving metrics on port %d", port)
+    return server
+
+
+if METRICS_PORT:
+    start_metrics_server(int(METRICS_PORT))
+
+# Finish any teardowns that were in progress when we last stopped.
+teardowns.recover()
+
+
 if __name__ == '__main__':
     # Used when being invoked by the flask development server
     PLUGIN_DIR = "/usr/share/docker/plugins/"
@@ -14,18 +14,27 @@
 
 import json
 import os
+import threading
+from collections import deque
+
 import etcd
-from etcd import EtcdKeyNotFound, EtcdException
+from etcd import EtcdKeyNotFound, EtcdAlreadyExist, EtcdException
 
 from netaddr import IPNetwork, IPAddress, AddrFormatError
 
+from pycalico import datastore_stats
+from pycalico.datastore_cache import CachingEtcdClient
+from pycalico.datastore_cluster import ClusterEtcdClient
 from pycalico.datastore_datatypes import Rules, BGPPeer, IPPool, \
-    Endpoint, Profile, Rule
-from pycalico.datastore_errors import DataStoreError, \
+    IPPoolSet, Endpoint, Profile, Rule
+from pycalico.datastore_errors import DataStoreError, BatchWriteError, \
     ProfileNotInEndpoint, ProfileAlreadyInEndpoint, MultipleEndpointsMatch
 
 ETCD_AUTHORITY_DEFAULT = "127.0.0.1:4001"
 ETCD_AUTHORITY_ENV = "ETCD_AUTHORITY"
+ETCD_QUORUM_READS_ENV = "ETCD_QUORUM_READS"
+"""Set to "false" to let reads from a cluster of etcd members be answered by
+any member without agreement from the cluster."""
 
 # etcd paths for Calico
 CALICO_V_PATH = "/calico/v1"
@@ -49,6 +58,13 @@ BGP_NODE_DEF_AS_PATH = CONFIG_PATH + "bgp_as"
 BGP_NODE_MESH_PATH = CONFIG_PATH + "bgp_node_mesh"
 HOST_BGP_PEERS_PATH = HOST_PATH + "bgp_peer_%(version)s/"
 HOST_BGP_PEER_PATH = HOST_PATH + "bgp_peer_%(version)s/%(peer_ip)s"
+ENDPOINT_INDEX_PATH = CALICO_V_PATH + "/index/endpoint/"
+ENDPOINT_INDEX_KEY = ENDPOINT_INDEX_PATH + "%(endpoint_id)s"
+WORKLOAD_INDEX_PATH = CALICO_V_PATH + "/index/workload/%(workload_id)s/"
+WORKLOAD_INDEX_KEY = WORKLOAD_INDEX_PATH + "%(endpoint_id)s"
+PROFILES_INDEX_PATH = CALICO_V_PATH + "/index/profile/"
+PROFILE_INDEX_PATH = PROFILES_INDEX_PATH + "%(profile_id)s/"
+PROFILE_INDEX_KEY = PROFILE_INDEX_PATH + "%(endpoint_id)s"
 
 IF_PREFIX = "cali"
 """
@@ -59,34 +75,137 @@ cali123456789ab.
 # The default node AS number
 DEFAULT_AS_NUM = 64511
 
+WRITE_BATCH_THREADS = 8
+"""The number of writes to etcd that a batch of writes makes at once."""
+
 
 def handle_errors(fn):
     """
     Decorator function to decorate Datastore API methods to handle common
-    exception types and re-raise as datastore specific errors.
+    exception types and re-raise as datastore specific errors.  The
+    statistics of each call are recorded in pycalico.datastore_stats.
     :param fn: The function to decorate.
     :return: The decorated function.
     """
-    def wrapped(*args, **kwargs):
+    def call(*args, **kwargs):
         try:
             return fn(*args, **kwargs)
         except EtcdException as e:
             # Don't leak out etcd exceptions.
             raise DataStoreError("%s: Error accessing etcd (%s).  Is etcd "
                                  "running?" % (fn.__name__, e.message))
+
+    def wrapped(*args, **kwargs):
+        return datastore_stats.timed(fn.__name__, call, *args, **kwargs)
     return wrapped
 
 
+def parse_etcd_authority(etcd_authority):
+    """
+    Parse the value of ETCD_AUTHORITY, which is the host:port of an etcd
+    member, or a comma-separated list of them for a cluster.
+
+    :param etcd_authority: The value to parse.
+    :return: List of (host, port) tuples, one for each member.
+    """
+    members = []
+    for authority in etcd_authority.split(","):
+        (host, port) = authority.strip().split(":", 1)
+        members.append((host, int(port)))
+    return members
+
+
+def _run_concurrently(calls):
+    """
+    Make a batch of independent calls (typically datastore writes) from up to
+    WRITE_BATCH_THREADS threads at once, so that the batch takes about as long
+    as its slowest call rather than the sum of them.
+
+    :param calls: List of (function, args) tuples.
+    :return: List of the results of the calls, in the same order.  Errors are
+    raised once all of the calls have finished: if one call failed, its
+    exception is raised as is; if more than one failed, a BatchWriteError
+    holding all of their exceptions is raised.
+    """
+    if len(calls) == 1:
+        function, args = calls[0]
+        return [function(*args)]
+
+    results = [None] * len(calls)
+    errors = []
+    counts = []
+    pending = deque(enumerate(calls))
+
+    def worker():
+        while True:
+            try:
+                index, (function, args) = pending.popleft()
+            except IndexError:
+                counts.append(datastore_stats.thread_counts())
+                return
+            try:
+                results[index] = function(*args)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(len(calls), WRITE_BATCH_THREADS))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Count the requests made by the threads as made by this one.
+    for requests, cas_failures in counts:
+        datastore_stats.add_thread_counts(requests, cas_failures)
+    if len(errors) == 1:
+        raise errors[0]
+    elif errors:
+        raise BatchWriteError(errors)
+    return results
+
+
 class DatastoreClient(object):
     """
     An datastore client that exposes high level Calico operations needed by the
     calico CLI.
     """
 
-    def __init__(self):
+    def __init__(self, cached=False, max_connections=None):
+        """
+        Constructor.
+        :param cached: If True, serve reads from an in-memory copy of the
+        Calico data that is kept up to date by watching etcd.  Writes still go
+        straight to etcd.  This is intended for long-lived processes, such as
+        the libnetwork plugin.
+        :param max_connections: The number of connections to etcd to keep open
+        for reuse.  Set this to the number of threads that share the client.
+        At least WRITE_BATCH_THREADS connections are kept, so that the writes
+        the client makes at once reuse them.
+        """
         etcd_authority = os.getenv(ETCD_AUTHORITY_ENV, ETCD_AUTHORITY_DEFAULT)
-        (host, port) = etcd_authority.split(":", 1)
-        self.etcd_client = etcd.Client(host=host, port=int(port))
+        members = parse_etcd_authority(etcd_authority)
+        if len(members) == 1:
+            (host, port) = members[0]
+            self.etcd_client = etcd.Client(host=host, port=port)
+            datastore_stats.count_etcd_requests(self.etcd_client)
+        else:
+            quorum_reads = os.getenv(ETCD_QUORUM_READS_ENV,
+                                     "true").lower() != "false"
+            self.etcd_client = ClusterEtcdClient(members, quorum_reads)
+            for member in self.etcd_client.members:
+                datastore_stats.count_etcd_requests(member)
+        # The connection pool for etcd is created on first use, so this
+        # applies to every request the client makes.
+        self.etcd_client.http.connection_pool_kw["maxsize"] = \
+            max(max_connections or 0, WRITE_BATCH_THREADS)
+        if cached:
+            self.etcd_client = CachingEtcdClient(self.etcd_client,
+                                                 CALICO_V_PATH)
+
+        self._ip_pool_sets = {}
+        """The last IPPoolSet built by get_ip_pool_set() for each IP version,
+        with the keys and indexes of the pools it was built from."""
 
     @handle_errors
     def ensure_global_config(self):
@@ -95,14 +214,18 @@ class DatastoreClient(object):
         defaults if they don't.
         :return: None.
         """
-        try:
-            self.etcd_client.read(CONFIG_IF_PREF_PATH)
-        except EtcdKeyNotFound:
-            # Didn't exist, create it now.
-            self.etcd_client.write(CONFIG_IF_PREF_PATH, IF_PREFIX)
+        def write_if_prefix():
+            try:
+                # Only create the prefix if it doesn't already exist.
+                self.etcd_client.write(CONFIG_IF_PREF_PATH, IF_PREFIX,
+                                       prevExist=False)
+            except EtcdAlreadyExist:
+                pass
 
         # We are always ready.
-        self.etcd_client.write(CALICO_V_PATH + "/Ready", "true")
+        _run_concurrently([
+            (write_if_prefix, ()),
+            (self.etcd_client.write, (CALICO_V_PATH + "/Ready", "true"))])
 
     @handle_errors
     def create_host(self, hostname, bird_ip, bird6_ip, as_num):
@@ -118,29 +241,32 @@ class DatastoreClient(object):
         """
         host_path = HOST_PATH % {"hostname": hostname}
 
-        # Set up the host
-        self.etcd_client.write(host_path + "bird_ip", bird_ip)
-        self.etcd_client.write(host_path + "bird6_ip", bird6_ip)
-        workload_dir = host_path + "workload"
-        try:
-            self.etcd_client.read(workload_dir)
-        except EtcdKeyNotFound:
-            # Didn't exist, create it now.
-            self.etcd_client.write(workload_dir, None, dir=True)
+        def create_workload_dir():
+            try:
+                self.etcd_client.write(host_path + "workload", None,
+                                       dir=True, prevExist=False)
+            except EtcdAlreadyExist:
+                pass
+
+        # Set up the host.  None of these keys depend on each other, so
+        # write them all at once.
+        writes = [(self.etcd_client.write, (host_path + "bird_ip", bird_ip)),
+                  (self.etcd_client.write, (host_path + "bird6_ip", bird6_ip)),
+                  (create_workload_dir, ())]
 
         # Set or delete the node specific BGP AS number as required.  If the
         # value is missing from the etcd datastore, the BIRD templates will
         # inherit the configured global default value (and then the
         # hardcoded default value).
         if as_num is None:
-            try:
-                self.etcd_client.delete(host_path + "bgp_as")
-            except EtcdKeyNotFound:
-                pass
+            writes.append((self._delete_if_exists, (host_path + "bgp_as",)))
         else:
-            self.etcd_client.write(host_path + "bgp_as", as_num)
+            writes.append((self.etcd_client.write,
+                           (host_path + "bgp_as", as_num)))
+        _run_concurrently(writes)
 
-        # Flag to Felix that the host is created.
+        # Flag to Felix that the host is created.  This is written last so
+        # that the rest of the host's config is in place when Felix sees it.
         self.etcd_client.write(host_path + "config/marker", "created")
 
         return
@@ -158,6 +284,26 @@ class DatastoreClient(object):
         except EtcdKeyNotFound:
             pass
 
+    @handle_errors
+    def get_hostnames(self):
+        """
+        Get the names of the Calico hosts.
+        :return: Set of hostnames.
+        """
+        try:
+            nodes = self.etcd_client.read(HOSTS_PATH).children
+        except EtcdKeyNotFound:
+            return set()
+
+        # If there are no hosts etcd returns the hosts directory itself, which
+        # has a shorter key.
+        hostnames = set()
+        for node in nodes:
+            packed = node.key.split("/")
+            if len(packed) > 4:
+                hostnames.add(packed[4])
+        return hostnames
+
     @handle_errors
     def get_host_ips(self, hostname):
         """
@@ -184,21 +330,46 @@ class DatastoreClient(object):
         :param version: "v4" for IPv4, "v6" for IPv6
         :return: List of IPPool.
         """
+        return [IPPool.from_json(leaf.value)
+                for leaf in self._read_ip_pool_leaves(version)]
+
+    @handle_errors
+    def get_ip_pool_set(self, version):
+        """
+        Get the configured IP pools as an IPPoolSet, for finding the pool that
+        an address is in.  The set is only rebuilt if the pools have changed
+        since the last call.
+
+        :param version: "v4" for IPv4, "v6" for IPv6
+        :return: IPPoolSet.
+        """
+        leaves = self._read_ip_pool_leaves(version)
+        indexes = [(leaf.key, leaf.modifiedIndex) for leaf in leaves]
+        last_indexes, pool_set = self._ip_pool_sets.get(version, (None, None))
+        if indexes != last_indexes:
+            pool_set = IPPoolSet(IPPool.from_json(leaf.value)
+                                 for leaf in leaves)
+            self._ip_pool_sets[version] = (indexes, pool_set)
+        return pool_set
+
+    def _read_ip_pool_leaves(self, version):
+        """
+        Read the configured IP pools.
+
+        :param version: "v4" for IPv4, "v6" for IPv6
+        :return: List of the etcd results for the pools.
+        """
         assert version in ("v4", "v6")
         pool_path = IP_POOLS_PATH % {"version": version}
         try:
             leaves = self.etcd_client.read(pool_path, recursive=True).leaves
         except EtcdKeyNotFound:
             # Path doesn't exist.
-            pools = []
-        else:
-            # Convert the leaf values to IPPools.  We need to handle an empty
-            # leaf value because when no pools are configured the recursive
-            # read returns the parent directory.
-            pools = [IPPool.from_json(leaf.value) for leaf in leaves
-                                                  if leaf.value]
+            return []
 
-        return pools
+        # We need to handle an empty leaf value because when no pools are
+        # configured the recursive read returns the parent directory.
+        return [leaf for leaf in leaves if leaf.value]
 
     @handle_errors
     def get_ip_pool_config(self, version, cidr):
@@ -380,7 +551,6 @@ class DatastoreClient(object):
         :return: nothing.
         """
         profile_path = PROFILE_PATH % {"profile_id": name}
-        self.etcd_client.write(profile_path + "tags", '["%s"]' % name)
 
         # Accept inbound traffic from self, allow outbound traffic to anywhere.
         # Note: We do not need to add a default_deny to outbound packet traffic
@@ -392,7 +562,10 @@ class DatastoreClient(object):
         rules = Rules(id=name,
                       inbound_rules=[accept_self],
                       outbound_rules=[default_allow])
-        self.etcd_client.write(profile_path + "rules", rules.to_json())
+        _run_concurrently([
+            (self.etcd_client.write, (profile_path + "tags", '["%s"]' % name)),
+            (self.etcd_client.write, (profile_path + "rules",
+                                      rules.to_json()))])
 
     @handle_errors
     def remove_profile(self, name):
@@ -471,8 +644,59 @@ class DatastoreClient(object):
         :param profile_name: Unique string name of the profile.
         :return: a list of Endpoint objects.
         """
-        return [endpoint for endpoint in self.get_endpoints()
-                if profile_name in endpoint.profile_ids]
+        index_path = PROFILE_INDEX_PATH % {"profile_id": profile_name}
+        try:
+            ep_paths = [child.value for child in
+                        self.etcd_client.read(index_path).children
+                        if not child.dir]
+        except EtcdKeyNotFound:
+            return []
+
+        # The index may briefly list an endpoint that is no longer in the
+        # profile, so check each endpoint's profiles.
+        members = []
+        for ep_path in ep_paths:
+            endpoint = self._read_endpoint(ep_path)
+            if endpoint and profile_name in endpoint.profile_ids:
+                members.append(endpoint)
+        return members
+
+    @handle_errors
+    def get_all_profile_members(self):
+        """
+        Get the endpoint members of every profile, with a single read of the
+        profile index.
+
+        :return: a dict of profile name to a list of Endpoint objects.  Only
+        profiles with members are included.
+        """
+        try:
+            leaves = self.etcd_client.read(PROFILES_INDEX_PATH,
+                                           recursive=True).leaves
+        except EtcdKeyNotFound:
+            return {}
+
+        profile_paths = {}
+        for leaf in leaves:
+            packed = leaf.key.split("/")
+            if not leaf.dir and len(packed) > 6:
+                profile_paths.setdefault(packed[5], []).append(leaf.value)
+
+        # Read each endpoint once, even if it is in several profiles.
+        endpoints = {}
+        for paths in profile_paths.itervalues():
+            for ep_path in paths:
+                if ep_path not in endpoints:
+                    endpoints[ep_path] = self._read_endpoint(ep_path)
+
+        members = {}
+        for profile_name, paths in profile_paths.iteritems():
+            profile_members = [endpoints[ep_path] for ep_path in paths
+                               if endpoints[ep_path] and profile_name in
+                               endpoints[ep_path].profile_ids]
+            if profile_members:
+                members[profile_name] = profile_members
+        return members
 
     @handle_errors
     def profile_update_tags(self, profile):
@@ -581,6 +805,40 @@ class DatastoreClient(object):
         :return: A list of Endpoint Objects which match the criteria, or an
         empty list if none match
         """
+        # Without a hostname we'd have to search every host, so use the
+        # endpoint or workload index if we can.
+        if not hostname and (endpoint_id or workload_id):
+            endpoints = self._get_indexed_endpoints(workload_id, endpoint_id)
+            if endpoints is not None:
+                return [endpoint for endpoint in endpoints
+                        if endpoint.matches(hostname=hostname,
+                                            orchestrator_id=orchestrator_id,
+                                            workload_id=workload_id,
+                                            endpoint_id=endpoint_id)]
+
+        return list(self.iter_endpoints(hostname=hostname,
+                                        orchestrator_id=orchestrator_id,
+                                        workload_id=workload_id,
+                                        endpoint_id=endpoint_id))
+
+    @handle_errors
+    def iter_endpoints(self, hostname=None, orchestrator_id=None,
+                       workload_id=None, endpoint_id=None):
+        """
+        Get the endpoints matching the criteria by searching the datastore,
+        without using the endpoint index.
+
+        The endpoints are returned one at a time as the results of the search
+        are parsed, and the endpoint JSON is only parsed for keys that match
+        the criteria.  Use this rather than get_endpoints to process a large
+        number of endpoints.
+
+        :param hostname: The hostname that the endpoint lives on.
+        :param orchestrator_id: The orchestrator that the endpoint belongs to.
+        :param workload_id: The workload that the endpoint belongs to.
+        :param endpoint_id: The ID of the endpoint
+        :return: An iterator of the matching Endpoint objects.
+        """
         # First build the query string as specific as possible. Note, we want
         # the query to be as specific as possible, so we proceed any variables
         # with known constants e.g. we add '/workload' after the hostname
@@ -605,20 +863,189 @@ class DatastoreClient(object):
             # Search etcd
             leaves = self.etcd_client.read(ep_path, recursive=True).leaves
         except EtcdKeyNotFound:
-            return []
+            return iter([])
+
+        criteria = {"hostname": hostname,
+                    "orchestrator_id": orchestrator_id,
+                    "workload_id": workload_id,
+                    "endpoint_id": endpoint_id}
+        return self._iter_matching_endpoints(leaves, criteria)
+
+    def _iter_matching_endpoints(self, leaves, criteria):
+        """
+        Parse the endpoints whose keys match the search criteria.
 
-        # Filter through result
-        matches = []
+        :param leaves: The leaves from a recursive read.
+        :param criteria: Dict of endpoint key component name to the value it
+        must have, or None to match any value.
+        :return: A generator of Endpoint objects.
+        """
         for leaf in leaves:
-            endpoint = Endpoint.from_json(leaf.key, leaf.value)
+            # Compare the key to the search criteria before parsing the JSON.
+            match = Endpoint.ENDPOINT_KEY_MATCH.match(leaf.key)
+            if not match:
+                continue
+            if all(not value or match.group(name) == value
+                   for name, value in criteria.iteritems()):
+                yield Endpoint.from_json(leaf.key, leaf.value)
+
+    def _get_indexed_endpoints(self, workload_id, endpoint_id):
+        """
+        Look up endpoints by endpoint ID, or failing that workload ID, using
+        the endpoint index.
+
+        :param workload_id: The workload ID, or None.
+        :param endpoint_id: The endpoint ID, or None.
+        :return: A list of Endpoint objects, or None if the index has no
+        entries for the endpoint or workload, in which case the caller should
+        search for the endpoint.
+        """
+        try:
+            if endpoint_id:
+                index_key = ENDPOINT_INDEX_KEY % {"endpoint_id": endpoint_id}
+                ep_paths = [self.etcd_client.read(index_key).value]
+            else:
+                index_path = WORKLOAD_INDEX_PATH % {"workload_id": workload_id}
+                ep_paths = [child.value for child in
+                            self.etcd_client.read(index_path).children
+                            if not child.dir]
+        except EtcdKeyNotFound:
+            return None
+
+        endpoints = []
+        for ep_path in ep_paths:
+            endpoint = self._read_endpoint(ep_path)
+            if endpoint:
+                endpoints.append(endpoint)
+        return endpoints or None
+
+    def _read_endpoint(self, ep_path):
+        """
+        Read the endpoint at a key found in one of the indexes.
 
-            # If its an endpoint, compare it to search criteria
-            if endpoint and endpoint.matches(hostname=hostname,
-                                             orchestrator_id=orchestrator_id,
-                                             workload_id=workload_id,
-                                             endpoint_id=endpoint_id):
-                matches.append(endpoint)
-        return matches
+        :param ep_path: The endpoint key.
+        :return: An Endpoint object, or None if there is no endpoint at the
+        key.
+        """
+        try:
+            result = self.etcd_client.read(ep_path)
+        except EtcdKeyNotFound:
+            # The endpoint was removed without updating the index.
+            return None
+        return Endpoint.from_json(result.key, result.value)
+
+    def _set_endpoint_index(self, endpoint, ep_path):
+        _run_concurrently([
+            (self.etcd_client.write,
+             (ENDPOINT_INDEX_KEY % {"endpoint_id": endpoint.endpoint_id},
+              ep_path)),
+            (self.etcd_client.write,
+             (WORKLOAD_INDEX_KEY % {"workload_id": endpoint.workload_id,
+                                    "endpoint_id": endpoint.endpoint_id},
+              ep_path))])
+
+    def _remove_endpoint_index(self, endpoint):
+        index_keys = [ENDPOINT_INDEX_KEY %
+                          {"endpoint_id": endpoint.endpoint_id},
+                      WORKLOAD_INDEX_KEY %
+                          {"workload_id": endpoint.workload_id,
+                           "endpoint_id": endpoint.endpoint_id}]
+        index_keys.extend(PROFILE_INDEX_KEY %
+                              {"profile_id": profile_id,
+                               "endpoint_id": endpoint.endpoint_id}
+                          for profile_id in endpoint.profile_ids)
+        _run_concurrently([(self._delete_if_exists, (index_key,))
+                           for index_key in index_keys])
+
+    def _add_profile_index(self, endpoint, ep_path, profile_ids):
+        _run_concurrently([(self.etcd_client.write,
+                            (PROFILE_INDEX_KEY %
+                             {"profile_id": profile_id,
+                              "endpoint_id": endpoint.endpoint_id},
+                             ep_path))
+                           for profile_id in profile_ids])
+
+    def _remove_profile_index(self, endpoint, profile_ids):
+        _run_concurrently([(self._delete_if_exists,
+                            (PROFILE_INDEX_KEY %
+                             {"profile_id": profile_id,
+                              "endpoint_id": endpoint.endpoint_id},))
+                           for profile_id in profile_ids])
+
+    def _delete_if_exists(self, key):
+        """
+        Delete a key, ignoring it if it doesn't exist.
+        """
+        try:
+            self.etcd_client.delete(key)
+        except EtcdKeyNotFound:
+            pass
+
+    def _stored_profile_ids(self, endpoint, ep_path):
+        """
+        Get the profiles the endpoint had when it was read from the
+        datastore.
+
+        :param endpoint: The Endpoint.
+        :param ep_path: The endpoint key.
+        :return: A list of profile IDs, empty if the endpoint wasn't read from
+        the datastore.
+        """
+        if not endpoint._original_json:
+            return []
+        return Endpoint.from_json(ep_path,
+                                  endpoint._original_json).profile_ids
+
+    @handle_errors
+    def check_endpoint_index(self, repair=False):
+        """
+        Check that the endpoint, workload and profile indexes match the
+        endpoints in the datastore, by reading every endpoint.
+
+        :param repair: If True, add missing index entries and remove ones
+        that are wrong.
+        :return: A tuple of (missing, stale), which are lists of the index
+        keys that are missing and those that don't match an endpoint.
+        """
+        expected = {}
+        for endpoint in self.iter_endpoints():
+            ep_path = ENDPOINT_PATH % {
+                            "hostname": endpoint.hostname,
+                            "orchestrator_id": endpoint.orchestrator_id,
+                            "workload_id": endpoint.workload_id,
+                            "endpoint_id": endpoint.endpoint_id}
+            expected[ENDPOINT_INDEX_KEY %
+                     {"endpoint_id": endpoint.endpoint_id}] = ep_path
+            expected[WORKLOAD_INDEX_KEY %
+                     {"workload_id": endpoint.workload_id,
+                      "endpoint_id": endpoint.endpoint_id}] = ep_path
+            for profile_id in endpoint.profile_ids:
+                expected[PROFILE_INDEX_KEY %
+                         {"profile_id": profile_id,
+                          "endpoint_id": endpoint.endpoint_id}] = ep_path
+
+        actual = {}
+        try:
+            index_leaves = self.etcd_client.read(CALICO_V_PATH + "/index/",
+                                                 recursive=True).leaves
+        except EtcdKeyNotFound:
+            index_leaves = []
+        for leaf in index_leaves:
+            if not leaf.dir:
+                actual[leaf.key] = leaf.value
+
+        missing = sorted(key for key, value in expected.iteritems()
+                         if actual.get(key) != value)
+        stale = sorted(key for key in actual if key not in expected)
+        if repair:
+            for key in missing:
+                self.etcd_client.write(key, expected[key])
+            for key in stale:
+                try:
+                    self.etcd_client.delete(key)
+                except EtcdKeyNotFound:
+                    pass
+        return missing, stale
 
     @handle_errors
     def get_endpoint(self, hostname=None, orchestrator_id=None,
@@ -657,14 +1084,51 @@ class DatastoreClient(object):
         Write a single endpoint object to the datastore.
 
         :param endpoint: The Endpoint to add to the workload.
+        :return: The etcd modifiedIndex of the endpoint.
         """
         ep_path = ENDPOINT_PATH % {"hostname": endpoint.hostname,
                                    "orchestrator_id": endpoint.orchestrator_id,
                                    "workload_id": endpoint.workload_id,
                                    "endpoint_id": endpoint.endpoint_id}
+        old_profile_ids = self._stored_profile_ids(endpoint, ep_path)
         new_json = endpoint.to_json()
-        self.etcd_client.write(ep_path, new_json)
+
+        # Add the endpoint to the index of each of its profiles before writing
+        # it, and remove it from the profiles it has left afterwards, so that
+        # the profile index never misses a member.  Readers check the profiles
+        # of each endpoint they find in the index, so an entry left behind by
+        # a failed write is harmless.
+        self._add_profile_index(endpoint, ep_path, endpoint.profile_ids)
+        result = self.etcd_client.write(ep_path, new_json)
         endpoint._original_json = new_json
+        self._set_endpoint_index(endpoint, ep_path)
+        self._remove_profile_index(endpoint,
+                                   [profile_id for profile_id in
+                                    old_profile_ids if profile_id not in
+                                    endpoint.profile_ids])
+        return result.modifiedIndex
+
+    @handle_errors
+    def get_endpoint_index(self, hostname, orchestrator_id, workload_id,
+                           endpoint_id):
+        """
+        Get the etcd modifiedIndex of an endpoint, without parsing it.  Used
+        to check whether a copy of the endpoint is still current.
+
+        :param hostname: The hostname that the endpoint lives on.
+        :param orchestrator_id: The orchestrator that the endpoint belongs to.
+        :param workload_id: The workload that the endpoint belongs to.
+        :param endpoint_id: The ID of the endpoint
+        :return: The modifiedIndex.
+        """
+        ep_path = ENDPOINT_PATH % {"hostname": hostname,
+                                   "orchestrator_id": orchestrator_id,
+                                   "workload_id": workload_id,
+                                   "endpoint_id": endpoint_id}
+        try:
+            return self.etcd_client.read(ep_path).modifiedIndex
+        except EtcdKeyNotFound:
+            raise KeyError("Endpoint %s not found" % endpoint_id)
 
     @handle_errors
     def update_endpoint(self, endpoint):
@@ -682,11 +1146,19 @@ class DatastoreClient(object):
                                    "orchestrator_id": endpoint.orchestrator_id,
                                    "workload_id": endpoint.workload_id,
                                    "endpoint_id": endpoint.endpoint_id}
+        old_profile_ids = self._stored_profile_ids(endpoint, ep_path)
         new_json = endpoint.to_json()
+
+        # Update the profile index as in set_endpoint.
+        self._add_profile_index(endpoint, ep_path, endpoint.profile_ids)
         self.etcd_client.write(ep_path,
                                new_json,
                                prevValue=endpoint._original_json)
         endpoint._original_json = new_json
+        self._remove_profile_index(endpoint,
+                                   [profile_id for profile_id in
+                                    old_profile_ids if profile_id not in
+                                    endpoint.profile_ids])
 
     @handle_errors
     def remove_endpoint(self, endpoint):
@@ -700,6 +1172,7 @@ class DatastoreClient(object):
                                    "workload_id": endpoint.workload_id,
                                    "endpoint_id": endpoint.endpoint_id}
         self.etcd_client.delete(ep_path, dir=True, recursive=True)
+        self._remove_endpoint_index(endpoint)
 
     @handle_errors
     def get_default_next_hops(self, hostname):
@@ -758,11 +1231,16 @@ class DatastoreClient(object):
         workload_path = WORKLOAD_PATH % {"hostname": hostname,
                                          "orchestrator_id": orchestrator_id,
                                          "workload_id": workload_id}
+        endpoints = self.get_endpoints(hostname=hostname,
+                                       orchestrator_id=orchestrator_id,
+                                       workload_id=workload_id)
         try:
             self.etcd_client.delete(workload_path, recursive=True, dir=True)
         except EtcdKeyNotFound:
             raise KeyError("%s is not a configured workload on host %s" %
                            (workload_id, hostname))
+        for endpoint in endpoints:
+            self._remove_endpoint_index(endpoint)
 
     @handle_errors
     def set_bgp_node_mesh(self, enable):
@@ -0,0 +1,364 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from etcd import EtcdResult, EtcdKeyNotFound, EtcdAlreadyExist, \
+    EtcdEventIndexCleared
+
+_log = logging.getLogger(__name__)
+
+WATCH_TIMEOUT = 10
+"""How long (seconds) each watch request waits for an event."""
+
+RETRY_DELAY = 1
+"""How long (seconds) to wait before retrying a failed watch."""
+
+DELETE_ACTIONS = ("delete", "expire", "compareAndDelete")
+
+
+def _normalize(key):
+    """
+    Normalize an etcd key so that directory keys with and without a trailing
+    slash are treated the same.
+    """
+    return "/" + key.strip("/")
+
+
+def _node_from_result(result):
+    """
+    Convert an EtcdResult into the node dictionary format used by etcd.
+    """
+    node = {"key": _normalize(result.key),
+            "modifiedIndex": result.modifiedIndex,
+            "createdIndex": result.createdIndex}
+    if result.dir:
+        node["dir"] = True
+    else:
+        node["value"] = result.value
+    return node
+
+
+class CachingEtcdClient(object):
+    """
+    A wrapper around an etcd.Client that serves reads of a subtree (by default
+    the whole Calico tree) from an in-memory copy.
+
+    The copy is primed with one recursive read and then kept up to date by a
+    background thread that watches etcd for changes.  Until the copy has been
+    primed, reads go straight to etcd.  Writes and deletes always go to etcd,
+    including any compare-and-swap conditions, and the result is applied to
+    the copy immediately so that callers see their own writes.  If a
+    conditional write fails, the key is re-read from etcd so that a retry
+    uses current data.
+    """
+
+    def __init__(self, etcd_client, root):
+        """
+        Constructor.
+        :param etcd_client: The etcd.Client to wrap.
+        :param root: The key of the subtree to cache.
+        """
+        self.etcd_client = etcd_client
+        self.root = _normalize(root)
+
+        self._lock = threading.RLock()
+        self._nodes = {}
+        self._children = defaultdict(set)
+
+        self._index = None
+        """The etcd index that the cache is up to date with, or None if the
+        cache has not been primed."""
+
+        self._tombstones = {}
+        """Deleted keys, mapped to the index of the delete.  Used to stop an
+        event or a write result older than the delete re-adding the key."""
+
+        self._updates_in_flight = defaultdict(int)
+        """The number of writes and refreshes waiting for etcd, by the index
+        the cache was at when they started.  Their results are newer than
+        that index, so tombstones for deletes at or before it can go."""
+
+        self._watcher = None
+
+    def start(self):
+        """
+        Start the background thread that primes the cache and keeps it up to
+        date.  This is idempotent.
+        """
+        with self._lock:
+            if self._watcher is None:
+                self._watcher = threading.Thread(target=self._watch_loop,
+                                                 name="etcd-cache")
+                self._watcher.daemon = True
+                self._watcher.start()
+
+    @property
+    def synced(self):
+        """True once the cache has been primed."""
+        return self._index is not None
+
+    def read(self, key, **kwargs):
+        """
+        Read a key, as etcd.Client.read().  Reads of keys outside the cached
+        subtree, and watches, are passed through to etcd.
+        """
+        self.start()
+        norm_key = _normalize(key)
+        if not kwargs.get("wait") and self._in_root(norm_key):
+            with self._lock:
+                if self._index is not None:
+                    if norm_key not in self._nodes:
+                        raise EtcdKeyNotFound("Key not found : %s" % norm_key)
+                    result = EtcdResult("get",
+                                        self._build_node(
+                                            norm_key,
+                                            kwargs.get("recursive", False)))
+                    result.etcd_index = self._index
+                    return result
+        return self.etcd_client.read(key, **kwargs)
+
+    def write(self, key, value, **kwargs):
+        """
+        Write a key to etcd, as etcd.Client.write().
+        """
+        started = self._start_update()
+        try:
+            try:
+                result = self.etcd_client.write(key, value, **kwargs)
+            except (ValueError, EtcdAlreadyExist, EtcdKeyNotFound):
+                # Compare failed, so our copy of this key is probably stale.
+                self._refresh(key)
+                raise
+            with self._lock:
+                self._apply_set(_node_from_result(result))
+        finally:
+            self._finish_update(started)
+        return result
+
+    def delete(self, key, **kwargs):
+        """
+        Delete a key from etcd, as etcd.Client.delete().
+        """
+        try:
+            result = self.etcd_client.delete(key, **kwargs)
+        except (ValueError, EtcdKeyNotFound):
+            self._refresh(key)
+            raise
+        with self._lock:
+            self._record_delete(_normalize(key), result.modifiedIndex)
+        return result
+
+    def _in_root(self, key):
+        return key == self.root or key.startswith(self.root + "/")
+
+    def _build_node(self, key, recursive, top=True):
+        node = dict(self._nodes[key])
+        if node.get("dir") and (top or recursive):
+            nodes = [self._build_node(child, recursive, top=False)
+                     for child in sorted(self._children[key])]
+            if nodes:
+                node["nodes"] = nodes
+        return node
+
+    def _refresh(self, key):
+        """
+        Re-read a single key from etcd and update the cache with it.
+        """
+        norm_key = _normalize(key)
+        if not self._in_root(norm_key):
+            return
+        started = self._start_update()
+        try:
+            result = self.etcd_client.read(key)
+        except EtcdKeyNotFound:
+            with self._lock:
+                self._apply_delete(norm_key)
+        except Exception:
+            _log.exception("Failed to refresh %s", key)
+        else:
+            if not result.dir:
+                with self._lock:
+                    self._apply_set(_node_from_result(result))
+        finally:
+            self._finish_update(started)
+
+    def _start_update(self):
+        """
+        Note that a write or refresh is about to be sent to etcd.
+
+        :return: The index to pass to _finish_update().
+        """
+        with self._lock:
+            started = self._index or 0
+            self._updates_in_flight[started] += 1
+            return started
+
+    def _finish_update(self, started):
+        """
+        Note that a write or refresh started by _start_update() has been
+        applied to the cache (or failed).
+        """
+        with self._lock:
+            self._updates_in_flight[started] -= 1
+            if not self._updates_in_flight[started]:
+                del self._updates_in_flight[started]
+            self._prune_tombstones()
+
+    def _record_delete(self, key, index):
+        """
+        Apply a delete to the cache, and remember it until nothing older than
+        it can arrive.  Must be called with the lock held.
+        """
+        self._tombstones[key] = max(self._tombstones.get(key, 0), index)
+        self._apply_delete(key, index)
+
+    def _prune_tombstones(self):
+        """
+        Forget the deletes that the watcher has caught up with, and that are
+        older than every write and refresh still waiting for etcd.  Must be
+        called with the lock held.
+        """
+        if self._index is None:
+            return
+        oldest = min(self._updates_in_flight or [self._index])
+        for tombstone, deleted_index in self._tombstones.items():
+            if deleted_index <= min(self._index, oldest):
+                del self._tombstones[tombstone]
+
+    def _apply_set(self, node):
+        """
+        Add or update a node in the cache, creating its parent directories.
+        Must be called with the lock held.
+        """
+        key = node["key"]
+        index = node["modifiedIndex"]
+        if not self._in_root(key):
+            return
+        for tombstone, deleted_index in self._tombstones.iteritems():
+            if index <= deleted_index and (key == tombstone or
+                                           key.startswith(tombstone + "/")):
+                return
+        existing = self._nodes.get(key)
+        if existing and existing["modifiedIndex"] > index:
+            return
+
+        # Make sure the parent directories exist.
+        child = key
+        while child != self.root:
+            parent = child.rsplit("/", 1)[0] or "/"
+            if parent not in self._nodes:
+                self._nodes[parent] = {"key": parent, "dir": True,
+                                       "modifiedIndex": index,
+                                       "createdIndex": index}
+            self._children[parent].add(child)
+            child = parent
+        self._nodes[key] = node
+
+    def _apply_delete(self, key, index=None):
+        """
+        Remove a node and everything beneath it from the cache.  Nodes written
+        after the delete, and the directories containing them, are kept.
+        Must be called with the lock held.
+
+        :param key: The normalized key that was deleted.
+        :param index: The index of the delete, or None to remove the nodes
+        whatever their index.
+        """
+        if self.root.startswith(key.rstrip("/") + "/"):
+            # Deleting a parent of the cached subtree deletes all of it.
+            key = self.root
+        for child in list(self._children.get(key, ())):
+            self._apply_delete(child, index)
+        node = self._nodes.get(key)
+        if self._children.get(key) or (node is not None and
+                                       index is not None and
+                                       node["modifiedIndex"] > index):
+            return
+        self._children.pop(key, None)
+        self._nodes.pop(key, None)
+        parent = key.rsplit("/", 1)[0] or "/"
+        self._children[parent].discard(key)
+
+    def _load(self):
+        """
+        Prime the cache with a recursive read of the whole subtree.
+        """
+        try:
+            result = self.etcd_client.read(self.root, recursive=True)
+        except EtcdKeyNotFound:
+            # Nothing to cache yet, but we still need the current index to
+            # start watching from.
+            result = None
+            index = self.etcd_client.read("/").etcd_index
+        else:
+            index = result.etcd_index
+
+        with self._lock:
+            self._nodes.clear()
+            self._children.clear()
+            self._tombstones.clear()
+            if result is not None:
+                self._apply_set(_node_from_result(result))
+                if result.dir:
+                    for node in result.get_subtree():
+                        self._apply_set(_node_from_result(node))
+            self._index = index
+        _log.info("Loaded %s into cache at index %s", self.root, index)
+
+    def _handle_event(self, result):
+        """
+        Apply an event returned by a watch to the cache.
+        """
+        with self._lock:
+            key = _normalize(result.key)
+            if result.action in DELETE_ACTIONS:
+                self._record_delete(key, result.modifiedIndex)
+            else:
+                self._apply_set(_node_from_result(result))
+            self._index = max(self._index, result.modifiedIndex)
+            self._prune_tombstones()
+
+    def _watch_loop(self):
+        while True:
+            try:
+                if self._index is None:
+                    self._load()
+                result = self.etcd_client.read(self.root,
+                                               recursive=True,
+                                               wait=True,
+                                               waitIndex=self._index + 1,
+                                               timeout=WATCH_TIMEOUT)
+            except EtcdEventIndexCleared:
+                # We've fallen behind etcd's event history, so reload.
+                _log.info("Event history cleared, reloading %s", self.root)
+                with self._lock:
+                    self._index = None
+                continue
+            except EtcdKeyNotFound:
+                # The watched directory doesn't exist (it was deleted).  Reload
+                # to pick up the current index.
+                with self._lock:
+                    self._index = None
+                time.sleep(RETRY_DELAY)
+                continue
+            except Exception:
+                # Includes watch timeouts when there are no changes.
+                _log.debug("Watch on %s failed", self.root, exc_info=True)
+                time.sleep(RETRY_DELAY)
+                continue
+            self._handle_event(result)
@@ -0,0 +1,198 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import logging
+import threading
+import time
+
+import etcd
+from etcd import EtcdException
+
+_log = logging.getLogger(__name__)
+
+MEMBER_RETRY_DELAY = 5
+"""How long (seconds) to avoid a member of the cluster after a request to it
+fails."""
+
+LEADER_STATES = ("StateLeader", "leader")
+"""The values of "state" in a member's /stats/self that mean it is the
+leader, for etcd 2.x and 0.4 respectively."""
+
+
+_REQUEST_ERRORS = tuple(
+    getattr(etcd, name) for name in
+    ("EtcdKeyError", "EtcdValueError", "EtcdEventIndexCleared",
+     "EtcdWatcherCleared", "EtcdWatchTimedOut", "EtcdRootReadOnly",
+     "EtcdInsufficientPermissions")
+    if hasattr(etcd, name))
+"""The errors about the keys or the request itself, or about watches, that
+another member would give too.  Not all of these exist in every version of
+python-etcd."""
+
+
+def _member_failed(error):
+    """
+    Whether an error from a request means that the member could not handle
+    it, as opposed to an error about the keys in the request.  python-etcd
+    0.4 raises EtcdConnectionFailed when it can't connect to the member;
+    older versions raise EtcdException itself, and Exception for raft
+    errors.  Failed compare-and-swaps are a ValueError in older versions
+    and an EtcdCompareFailed (an EtcdValueError) in 0.4.
+    """
+    if isinstance(error, _REQUEST_ERRORS):
+        return False
+    return isinstance(error, EtcdException) or type(error) is Exception
+
+
+class ClusterEtcdClient(object):
+    """
+    A client for a cluster of etcd members, with the read(), write() and
+    delete() methods of etcd.Client.
+
+    Writes and deletes go to the leader, so that they are not forwarded
+    between members.  Reads are spread across the members in turn.  Quorum
+    reads are agreed by the cluster, so they see every write that has
+    completed; without them, a member answers from its own copy of the data,
+    which can be slightly behind the leader.
+
+    The clients for the members share one pool of keep-alive connections.  A
+    member that fails a request is skipped for MEMBER_RETRY_DELAY seconds.  A
+    failed read is retried on the next member; a failed write or delete is not
+    retried, because it may have been applied, but the leader is looked up
+    again for the next one.
+    """
+
+    def __init__(self, members, quorum_reads=True):
+        """
+        Constructor.
+        :param members: List of (host, port) tuples, one for each member.
+        :param quorum_reads: If True, make reads quorum reads.
+        """
+        assert members
+        self.quorum_reads = quorum_reads
+
+        self.members = [etcd.Client(host=host, port=port)
+                        for host, port in members]
+        """The etcd.Client for each member."""
+        self.http = self.members[0].http
+        """The connection pool shared by the members' clients."""
+        for member in self.members:
+            member.http = self.http
+            # python-etcd only passes on the read options that it knows of.
+            member._read_options = member._read_options | set(["quorum"])
+
+        self._lock = threading.Lock()
+        self._next_read = 0
+        self._leader = None
+        self._leader_lookup = None
+        """The time of the last failed lookup of the leader."""
+        self._failed = {}
+        """The members that failed a request, mapped to the time they
+        failed."""
+
+    def read(self, key, **kwargs):
+        """
+        Read a key from etcd, as etcd.Client.read().
+        """
+        if self.quorum_reads and not kwargs.get("wait"):
+            kwargs.setdefault("quorum", True)
+        members = self._members_to_try()
+        for member in members:
+            try:
+                return member.read(key, **kwargs)
+            except Exception as e:
+                if not _member_failed(e) or member is members[-1]:
+                    raise
+                self._fail(member, e)
+
+    def write(self, key, value, **kwargs):
+        """
+        Write a key to etcd, as etcd.Client.write().
+        """
+        return self._on_leader("write", key, value, **kwargs)
+
+    def delete(self, key, **kwargs):
+        """
+        Delete a key from etcd, as etcd.Client.delete().
+        """
+        return self._on_leader("delete", key, **kwargs)
+
+    def _on_leader(self, method, *args, **kwargs):
+        """
+        Make a request to the leader, or to any working member if the leader
+        can't be found.
+        """
+        member = self._get_leader() or self._members_to_try()[0]
+        try:
+            return getattr(member, method)(*args, **kwargs)
+        except Exception as e:
+            if _member_failed(e):
+                self._fail(member, e)
+            raise
+
+    def _members_to_try(self):
+        """
+        Get the members to make a read from, leaving out those that have
+        recently failed unless that leaves none, starting with the next one
+        in turn.
+        """
+        with self._lock:
+            now = time.time()
+            for member, failed in self._failed.items():
+                if now - failed >= MEMBER_RETRY_DELAY:
+                    del self._failed[member]
+            members = [member for member in self.members
+                       if member not in self._failed] or self.members
+            start = self._next_read % len(members)
+            self._next_read += 1
+            return members[start:] + members[:start]
+
+    def _get_leader(self):
+        """
+        Get the client for the leader, asking the working members which of
+        them is the leader if we don't already know.
+        :return: The client, or None if no member says it is the leader.
+        """
+        leader, lookup = self._leader, self._leader_lookup
+        if leader is not None:
+            return leader
+        if lookup is not None and time.time() - lookup < MEMBER_RETRY_DELAY:
+            return None
+        for member in self._members_to_try():
+            try:
+                response = member.api_execute(
+                    member.version_prefix + "/stats/self", member._MGET)
+                stats = json.loads(response.data.decode("utf-8"))
+            except Exception as e:
+                self._fail(member, e)
+                continue
+            if stats.get("state") in LEADER_STATES:
+                _log.info("etcd leader is %s", member.base_uri)
+                self._leader = member
+                return member
+        _log.warning("Couldn't find the etcd leader")
+        self._leader_lookup = time.time()
+        return None
+
+    def _fail(self, member, error):
+        """
+        Record that a request to a member failed.
+        """
+        _log.warning("Request to etcd at %s failed: %r",
+                     member.base_uri, error)
+        with self._lock:
+            self._failed[member] = time.time()
+            if self._leader is member:
+                self._leader = None
@@ -16,6 +16,7 @@ from collections import namedtuple
 import copy
 import json
 import re
+import threading
 
 from netaddr import IPAddress, IPNetwork
 
@@ -23,13 +24,39 @@ VETH_NAME = "eth1"
 """The name to give to the veth in the target container's namespace. Default
 to eth1 because eth0 could be in use"""
 
-# The various datatype classes used by datastore.py are collected here.
+# The various datatype classes used by datastore.py are collected here.  A
+# cache may hold a great many of these objects, so they use __slots__.
+
+MAX_SHARED_STRINGS = 10000
+"""The number of strings that _shared() holds before it starts again."""
+
+_SHARED_STRINGS = {}
+
+
+def _shared(value):
+    """
+    Return a single shared copy of a string that is likely to be repeated
+    across many endpoints, such as a hostname or profile ID.
+
+    The strings are unicode, which can't be interned or weakly referenced, so
+    they are held in a dict.  The dict is emptied when it is full, so that
+    strings which are no longer used (such as the IDs of deleted profiles)
+    don't accumulate; strings already shared stay shared.
+    """
+    shared = _SHARED_STRINGS.get(value)
+    if shared is None:
+        if len(_SHARED_STRINGS) >= MAX_SHARED_STRINGS:
+            _SHARED_STRINGS.clear()
+        shared = _SHARED_STRINGS.setdefault(value, value)
+    return shared
+
 
 class Rules(namedtuple("Rules", ["id", "inbound_rules", "outbound_rules"])):
     """
     A set of Calico rules describing inbound and outbound network traffic
     policy.
     """
+    __slots__ = ()
 
     def to_json(self, indent=None):
         """
@@ -72,6 +99,7 @@ class BGPPeer(object):
     """
     Class encapsulating a BGPPeer.
     """
+    __slots__ = ("ip", "as_num")
 
     def __init__(self, ip, as_num):
         """
@@ -111,6 +139,7 @@ class IPPool(object):
     """
     Class encapsulating an IPPool.
     """
+    __slots__ = ("cidr", "ipip", "masquerade")
 
     def __init__(self, cidr, ipip=False, masquerade=False):
         """
@@ -169,6 +198,140 @@ class IPPool(object):
         return str(self.cidr)
 
 
+_ADDRESS_BITS = {4: 32, 6: 128}
+
+
+class _PrefixTrieNode(object):
+    """
+    A node of the binary prefix trie in an IPPoolSet.  The node at depth n
+    stands for a prefix of length n.
+    """
+    __slots__ = ("children", "pool")
+
+    def __init__(self):
+        self.children = [None, None]
+        self.pool = None
+
+
+class IPPoolSet(object):
+    """
+    A set of IPPools, indexed by a binary prefix trie over the integer values
+    of their CIDRs.  This finds the pool that an address is in, or the pools
+    that overlap a CIDR, in time proportional to the prefix length rather
+    than the number of pools.
+    """
+
+    def __init__(self, pools=()):
+        """
+        Constructor.
+        :param pools: Iterable of IPPools to add.
+        """
+        self._roots = {4: _PrefixTrieNode(), 6: _PrefixTrieNode()}
+        for pool in pools:
+            self.add(pool)
+
+    def add(self, pool):
+        """
+        Add a pool to the set, replacing any pool with the same CIDR.
+        :param pool: IPPool object
+        :return: None
+        """
+        node = self._roots[pool.cidr.version]
+        for bit in _prefix_bits(pool.cidr):
+            if node.children[bit] is None:
+                node.children[bit] = _PrefixTrieNode()
+            node = node.children[bit]
+        node.pool = pool
+
+    def get_pool(self, address):
+        """
+        Find the pool that an address is in.  If the address is in more than
+        one pool, the pool with the longest prefix is used.
+        :param address: IPAddress object
+        :return: The IPPool, or None if the address isn't in any pool.
+        """
+        value = int(address)
+        shift = _ADDRESS_BITS[address.version]
+        node = self._roots[address.version]
+        pool = None
+        while node is not None:
+            if node.pool is not None:
+                pool = node.pool
+            shift -= 1
+            if shift < 0:
+                break
+            node = node.children[(value >> shift) & 1]
+        return pool
+
+    def get_overlapping_pools(self, cidr):
+        """
+        Find the pools that overlap a CIDR, i.e. those that contain it or are
+        contained in it.
+        :param cidr: IPNetwork object
+        :return: List of IPPool.
+        """
+        overlapping = []
+        node = self._roots[cidr.version]
+        for bit in _prefix_bits(cidr):
+            if node.pool is not None:
+                overlapping.append(node.pool)
+            node = node.children[bit]
+            if node is None:
+                return overlapping
+
+        # Every pool at or below this node is within the CIDR.
+        nodes = [node]
+        while nodes:
+            node = nodes.pop()
+            if node.pool is not None:
+                overlapping.append(node.pool)
+            nodes.extend(child for child in node.children if child)
+        return overlapping
+
+
+def _prefix_bits(cidr):
+    """
+    :param cidr: IPNetwork object
+    :return: Iterator of the bits of the CIDR's prefix, most significant
+    first.
+    """
+    value = cidr.value
+    bits = _ADDRESS_BITS[cidr.version]
+    for shift in range(bits - 1, bits - 1 - cidr.prefixlen, -1):
+        yield (value >> shift) & 1
+
+
+_NO_ADDRESSES = ((), (), None, None)
+"""The unparsed addresses of a new Endpoint."""
+
+_PARSE_LOCK = threading.Lock()
+"""Serializes converting the addresses of Endpoints, which may first be used
+from more than one thread at once (e.g. the IPv4 and IPv6 assignments in the
+libnetwork plugin)."""
+
+
+class _AddressField(object):
+    """
+    Descriptor for the networks and gateways of an Endpoint.  An Endpoint
+    read from the datastore keeps these as strings until one of them is
+    used, since converting them to netaddr objects is most of the cost of
+    parsing an endpoint.
+    """
+
+    def __init__(self, name):
+        self.attr = "_" + name
+
+    def __get__(self, endpoint, owner):
+        if endpoint is None:
+            return self
+        endpoint._parse_addresses()
+        return getattr(endpoint, self.attr)
+
+    def __set__(self, endpoint, value):
+        endpoint._parse_addresses()
+        setattr(endpoint, self.attr, value)
+
+
 class Endpoint(object):
     """
     Class encapsulating an Endpoint.
@@ -181,6 +344,16 @@ class Endpoint(object):
                                 "(?P<workload_id>[^/]*)/"
                                 "endpoint/(?P<endpoint_id>[^/]*)")
 
+    __slots__ = ("hostname", "orchestrator_id", "workload_id", "endpoint_id",
+                 "state", "mac", "if_name", "profile_ids", "_original_json",
+                 "_unparsed_addresses", "_ipv4_nets", "_ipv6_nets",
+                 "_ipv4_gateway", "_ipv6_gateway")
+
+    ipv4_nets = _AddressField("ipv4_nets")
+    ipv6_nets = _AddressField("ipv6_nets")
+    ipv4_gateway = _AddressField("ipv4_gateway")
+    ipv6_gateway = _AddressField("ipv6_gateway")
+
     def __init__(self, hostname, orchestrator_id, workload_id, endpoint_id,
                  state, mac):
         self.hostname = hostname
@@ -189,17 +362,20 @@ class Endpoint(object):
         self.endpoint_id = endpoint_id
         self.state = state
         self.mac = mac
-        self.name = "cali" + endpoint_id[:11]
 
-        self.ipv4_nets = set()
-        self.ipv6_nets = set()
-        self.ipv4_gateway = None
-        self.ipv6_gateway = None
+        # The (ipv4_nets, ipv6_nets, ipv4_gateway, ipv6_gateway) strings, until
+        # they are converted to the attributes of the same names.
+        self._unparsed_addresses = _NO_ADDRESSES
 
         self.if_name = None
         self.profile_ids = []
         self._original_json = None
 
+    @property
+    def name(self):
+        """The name of the endpoint's interface in the root namespace."""
+        return "cali" + self.endpoint_id[:11]
+
     def to_json(self):
         json_dict = {"state": self.state,
                      "name": self.name,
@@ -228,37 +404,52 @@ class Endpoint(object):
         if not match:
             return None
 
-        hostname = match.group("hostname")
-        orchestrator_id = match.group("orchestrator_id")
+        hostname = _shared(match.group("hostname"))
+        orchestrator_id = _shared(match.group("orchestrator_id"))
         workload_id = match.group("workload_id")
         endpoint_id = match.group("endpoint_id")
 
         json_dict = json.loads(json_str)
         ep = cls(hostname, orchestrator_id, workload_id, endpoint_id,
-                 json_dict["state"], json_dict["mac"])
-
-        for net in json_dict["ipv4_nets"]:
-            ep.ipv4_nets.add(IPNetwork(net))
-        for net in json_dict["ipv6_nets"]:
-            ep.ipv6_nets.add(IPNetwork(net))
-        ipv4_gw = json_dict.get("ipv4_gateway")
-        if ipv4_gw:
-            ep.ipv4_gateway = IPAddress(ipv4_gw)
-        ipv6_gw = json_dict.get("ipv6_gateway")
-        if ipv6_gw:
-            ep.ipv6_gateway = IPAddress(ipv6_gw)
+                 _shared(json_dict["state"]), json_dict["mac"])
+
+        # The networks and gateways are parsed when they are first used.
+        ep._unparsed_addresses = (json_dict["ipv4_nets"],
+                                  json_dict["ipv6_nets"],
+                                  json_dict.get("ipv4_gateway"),
+                                  json_dict.get("ipv6_gateway"))
 
         # Version controlled fields
         profile_id = json_dict.get("profile_id", None)
-        ep.profile_ids = [profile_id] if profile_id else \
-                         json_dict.get("profile_ids", [])
-        ep.if_name = json_dict.get("container:if_name", VETH_NAME)
+        ep.profile_ids = [_shared(profile_id)] if profile_id else \
+                         [_shared(profile) for profile in
+                          json_dict.get("profile_ids", [])]
+        ep.if_name = _shared(json_dict.get("container:if_name", VETH_NAME))
 
         # Store the original JSON representation of this Endpoint.
         ep._original_json = json_str
 
         return ep
 
+    def _parse_addresses(self):
+        """
+        Convert the networks and gateways from the endpoint JSON, if that
+        hasn't been done yet.
+        """
+        if self._unparsed_addresses is None:
+            return
+        with _PARSE_LOCK:
+            if self._unparsed_addresses is None:
+                # Another thread converted them while we waited.
+                return
+            ipv4_nets, ipv6_nets, ipv4_gw, ipv6_gw = self._unparsed_addresses
+
+            self._ipv4_nets = set(IPNetwork(net) for net in ipv4_nets)
+            self._ipv6_nets = set(IPNetwork(net) for net in ipv6_nets)
+            self._ipv4_gateway = IPAddress(ipv4_gw) if ipv4_gw else None
+            self._ipv6_gateway = IPAddress(ipv6_gw) if ipv6_gw else None
+            self._unparsed_addresses = None
+
     def matches(self, hostname=None, orchestrator_id=None,
                 workload_id=None, endpoint_id=None):
         """
@@ -313,6 +504,7 @@ class Endpoint(object):
 
 class Profile(object):
     """A Calico policy profile."""
+    __slots__ = ("name", "tags", "rules")
 
     def __init__(self, name):
         self.name = name
@@ -326,6 +518,7 @@ class Rule(dict):
     """
     A Calico inbound or outbound traffic rule.
     """
+    __slots__ = ()
 
     ALLOWED_KEYS = ["protocol",
                     "src_tag",
@@ -51,4 +51,16 @@ class MultipleEndpointsMatch(Exception):
     """
     More than one endpoint was found for the specified criteria.
     """
-    pass
\ No newline at end of file
+    pass
+
+
+class BatchWriteError(DataStoreError):
+    """
+    More than one of a batch of concurrent writes failed.  The exceptions
+    raised by the failed writes are in errors.
+    """
+    def __init__(self, errors):
+        super(BatchWriteError, self).__init__(
+            "%d writes failed: %s" % (len(errors),
+                                      "; ".join(str(e) for e in errors)))
+        self.errors = errors
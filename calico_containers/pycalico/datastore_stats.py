@@ -0,0 +1,207 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Statistics for the calls to the datastore API, kept for each method by the
+handle_errors decorator: the number of calls and errors, a histogram of how
+long the calls took, and how many etcd requests and failed compare-and-swaps
+they made.  The counts for a call include any datastore methods it calls in
+turn.
+"""
+import logging
+import os
+import threading
+import time
+
+from etcd import EtcdAlreadyExist
+
+_log = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+"""The upper bounds (seconds) of the buckets of the latency histograms.  The
+last bucket of each histogram holds the calls slower than all of these."""
+
+SLOW_CALL_ENV = "CALICO_SLOW_CALL_MS"
+"""If set, calls that take longer than this many milliseconds are logged."""
+
+slow_call_threshold = None
+"""Calls that take longer than this (seconds) are logged.  None turns off the
+logging."""
+if os.getenv(SLOW_CALL_ENV):
+    slow_call_threshold = float(os.getenv(SLOW_CALL_ENV)) / 1000
+
+_lock = threading.Lock()
+_operations = {}
+
+_local = threading.local()
+"""The number of etcd requests and of failed compare-and-swaps made by this
+thread."""
+
+
+class OperationStats(object):
+    """
+    The statistics for one datastore method.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.etcd_requests = 0
+        self.cas_failures = 0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def record(self, elapsed, etcd_requests, cas_failures, failed):
+        """
+        Add a call to the statistics.
+        """
+        self.calls += 1
+        if failed:
+            self.errors += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.etcd_requests += etcd_requests
+        self.cas_failures += cas_failures
+        bucket = 0
+        while bucket < len(LATENCY_BUCKETS) and \
+                elapsed > LATENCY_BUCKETS[bucket]:
+            bucket += 1
+        self.histogram[bucket] += 1
+
+    def to_dict(self):
+        return {"calls": self.calls,
+                "errors": self.errors,
+                "total_time": self.total_time,
+                "max_time": self.max_time,
+                "etcd_requests": self.etcd_requests,
+                "cas_failures": self.cas_failures,
+                "histogram": list(self.histogram)}
+
+
+def thread_counts():
+    """
+    Get the number of etcd requests and failed compare-and-swaps made by this
+    thread so far.
+    """
+    return getattr(_local, "requests", 0), getattr(_local, "cas_failures", 0)
+
+
+def add_thread_counts(requests, cas_failures):
+    """
+    Add etcd requests and failed compare-and-swaps to those made by this
+    thread.  Used to count the requests that a call makes from other threads
+    on its behalf.
+    """
+    _local.requests = getattr(_local, "requests", 0) + requests
+    _local.cas_failures = getattr(_local, "cas_failures", 0) + cas_failures
+
+
+def timed(name, fn, *args, **kwargs):
+    """
+    Call a datastore method and record its statistics.
+
+    :param name: The name of the method.
+    :param fn: The function to call, with the remaining arguments.
+    :return: The result of the call.
+    """
+    start_requests, start_cas_failures = thread_counts()
+    start = time.time()
+    failed = True
+    try:
+        result = fn(*args, **kwargs)
+        failed = False
+        return result
+    finally:
+        elapsed = time.time() - start
+        requests, cas_failures = thread_counts()
+        requests -= start_requests
+        cas_failures -= start_cas_failures
+        with _lock:
+            stats = _operations.get(name)
+            if stats is None:
+                stats = _operations[name] = OperationStats()
+            stats.record(elapsed, requests, cas_failures, failed)
+        if slow_call_threshold is not None and elapsed > slow_call_threshold:
+            _log.warning("Slow datastore call %s took %.1fms with %d etcd "
+                         "requests and %d failed compare-and-swaps", name,
+                         elapsed * 1000, requests, cas_failures)
+
+
+def count_etcd_requests(etcd_client):
+    """
+    Count the requests that an etcd.Client makes, for the statistics of the
+    datastore calls that make them.
+
+    :param etcd_client: The etcd.Client.  Its api_execute() method, which
+    makes every request, is wrapped.
+    """
+    api_execute = etcd_client.api_execute
+
+    def counted_api_execute(path, method, params=None, **kwargs):
+        add_thread_counts(1, 0)
+        try:
+            return api_execute(path, method, params=params, **kwargs)
+        except (ValueError, EtcdAlreadyExist):
+            # The comparison for a compare-and-swap failed, or the key for a
+            # create-if-absent already existed.
+            add_thread_counts(0, 1)
+            raise
+
+    etcd_client.api_execute = counted_api_execute
+
+
+def get_stats():
+    """
+    Get the statistics of each datastore method that has been called.
+
+    :return: Dict mapping the name of each method to a dict of its
+    statistics: "calls", "errors", "total_time" and "max_time" (seconds),
+    "etcd_requests", "cas_failures", and "histogram", the number of calls
+    in each of LATENCY_BUCKETS.
+    """
+    with _lock:
+        return dict((name, stats.to_dict())
+                    for name, stats in _operations.iteritems())
+
+
+def reset_stats():
+    """
+    Discard the statistics of all methods.
+    """
+    with _lock:
+        _operations.clear()
+
+
+def format_stats(stats):
+    """
+    Format statistics, as returned by get_stats(), as a table with a line for
+    each method, slowest in total first.
+
+    :param stats: The statistics.
+    :return: The table, as a string.
+    """
+    lines = ["%-32s %8s %7s %10s %10s %10s %8s" %
+             ("method", "calls", "errors", "mean ms", "max ms",
+              "etcd/call", "cas")]
+    for name, op in sorted(stats.iteritems(),
+                           key=lambda (_, op): -op["total_time"]):
+        lines.append("%-32s %8d %7d %10.1f %10.1f %10.1f %8d" %
+                     (name, op["calls"], op["errors"],
+                      op["total_time"] * 1000 / op["calls"],
+                      op["max_time"] * 1000,
+                      float(op["etcd_requests"]) / op["calls"],
+                      op["cas_failures"]))
+    return "\n".join(lines) + "\n"
@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import os
 from datetime import datetime
 import tarfile
@@ -24,6 +25,10 @@ from shutil import copytree
 import sh
 
 from pycalico.datastore import DatastoreClient
+from pycalico.datastore_stats import format_stats
+
+PLUGIN_SOCKET = "/usr/share/docker/plugins/calico.sock"
+PLUGIN_TIMEOUT = 5
 
 
 def save_diags(log_dir, upload=False):
@@ -115,6 +120,14 @@ def save_diags(log_dir, upload=False):
     except EtcdException:
         print "Unable to dump etcd datastore"
 
+    print("Dumping datastore statistics from the Calico plugin")
+    try:
+        stats = get_plugin_stats()
+        with open(os.path.join(temp_diags_dir, 'datastore_stats'), 'w') as f:
+            f.write(format_stats(stats))
+    except (socket.error, ValueError):
+        print "Unable to get datastore statistics from the Calico plugin"
+
     # Create tar and upload
     tar_filename = datetime.strftime(datetime.today(),"diags-%d%m%y_%H%M%S.tar.gz")
     full_tar_path = os.path.join(temp_dir, tar_filename)
@@ -128,6 +141,32 @@ def save_diags(log_dir, upload=False):
         upload_temp_diags(full_tar_path)
 
 
+def get_plugin_stats():
+    """
+    Get the statistics of the datastore calls made by the Calico libnetwork
+    plugin, from its socket.
+    :return: The statistics, as returned by datastore_stats.get_stats().
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(PLUGIN_TIMEOUT)
+    try:
+        sock.connect(PLUGIN_SOCKET)
+        sock.sendall("GET /stats HTTP/1.0\r\n\r\n")
+        response = ""
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            response += data
+    finally:
+        sock.close()
+    headers, _, body = response.partition("\r\n\r\n")
+    status_line = headers.split("\r\n", 1)[0]
+    if status_line.split()[1:2] != ["200"]:
+        raise ValueError("Unexpected response from plugin: %s" % status_line)
+    return json.loads(body)
+
+
 def upload_temp_diags(diags_path):
     # TODO: Rewrite into httplib
     print("Uploading file. Available for 14 days from the URL printed when the upload completes")
@@ -0,0 +1,129 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_MAX_SIZE = 1000
+"""The number of endpoints an EndpointCache holds by default."""
+
+DEFAULT_TTL = 10
+"""How long (seconds) an EndpointCache uses an endpoint for by default before
+checking it is still current."""
+
+
+class EndpointCache(object):
+    """
+    A cache of the Endpoint objects that a process has written, so that it can
+    use them again without reading and parsing them from the datastore.
+
+    Endpoints are added by put() with the etcd modifiedIndex of the write that
+    stored them.  Once an endpoint has been in the cache for longer than the
+    TTL, its index is checked against the datastore before it is used again.
+    The least recently used endpoints are dropped when the cache is full.
+
+    The endpoints returned are shared, so must not be modified.
+    """
+
+    def __init__(self, client, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL):
+        """
+        Constructor.
+        :param client: The DatastoreClient to read endpoints from.
+        :param max_size: The number of endpoints to hold.
+        :param ttl: How long (seconds) to use an endpoint for before checking
+        its index.
+        """
+        self.client = client
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        """Maps (hostname, orchestrator_id, workload_id, endpoint_id) to
+        (endpoint, modifiedIndex, time the index was last checked), least
+        recently used first."""
+
+    def put(self, endpoint, index):
+        """
+        Add an endpoint that has been written to the datastore.
+
+        :param endpoint: The Endpoint.
+        :param index: The etcd modifiedIndex of the endpoint.
+        """
+        key = (endpoint.hostname, endpoint.orchestrator_id,
+               endpoint.workload_id, endpoint.endpoint_id)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (endpoint, index, time.time())
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, hostname, orchestrator_id, workload_id,
+                   endpoint_id):
+        """
+        Remove an endpoint from the cache, if it is there.
+        """
+        with self._lock:
+            self._entries.pop((hostname, orchestrator_id, workload_id,
+                               endpoint_id), None)
+
+    def clear(self):
+        """
+        Remove all the endpoints from the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def get_endpoint(self, hostname, orchestrator_id, workload_id,
+                     endpoint_id):
+        """
+        Get an endpoint, from the cache if it holds a current copy, and from
+        the datastore otherwise.  Endpoints read from the datastore are not
+        added to the cache, as we don't know their index.
+
+        :param hostname: The hostname that the endpoint lives on.
+        :param orchestrator_id: The orchestrator that the endpoint belongs to.
+        :param workload_id: The workload that the endpoint belongs to.
+        :param endpoint_id: The ID of the endpoint
+        :return: An Endpoint Object
+        """
+        key = (hostname, orchestrator_id, workload_id, endpoint_id)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+
+        if entry is not None:
+            endpoint, index, checked = entry
+            now = time.time()
+            if now - checked < self.ttl:
+                return endpoint
+            try:
+                current = self.client.get_endpoint_index(*key)
+            except KeyError:
+                current = None
+            with self._lock:
+                if current == index:
+                    if key in self._entries:
+                        self._entries[key] = (endpoint, index, now)
+                    return endpoint
+                # The endpoint has changed or gone.  Only remove our entry if
+                # it hasn't been replaced meanwhile.
+                if self._entries.get(key) == entry:
+                    del self._entries[key]
+
+        return self.client.get_endpoint(hostname=hostname,
+                                        orchestrator_id=orchestrator_id,
+                                        workload_id=workload_id,
+                                        endpoint_id=endpoint_id)
@@ -12,15 +12,68 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from etcd import EtcdKeyNotFound, EtcdAlreadyExist
+import json
+import logging
+import random
+import threading
+import time
+from collections import deque
+
+from etcd import EtcdException, EtcdKeyNotFound, EtcdAlreadyExist
 
 from netaddr import IPAddress, IPNetwork
 
 from pycalico.datastore_datatypes import IPPool
-from pycalico.datastore import CALICO_V_PATH, DatastoreClient
+from pycalico.datastore import CALICO_V_PATH, DatastoreClient, \
+    handle_errors, _run_concurrently
+from pycalico.datastore_errors import DataStoreError
+
+_log = logging.getLogger(__name__)
 
-IP_ASSIGNMENT_PATH = CALICO_V_PATH + "/ipam/%(version)s/assignment/%(pool)s"
+IP_ASSIGNMENTS_PATH = CALICO_V_PATH + "/ipam/%(version)s/assignment/"
+IP_ASSIGNMENT_PATH = IP_ASSIGNMENTS_PATH + "%(pool)s"
+"""Directory of per-address assignment keys used by earlier versions.  Pools
+that still have these keys aren't allocated from automatically until they are
+migrated to allocation blocks."""
 IP_ASSIGNMENT_KEY = IP_ASSIGNMENT_PATH + "/%(address)s"
+IP_BLOCK_PATH = CALICO_V_PATH + "/ipam/%(version)s/block/%(pool)s/"
+IP_BLOCK_KEY = IP_BLOCK_PATH + "%(block)s"
+IP_HOSTS_PATH = CALICO_V_PATH + "/ipam/%(version)s/host/"
+IP_HOST_AFFINITY_PATH = IP_HOSTS_PATH + "%(hostname)s/%(pool)s/"
+IP_HOST_AFFINITY_KEY = IP_HOST_AFFINITY_PATH + "%(block)s"
+IP_RESERVE_PATH = CALICO_V_PATH + \
+                  "/ipam/%(version)s/host/%(hostname)s/reserved/"
+IP_RESERVE_KEY = IP_RESERVE_PATH + "%(address)s"
+IP_USAGE_PATH = CALICO_V_PATH + "/ipam/%(version)s/usage/"
+IP_USAGE_KEY = IP_USAGE_PATH + "%(pool)s"
+IP_HANDLES_PATH = CALICO_V_PATH + "/ipam/handle/"
+IP_HANDLE_PATH = IP_HANDLES_PATH + "%(handle)s/"
+IP_HANDLE_KEY = IP_HANDLE_PATH + "%(address)s"
+
+RESERVE_RETRY_DELAY = 5
+"""How long (seconds) to wait before retrying a failed refill of an
+AddressReserve."""
+
+BLOCK_PREFIXLEN = {4: 26, 6: 122}
+"""The prefix length of the address blocks that a host claims from a pool, by
+IP version.  Pools smaller than this are handled as a single block."""
+
+RANDOM_MIN_POOL_SIZE = 2 ** 32
+"""The smallest pool that RandomAssignment picks addresses from at random."""
+RANDOM_PROBES = 8
+"""The number of random addresses RandomAssignment tries before falling back
+to assigning from blocks."""
+
+_random = random.SystemRandom()
+
+FULL_POOL_RECOUNT_INTERVAL = 60
+"""How often (seconds) get_free_ip_pools() recounts a pool whose usage counter
+says it is full, in case the counter has drifted."""
+
+GC_GRACE_PERIOD = 30
+"""How long (seconds) IPAMClient.release_leaked_addresses() waits before
+checking again that the addresses it found are unused.  This must be longer
+than it takes to write an endpoint after assigning its addresses."""
 
 
 class SequentialAssignment(object):
@@ -32,11 +85,12 @@ class SequentialAssignment(object):
         # Init an etcd client.
         self.etcd = IPAMClient()
 
-    def allocate(self, pool):
+    def allocate(self, pool, handle=None):
         """
         Attempt to allocate an IP address from the provided pool.
 
         :param IPPool or IPNetwork pool: The pool to allocate from
+        :param handle: Optional allocation handle to record the address under.
         :return: An IP address which has been allocated or None
         if allocation failed.
         :rtype str:
@@ -46,43 +100,398 @@ class SequentialAssignment(object):
         assert isinstance(pool, IPNetwork)
 
         while True:
-            assigned_addresses = self.etcd.get_assigned_addresses(pool)
+            blocks = dict((block.cidr, block)
+                          for block in self.etcd.get_allocation_blocks(pool))
+            # Skip the addresses assigned by hosts that haven't been upgraded
+            # yet, which aren't in the blocks.
+            for address in self.etcd.get_legacy_assignments(pool):
+                block_cidr = _block_cidr(pool, address)
+                if block_cidr not in blocks:
+                    blocks[block_cidr] = AllocationBlock(block_cidr, pool)
+                blocks[block_cidr].assign(address)
 
-            candidate_address = self._get_next(pool, assigned_addresses)
+            candidate_address = self._get_next(pool, blocks)
             if candidate_address is None:
                 # the pool is full, we can't allocate an address
                 return None
             else:
                 # We've found an address to try.
-                if self.etcd.assign_address(pool,
-                                            IPAddress(candidate_address)):
-                    return candidate_address
+                if self.etcd.assign_address(pool, candidate_address,
+                                            handle=handle):
+                    return str(candidate_address)
 
-    def _get_next(self, pool, assigned):
+    def _get_next(self, pool, blocks):
         """
         Gets the next address in a range.
         :param IPNetwork pool: The pool to allocate from
-        :param assigned: a dict of addresses that are already assigned.
-        :return: the next IP address to try (a string), or None if the pool
-                 is full.
+        :param blocks: a dict of the pool's AllocationBlocks, keyed by CIDR.
+        :return: the next IP address to try (an IPAddress), or None if the
+                 pool is full.
         """
         assert isinstance(pool, IPNetwork)
-        for addr in pool.iter_hosts():
-            addr_string = str(addr)
-            if addr_string not in assigned:
-                return addr_string
+        prefixlen = max(BLOCK_PREFIXLEN[pool.version], pool.prefixlen)
+        for block_cidr in pool.subnet(prefixlen):
+            block = blocks.get(block_cidr) or AllocationBlock(block_cidr, pool)
+            address = block.auto_assign()
+            if address is not None:
+                return address
         return None
 
 
+class BlockAssignment(object):
+    """
+    Assign IP addresses from blocks with an affinity to a particular host.
+
+    Each host claims blocks of BLOCK_PREFIXLEN addresses from a pool, and
+    allocates from those blocks first, so an allocation only needs to read
+    the host's own block rather than every assignment in the pool.  New blocks
+    are claimed when the host's blocks are full.  Once every block in the pool
+    has been claimed, the allocator borrows from blocks owned by other hosts.
+    """
+
+    def __init__(self, hostname, client=None):
+        """
+        Constructor.
+        :param hostname: The host to allocate addresses for.
+        :param client: The IPAMClient to use.  If not specified, a new client
+        is created.
+        """
+        self.hostname = hostname
+        self.etcd = client or IPAMClient()
+        self._legacy_pools = {}
+        """The pools with unmigrated assignments, by IP version, read once
+        for the life of the allocator."""
+
+    def allocate(self, pool, handle=None):
+        """
+        Attempt to allocate an IP address from the provided pool.  Nothing is
+        allocated from a pool that has unmigrated assignments (see
+        IPAMClient.get_legacy_pools()).
+
+        :param IPPool or IPNetwork pool: The pool to allocate from
+        :param handle: Optional allocation handle to record the address under.
+        :return: An IP address which has been allocated or None
+        if allocation failed.
+        :rtype str:
+        """
+        if isinstance(pool, IPPool):
+            pool = pool.cidr
+        assert isinstance(pool, IPNetwork)
+
+        version = "v%s" % pool.version
+        if version not in self._legacy_pools:
+            self._legacy_pools[version] = self.etcd.get_legacy_pools(version)
+        if pool in self._legacy_pools[version]:
+            _log.warning("Not allocating from pool %s, which has "
+                         "unmigrated assignments", pool)
+            return None
+
+        address = self._allocate(pool)
+        if address is not None and handle is not None:
+            self.etcd.add_to_handle(handle, pool, IPAddress(address))
+        return address
+
+    def _allocate(self, pool):
+        """
+        Allocate an address from the host's blocks.
+
+        :param IPNetwork pool: The pool to allocate from.
+        :return: The allocated address (a string), or None if the pool is
+        full.
+        """
+        # Try the blocks this host already owns.
+        for block_cidr in self.etcd.get_host_blocks(self.hostname, pool):
+            address = self._allocate_from_block(pool, block_cidr)
+            if address is not None:
+                return address
+
+        # All of our blocks are full, so claim a new one.
+        while True:
+            block = self.etcd.claim_block(self.hostname, pool)
+            if block is None:
+                # Every block in the pool has been claimed.
+                break
+            address = self._allocate_from_block(pool, block.cidr)
+            if address is not None:
+                return address
+
+        # Finally, borrow an address from a block owned by another host.
+        for block_cidr in self.etcd.get_blocks(pool):
+            address = self._allocate_from_block(pool, block_cidr)
+            if address is not None:
+                return address
+        return None
+
+    def _allocate_from_block(self, pool, block_cidr):
+        """
+        Allocate an address from a single block.
+
+        :param IPNetwork pool: The pool that the block is in.
+        :param IPNetwork block_cidr: The block to allocate from.
+        :return: The allocated address (a string), or None if the block is
+        full.
+        """
+        while True:
+            try:
+                block = self.etcd.read_block(pool, block_cidr)
+            except KeyError:
+                return None
+
+            address = block.auto_assign()
+            if address is None:
+                return None
+
+            if self.etcd.compare_and_swap_block(block):
+                return str(address)
+            # Someone else updated the block.  Re-read and try again.
+
+
+class RandomAssignment(BlockAssignment):
+    """
+    Assign IP addresses by picking them at random from large pools, such as
+    an IPv6 /64.
+
+    A random address in a large, sparsely used pool is almost always free, so
+    an allocation takes one read of the address's block and one write (which
+    creates the block if needed), however many addresses are already
+    assigned.  Neither the pool's assignments nor the host's blocks are read.
+    Pools smaller than RANDOM_MIN_POOL_SIZE, or in which RANDOM_PROBES random
+    addresses are all taken, are allocated from as by BlockAssignment.
+    """
+
+    def _allocate(self, pool):
+        """
+        Allocate a random address, or from the host's blocks.
+
+        :param IPNetwork pool: The pool to allocate from.
+        :return: The allocated address (a string), or None if the pool is
+        full.
+        """
+        if pool.size >= RANDOM_MIN_POOL_SIZE:
+            unusable = _unusable_addresses(pool)
+            for _ in range(RANDOM_PROBES):
+                address = IPAddress(pool.first + _random.randrange(pool.size),
+                                    pool.version)
+                if address in unusable:
+                    continue
+                # allocate() has checked that the pool has no unmigrated
+                # assignments, so only the block needs checking.
+                if self.etcd._assign_in_block(pool, address):
+                    return str(address)
+        return super(RandomAssignment, self)._allocate(pool)
+
+
+class AllocationBlock(object):
+    """
+    A block of addresses within a pool, with a bitmap recording which of its
+    addresses are allocated.  The blocks are the record of which addresses in
+    a pool are in use.
+    """
+
+    def __init__(self, cidr, pool, host_affinity=None):
+        """
+        Constructor.
+        :param cidr: IPNetwork object (or CIDR string) for the block.
+        :param pool: IPNetwork object for the pool containing the block.
+        :param host_affinity: The hostname of the host that owns the block, or
+        None.
+        """
+        self.cidr = IPNetwork(cidr).cidr
+        self.pool = pool
+        self.host_affinity = host_affinity
+
+        self.allocations = 0
+        """Bitmap of allocated addresses.  Bit n is set when the n'th address
+        in the block is allocated."""
+
+        self.db_result = None
+        """The etcd result this block was read from, used for atomic
+        updates."""
+
+        self.db_allocations = 0
+        """The allocations bitmap as last read from or written to the
+        datastore, used to count the addresses an update assigns or
+        releases."""
+
+        # Addresses that hosts can't use (e.g. the pool's network and
+        # broadcast addresses) are never handed out.
+        self.reserved = 0
+        for address in _unusable_addresses(pool):
+            if address in self.cidr:
+                self.reserved |= 1 << self._offset(address)
+
+    def to_json(self):
+        """
+        Convert the AllocationBlock to a JSON string.
+        :return: A JSON string.
+        """
+        json_dict = {"cidr": str(self.cidr),
+                     "affinity": self.host_affinity,
+                     "allocations": "%x" % self.allocations}
+        return json.dumps(json_dict)
+
+    @classmethod
+    def from_json(cls, json_str, pool):
+        """
+        Convert the json string into an AllocationBlock object.
+        :param json_str: The JSON string representing an AllocationBlock.
+        :param pool: IPNetwork object for the pool containing the block.
+        :return: An AllocationBlock object.
+        """
+        json_dict = json.loads(json_str)
+        block = cls(json_dict["cidr"], pool,
+                    host_affinity=json_dict.get("affinity"))
+        block.allocations = int(json_dict["allocations"], 16)
+        block.db_allocations = block.allocations
+        return block
+
+    def _offset(self, address):
+        return int(address) - self.cidr.first
+
+    def auto_assign(self):
+        """
+        Mark the lowest free address in the block as allocated.
+
+        :return: The IPAddress allocated, or None if the block is full.
+        """
+        free = ~(self.allocations | self.reserved) & ((1 << self.cidr.size) - 1)
+        if not free:
+            return None
+        # Isolate the lowest set bit of the free bitmap.
+        offset = (free & -free).bit_length() - 1
+        self.allocations |= 1 << offset
+        return IPAddress(self.cidr.first + offset, self.cidr.version)
+
+    def assign(self, address):
+        """
+        Mark a specific address in the block as allocated.
+
+        :param IPAddress address: The address to assign.
+        :return: True if the address was free, False if it was already
+        allocated.
+        """
+        bit = 1 << self._offset(address)
+        if self.allocations & bit:
+            return False
+        self.allocations |= bit
+        return True
+
+    def release(self, address):
+        """
+        Mark an address in the block as free.
+
+        :param IPAddress address: The address to release.
+        :return: True if the address was allocated, False otherwise.
+        """
+        bit = 1 << self._offset(address)
+        if not self.allocations & bit:
+            return False
+        self.allocations &= ~bit
+        return True
+
+    def count(self):
+        """
+        :return: The number of addresses in the block that are allocated.
+        """
+        return _bit_count(self.allocations)
+
+    def free_count(self):
+        """
+        :return: The number of addresses in the block that can be allocated.
+        """
+        return self.cidr.size - _bit_count(self.allocations | self.reserved)
+
+    def allocated_addresses(self):
+        """
+        Get the addresses in the block that are allocated.
+
+        :return: Iterator of IPAddress, in ascending order.
+        """
+        allocations = self.allocations
+        while allocations:
+            bit = allocations & -allocations
+            allocations ^= bit
+            yield IPAddress(self.cidr.first + bit.bit_length() - 1,
+                            self.cidr.version)
+
+
+def _block_cidr(pool, address):
+    """
+    Get the CIDR of the block that contains an address.
+
+    :param IPNetwork pool: The pool that the address is in.
+    :param IPAddress address: The address.
+    :return: IPNetwork for the block.
+    """
+    prefixlen = max(BLOCK_PREFIXLEN[pool.version], pool.prefixlen)
+    return IPNetwork("%s/%d" % (address, prefixlen)).cidr
+
+
+def _bit_count(value):
+    """
+    :return: The number of bits set in an integer.
+    """
+    return bin(value).count("1")
+
+
+def _pool_capacity(pool):
+    """
+    :param IPNetwork pool: The pool.
+    :return: The number of addresses in the pool that can be assigned.
+    """
+    return pool.size - len(_unusable_addresses(pool))
+
+
+def _unusable_addresses(pool):
+    """
+    Get the addresses in a pool that can't be assigned to a host.  This
+    matches the behaviour of IPNetwork.iter_hosts().
+
+    :param IPNetwork pool: The pool.
+    :return: A list of IPAddress.
+    """
+    if pool.version == 4 and pool.size < 4 or pool.size < 2:
+        return list(pool)
+    elif pool.version == 4:
+        return [IPAddress(pool.first, 4), IPAddress(pool.last, 4)]
+    else:
+        return [IPAddress(pool.first, 6)]
+
+
+class DualStackAllocation(object):
+    """
+    The addresses allocated for an endpoint by
+    IPAMClient.allocate_dual_stack(), with the host's next hops to use as the
+    endpoint's gateways.  The IPv6 fields are None if no IPv6 address was
+    allocated.
+    """
+
+    def __init__(self, ipv4, ipv4_pool, ipv4_gateway,
+                 ipv6=None, ipv6_pool=None, ipv6_gateway=None):
+        self.ipv4 = ipv4
+        self.ipv4_pool = ipv4_pool
+        self.ipv4_gateway = ipv4_gateway
+        self.ipv6 = ipv6
+        self.ipv6_pool = ipv6_pool
+        self.ipv6_gateway = ipv6_gateway
+
+
 class IPAMClient(DatastoreClient):
-    def assign_address(self, pool, address):
+
+    def __init__(self, *args, **kwargs):
+        super(IPAMClient, self).__init__(*args, **kwargs)
+        self._full_pool_recounts = {}
+        """The time get_free_ip_pools() last recounted each pool that looked
+        full."""
+
+    def assign_address(self, pool, address, handle=None):
         """
         Attempt to assign an IPAddress in a pool.
         Fails if the address is already assigned.
-        The directory for storing assignments in this pool must already exist.
 
         :param IPPool or IPNetwork pool: The pool that the assignment is from.
         :param IPAddress address: The address to assign.
+        :param handle: Optional allocation handle to record the address under.
 
         :return: True if the allocation succeeds, false otherwise. An
         exception is thrown for any error conditions.
@@ -93,22 +502,69 @@ class IPAMClient(DatastoreClient):
         assert isinstance(pool, IPNetwork)
         assert isinstance(address, IPAddress)
 
+        if self._legacy_assigned(pool, address):
+            # Assigned by a host that hasn't been upgraded, and not yet
+            # migrated into a block.
+            return False
+        if not self._assign_in_block(pool, address):
+            return False
+        if handle is not None:
+            self.add_to_handle(handle, pool, address)
+        return True
+
+    @handle_errors
+    def _legacy_assigned(self, pool, address):
+        """
+        Check whether an address has a per-address assignment key written by
+        an earlier version.
+
+        :param IPNetwork pool: The pool that the address is in.
+        :param IPAddress address: The address.
+        :return: True if the legacy key exists.
+        """
         key = IP_ASSIGNMENT_KEY % {"version": "v%s" % pool.version,
                                    "pool": str(pool).replace("/", "-"),
                                    "address": address}
         try:
-            self.etcd_client.write(key, "", prevExist=False)
-        except EtcdAlreadyExist:
+            self.etcd_client.read(key)
+        except EtcdKeyNotFound:
             return False
-        else:
-            return True
+        return True
+
+    def _assign_in_block(self, pool, address):
+        """
+        Mark an address as assigned in its allocation block.
+
+        :param IPNetwork pool: The pool that the address is in.
+        :param IPAddress address: The address to assign.
+        :return: True if the address was assigned, False if it was already
+        assigned.
+        """
+        block_cidr = _block_cidr(pool, address)
+        while True:
+            try:
+                block = self.read_block(pool, block_cidr)
+            except KeyError:
+                # Nobody has used this block yet, so create it without a host
+                # affinity.
+                block = AllocationBlock(block_cidr, pool)
+                block.assign(address)
+                if self._create_block(pool, block):
+                    return True
+                continue
 
-    def unassign_address(self, pool, address):
+            if not block.assign(address):
+                return False
+            if self.compare_and_swap_block(block):
+                return True
+
+    def unassign_address(self, pool, address, handle=None):
         """
         Unassign an IP from a pool.
 
         :param IPPool or IPNetwork pool: The pool that the assignment is from.
         :param IPAddress address: The address to unassign.
+        :param handle: Optional allocation handle to remove the address from.
 
         :return: True if the address was unassigned, false otherwise. An
         exception is thrown for any error conditions.
@@ -119,15 +575,275 @@ class IPAMClient(DatastoreClient):
         assert isinstance(pool, IPNetwork)
         assert isinstance(address, IPAddress)
 
-        key = IP_ASSIGNMENT_KEY % {"version": "v%s" % pool.version,
-                                   "pool": str(pool).replace("/", "-"),
-                                   "address": address}
+        unassigned = self._release_in_block(pool, address)
+        if handle is not None:
+            self.remove_from_handle(handle, address)
+        return unassigned
+
+    def _release_in_block(self, pool, address):
+        """
+        Mark an address as free in its allocation block.
+
+        :param IPNetwork pool: The pool that the address is in.
+        :param IPAddress address: The address to release.
+        :return: True if the address was released, False if it wasn't
+        assigned.
+        """
+        return bool(self._release_addresses_in_block(
+                                pool, _block_cidr(pool, address), [address]))
+
+    def _release_addresses_in_block(self, pool, block_cidr, addresses):
+        """
+        Mark a number of addresses as free in an allocation block, with a
+        single write.
+
+        :param IPNetwork pool: The pool that the block is in.
+        :param IPNetwork block_cidr: The block.
+        :param addresses: List of the IPAddresses in the block to release.
+        :return: List of the IPAddresses that were released, which excludes
+        any that weren't assigned.
+        """
+        while True:
+            try:
+                block = self.read_block(pool, block_cidr)
+            except KeyError:
+                return []
+            released = [address for address in addresses
+                        if block.release(address)]
+            if not released or self.compare_and_swap_block(block):
+                return released
+
+    def allocate_many(self, pools, count, handle=None):
+        """
+        Allocate a number of addresses at once.
+
+        Free addresses are picked from a single read of a pool's allocation
+        blocks, and each block that addresses are picked from is written once,
+        with the blocks written concurrently.  If another client updates one
+        of the blocks first, the addresses picked from it are picked again
+        from a fresh read of the pool.  Pools are used in order until enough
+        addresses have been allocated, skipping pools that have unmigrated
+        assignments (see get_legacy_pools()).
+
+        :param pools: The IPPool or IPNetwork to allocate from, or a list of
+        them.
+        :param count: The number of addresses to allocate.
+        :param handle: Optional allocation handle to record the addresses
+        under.
+        :return: List of the IPAddresses allocated.  This is shorter than
+        count if the pools don't have enough free addresses.  If writing a
+        block fails, the addresses already allocated are released before the
+        error is raised.
+        """
+        if isinstance(pools, (IPPool, IPNetwork)):
+            pools = [pools]
+
+        def claim(pool, block):
+            try:
+                return self._claim_block(pool, block)
+            except Exception as e:
+                return e
+
+        allocated = []
+        legacy_pools = {}
         try:
-            self.etcd_client.delete(key)
-        except EtcdKeyNotFound:
-            return False
+            for pool in pools:
+                if isinstance(pool, IPPool):
+                    pool = pool.cidr
+                assert isinstance(pool, IPNetwork)
+
+                version = "v%s" % pool.version
+                if version not in legacy_pools:
+                    legacy_pools[version] = self.get_legacy_pools(version)
+                if pool in legacy_pools[version]:
+                    _log.warning("Not allocating from pool %s, which has "
+                                 "unmigrated assignments", pool)
+                    continue
+
+                while len(allocated) < count:
+                    picks = self._pick_free(pool, count - len(allocated))
+                    if not picks:
+                        # The pool is full.
+                        break
+                    results = _run_concurrently(
+                        [(claim, (pool, block)) for block, _ in picks])
+                    for (_, addresses), claimed in zip(picks, results):
+                        if claimed is True:
+                            allocated.extend((pool, address)
+                                             for address in addresses)
+                    errors = [result for result in results
+                              if isinstance(result, Exception)]
+                    if errors:
+                        raise errors[0]
+        except Exception as e:
+            # Don't leak the addresses in the blocks that were written.
+            if allocated:
+                _log.warning("Releasing %d addresses after failing to "
+                             "allocate: %s", len(allocated), e)
+                self._release_allocated(allocated)
+            raise e
+
+        if handle is not None:
+            _run_concurrently(
+                [(self.add_to_handle, (handle, address_pool, address))
+                 for address_pool, address in allocated])
+        return [address for _, address in allocated]
+
+    def _release_allocated(self, allocated):
+        """
+        Release addresses allocated by allocate_many(), writing each of their
+        blocks once, with the blocks written concurrently.
+
+        :param allocated: List of (IPNetwork pool, IPAddress address) tuples.
+        """
+        by_block = {}
+        for pool, address in allocated:
+            by_block.setdefault((pool, _block_cidr(pool, address)),
+                                []).append(address)
+        _run_concurrently([(self._release_addresses_in_block,
+                            (pool, block_cidr, addresses))
+                           for (pool, block_cidr), addresses
+                           in by_block.iteritems()])
+
+    def allocate_dual_stack(self, hostname, handle, reserves=None):
+        """
+        Allocate an IPv4 address for an endpoint and, if the host has an IPv6
+        next hop, an IPv6 address, with the two allocations made
+        concurrently.  The host's next hops are read once for both.
+
+        Each address is taken from the host's reserve if there is one and it
+        isn't empty, or else from the pool with the most free addresses.  The
+        IPv6 address is best effort.  If no IPv4 address can be allocated, or
+        either allocation fails with an error, any address that was allocated
+        is released before returning or re-raising the error.
+
+        :param hostname: The host that the endpoint is on.
+        :param handle: The allocation handle to record the addresses under.
+        :param reserves: Optional dict of IP version ("v4" or "v6") to the
+        host's AddressReserve for that version.
+        :return: A DualStackAllocation, or None if no IPv4 address could be
+        allocated.
+        :raises KeyError: If the host has no IPv4 next hop.
+        """
+        next_hops = self.get_default_next_hops(hostname)
+        if 4 not in next_hops:
+            raise KeyError("No IPv4 address configured for host %s." %
+                           hostname)
+        versions = [version for version in (4, 6) if version in next_hops]
+        reserves = reserves or {}
+
+        def allocate(version):
+            try:
+                return self._allocate_for_host(hostname, version, handle,
+                                               reserves.get("v%d" % version))
+            except Exception as e:
+                return e
+
+        results = dict(zip(versions, _run_concurrently(
+                                [(allocate, (version,))
+                                 for version in versions])))
+        errors = [result for result in results.itervalues()
+                  if isinstance(result, Exception)]
+        if errors or results[4] is None:
+            for result in results.itervalues():
+                if result is not None and not isinstance(result, Exception):
+                    self._release_for_host(handle, result[0], result[1],
+                                           reserves)
+            if errors:
+                raise errors[0]
+            return None
+
+        allocation = DualStackAllocation(results[4][0], results[4][1],
+                                         next_hops[4])
+        if results.get(6) is not None:
+            allocation.ipv6, allocation.ipv6_pool = results[6]
+            allocation.ipv6_gateway = next_hops[6]
+        return allocation
+
+    def _allocate_for_host(self, hostname, version, handle, reserve):
+        """
+        Allocate an address from a host's reserve, or from the pool with the
+        most free addresses if the reserve is empty.
+
+        :param hostname: The host.
+        :param version: The IP version, 4 or 6.
+        :param handle: The allocation handle to record the address under.
+        :param reserve: The host's AddressReserve, or None.
+        :return: A tuple of the IPAddress allocated and the IPNetwork of its
+        pool, or None if no address could be allocated.
+        """
+        if reserve is not None:
+            reserved = reserve.pop()
+            if reserved is not None:
+                address, pool = reserved
+                self.add_to_handle(handle, pool, address)
+                return address, pool
+
+        # Large (IPv6) pools are assigned from at random, and others from the
+        # host's blocks.
+        for pool in self.get_free_ip_pools("v%d" % version):
+            assigner = RandomAssignment(hostname, self)
+            address = assigner.allocate(pool, handle=handle)
+            if address is not None:
+                return IPAddress(address), pool.cidr
+        return None
+
+    def _release_for_host(self, handle, address, pool, reserves):
+        """
+        Release an address allocated by _allocate_for_host(), returning it to
+        the host's reserve if the reserve isn't full.
+
+        :param handle: The allocation handle the address is recorded under.
+        :param IPAddress address: The address.
+        :param IPNetwork pool: The pool that the address is in.
+        :param reserves: Dict of IP version to the host's AddressReserve.
+        """
+        reserve = reserves.get("v%d" % address.version)
+        if reserve is not None and reserve.put(address, pool):
+            self.remove_from_handle(handle, address)
         else:
-            return True
+            self.unassign_address(pool, address, handle=handle)
+
+    def _pick_free(self, pool, count):
+        """
+        Pick free addresses from a pool, marking them as allocated in copies
+        of its blocks (which are not written).
+
+        :param IPNetwork pool: The pool.
+        :param count: The number of addresses wanted.
+        :return: List of (AllocationBlock, list of IPAddress) tuples, one for
+        each block that addresses were picked from.  Blocks that don't exist
+        yet are included, without a db_result.
+        """
+        blocks = dict((block.cidr, block)
+                      for block in self.get_allocation_blocks(pool))
+        prefixlen = max(BLOCK_PREFIXLEN[pool.version], pool.prefixlen)
+        picks = []
+        for block_cidr in pool.subnet(prefixlen):
+            if count == 0:
+                break
+            block = blocks.get(block_cidr) or AllocationBlock(block_cidr, pool)
+            addresses = []
+            while count > 0:
+                address = block.auto_assign()
+                if address is None:
+                    break
+                addresses.append(address)
+                count -= 1
+            if addresses:
+                picks.append((block, addresses))
+        return picks
+
+    def _claim_block(self, pool, block):
+        """
+        Write a block picked by _pick_free().
+
+        :return: True if the block was written, False if another client had
+        created or updated it.
+        """
+        if block.db_result is None:
+            return self._create_block(pool, block)
+        return self.compare_and_swap_block(block)
 
     def get_assigned_addresses(self, pool):
         """
@@ -139,17 +855,971 @@ class IPAMClient(DatastoreClient):
             pool = pool.cidr
         assert isinstance(pool, IPNetwork)
 
+        addresses = {}
+        for block in self.get_allocation_blocks(pool):
+            for address in block.allocated_addresses():
+                addresses[str(address)] = ""
+        return addresses
+
+    @handle_errors
+    def get_allocation_blocks(self, pool):
+        """
+        Get all of the allocation blocks in a pool, with a single read.
+
+        :param IPNetwork pool: The pool.
+        :return: List of AllocationBlock.
+        """
+        directory = IP_BLOCK_PATH % {"version": "v%s" % pool.version,
+                                     "pool": str(pool).replace("/", "-")}
+        try:
+            nodes = self.etcd_client.read(directory).children
+        except EtcdKeyNotFound:
+            return []
+
+        blocks = []
+        for node in nodes:
+            if not node.dir:
+                block = AllocationBlock.from_json(node.value, pool)
+                block.db_result = node
+                blocks.append(block)
+        return blocks
+
+    @handle_errors
+    def migrate_assignments(self, pool):
+        """
+        Convert the per-address assignment keys written by earlier versions
+        into allocation blocks, and remove the old keys.  This is safe to run
+        more than once.
+
+        :param IPPool or IPNetwork pool: The pool to migrate.
+        :return: The number of addresses migrated.
+        """
+        if isinstance(pool, IPPool):
+            pool = pool.cidr
+        assert isinstance(pool, IPNetwork)
+
+        legacy = self.get_legacy_assignments(pool)
+        if not legacy:
+            return 0
+
+        by_block = {}
+        for address in legacy:
+            by_block.setdefault(_block_cidr(pool, address),
+                                []).append(address)
+
+        for block_cidr, addresses in by_block.iteritems():
+            while True:
+                try:
+                    block = self.read_block(pool, block_cidr)
+                except KeyError:
+                    block = AllocationBlock(block_cidr, pool)
+                    for address in addresses:
+                        block.assign(address)
+                    if self._create_block(pool, block):
+                        break
+                    continue
+
+                for address in addresses:
+                    block.assign(address)
+                if self.compare_and_swap_block(block):
+                    break
+
+        directory = IP_ASSIGNMENT_PATH % {"version": "v%s" % pool.version,
+                                          "pool": str(pool).replace("/", "-")}
+        self.etcd_client.delete(directory, dir=True, recursive=True)
+        return len(legacy)
+
+    @handle_errors
+    def get_legacy_assignments(self, pool):
+        """
+        Get the addresses in a pool that have per-address assignment keys
+        written by earlier versions.
+
+        :param IPNetwork pool: The pool.
+        :return: List of IPAddress.
+        """
         directory = IP_ASSIGNMENT_PATH % {"version": "v%s" % pool.version,
                                           "pool": str(pool).replace("/", "-")}
         try:
             nodes = self.etcd_client.read(directory).children
         except EtcdKeyNotFound:
-            # Path doesn't exist so configure now.
-            self.etcd_client.write(directory, None, dir=True)
-            return {}
-        else:
-            addresses = {}
-            for child in nodes:
-                if not child.dir:
-                    addresses[child.key.split("/")[-1]] = ""
-            return addresses
+            return []
+        return [IPAddress(node.key.split("/")[-1])
+                for node in nodes if not node.dir]
+
+    @handle_errors
+    def get_legacy_pools(self, version):
+        """
+        Get the pools that still have per-address assignment keys written by
+        earlier versions.  The addresses in those keys aren't recorded in the
+        pool's blocks, so addresses aren't allocated from these pools
+        automatically until migrate_assignments() has been run on them, once
+        every host has been upgraded.
+
+        :param version: "v4" for IPv4, "v6" for IPv6
+        :return: Set of IPNetwork.
+        """
+        directory = IP_ASSIGNMENTS_PATH % {"version": version}
+        try:
+            leaves = self.etcd_client.read(directory, recursive=True).leaves
+        except EtcdKeyNotFound:
+            return set()
+
+        pools = set()
+        for leaf in leaves:
+            # Keys are .../assignment/<pool>/<address>.
+            parts = leaf.key.split("/assignment/", 1)[-1].split("/")
+            if not leaf.dir and len(parts) == 2:
+                pools.add(IPNetwork(parts[0].replace("-", "/")))
+        return pools
+
+    @handle_errors
+    def get_host_blocks(self, hostname, pool):
+        """
+        Get the blocks in a pool that have an affinity to a host.
+
+        :param hostname: The host.
+        :param IPNetwork pool: The pool.
+        :return: List of IPNetwork, one for each block.
+        """
+        directory = IP_HOST_AFFINITY_PATH % {
+                                    "version": "v%s" % pool.version,
+                                    "hostname": hostname,
+                                    "pool": str(pool).replace("/", "-")}
+        return self._read_block_keys(directory)
+
+    @handle_errors
+    def get_blocks(self, pool):
+        """
+        Get all of the blocks that have been claimed in a pool.
+
+        :param IPNetwork pool: The pool.
+        :return: List of IPNetwork, one for each block.
+        """
+        directory = IP_BLOCK_PATH % {"version": "v%s" % pool.version,
+                                     "pool": str(pool).replace("/", "-")}
+        return self._read_block_keys(directory)
+
+    def _read_block_keys(self, directory):
+        try:
+            nodes = self.etcd_client.read(directory).children
+        except EtcdKeyNotFound:
+            return []
+        return [IPNetwork(node.key.split("/")[-1].replace("-", "/"))
+                for node in nodes if not node.dir]
+
+    @handle_errors
+    def claim_block(self, hostname, pool):
+        """
+        Claim a block in a pool that no host has claimed, giving it an
+        affinity to a host.
+
+        :param hostname: The host claiming the block.
+        :param IPNetwork pool: The pool to claim a block from.
+        :return: The AllocationBlock claimed, or None if every block in the
+        pool has already been claimed.
+        """
+        existing = dict((block.cidr, block)
+                        for block in self.get_allocation_blocks(pool))
+        prefixlen = max(BLOCK_PREFIXLEN[pool.version], pool.prefixlen)
+        for block_cidr in pool.subnet(prefixlen):
+            block = existing.get(block_cidr)
+            if block is None:
+                block = AllocationBlock(block_cidr, pool,
+                                        host_affinity=hostname)
+                if not self._create_block(pool, block):
+                    # Another host claimed this block first.
+                    continue
+            elif block.host_affinity is None:
+                # The block was created by assigning a specific address.
+                block.host_affinity = hostname
+                if not self.compare_and_swap_block(block):
+                    continue
+            else:
+                continue
+
+            key = IP_HOST_AFFINITY_KEY % {
+                                    "version": "v%s" % pool.version,
+                                    "hostname": hostname,
+                                    "pool": str(pool).replace("/", "-"),
+                                    "block": str(block_cidr).replace("/", "-")}
+            self.etcd_client.write(key, "")
+            return block
+        return None
+
+    def _create_block(self, pool, block):
+        """
+        Write a new block to the datastore.
+
+        :param IPNetwork pool: The pool that the block is in.
+        :param AllocationBlock block: The block to write.
+        :return: True if the block was written, False if it already existed.
+        """
+        key = IP_BLOCK_KEY % {"version": "v%s" % pool.version,
+                              "pool": str(pool).replace("/", "-"),
+                              "block": str(block.cidr).replace("/", "-")}
+        try:
+            block.db_result = self.etcd_client.write(key,
+                                                     block.to_json(),
+                                                     prevExist=False)
+        except EtcdAlreadyExist:
+            return False
+        self._block_written(block)
+        return True
+
+    @handle_errors
+    def read_block(self, pool, block_cidr):
+        """
+        Read an allocation block from the datastore.  Raises KeyError if the
+        block does not exist.
+
+        :param IPNetwork pool: The pool that the block is in.
+        :param IPNetwork block_cidr: The CIDR of the block.
+        :return: An AllocationBlock object.
+        """
+        key = IP_BLOCK_KEY % {"version": "v%s" % pool.version,
+                              "pool": str(pool).replace("/", "-"),
+                              "block": str(block_cidr).replace("/", "-")}
+        try:
+            result = self.etcd_client.read(key)
+        except EtcdKeyNotFound:
+            raise KeyError("Block %s does not exist." % block_cidr)
+        block = AllocationBlock.from_json(result.value, pool)
+        block.db_result = result
+        return block
+
+    @handle_errors
+    def compare_and_swap_block(self, block):
+        """
+        Write an updated block back to the datastore, provided it has not been
+        modified since it was read.
+
+        :param AllocationBlock block: The block, as returned by read_block and
+        then updated.
+        :return: True if the block was written, False if it had been modified
+        by someone else.
+        """
+        try:
+            block.db_result = self.etcd_client.write(
+                                block.db_result.key,
+                                block.to_json(),
+                                prevIndex=block.db_result.modifiedIndex)
+        except ValueError:
+            # Compare failed.
+            return False
+        self._block_written(block)
+        return True
+
+    def _block_written(self, block):
+        """
+        Update the usage count of a block's pool after the block has been
+        written.
+
+        :param AllocationBlock block: The block that was written.
+        """
+        change = block.count() - _bit_count(block.db_allocations)
+        block.db_allocations = block.allocations
+        if not change:
+            return
+        try:
+            self._update_pool_usage(block.pool, change)
+        except (EtcdException, DataStoreError) as e:
+            # The block write stands, so the caller mustn't see an error.  The
+            # counter is corrected the next time the pool is recounted.
+            _log.warning("Failed to update the usage count of pool %s: %s",
+                         block.pool, e)
+
+    def _update_pool_usage(self, pool, change):
+        """
+        Add to the count of allocated addresses in a pool, using
+        compare-and-swap.
+
+        :param IPNetwork pool: The pool.
+        :param change: The number of addresses assigned (or, if negative,
+        released).
+        """
+        key = IP_USAGE_KEY % {"version": "v%s" % pool.version,
+                              "pool": str(pool).replace("/", "-")}
+        while True:
+            try:
+                result = self.etcd_client.read(key)
+            except EtcdKeyNotFound:
+                # The pool hasn't been counted yet.  Counting the blocks
+                # includes this change.
+                self.recount_pool_usage(pool)
+                return
+            try:
+                self.etcd_client.write(key, str(int(result.value) + change),
+                                       prevIndex=result.modifiedIndex)
+                return
+            except ValueError:
+                # Compare failed.  Re-read and try again.
+                pass
+
+    @handle_errors
+    def get_pool_usage(self, pool):
+        """
+        Get the number of allocated and free addresses in a pool, from the
+        pool's usage counter.
+
+        :param IPPool or IPNetwork pool: The pool.
+        :return: A tuple of the number of addresses allocated and the number
+        free.
+        """
+        if isinstance(pool, IPPool):
+            pool = pool.cidr
+        assert isinstance(pool, IPNetwork)
+
+        key = IP_USAGE_KEY % {"version": "v%s" % pool.version,
+                              "pool": str(pool).replace("/", "-")}
+        try:
+            allocated = int(self.etcd_client.read(key).value)
+        except EtcdKeyNotFound:
+            allocated = self.recount_pool_usage(pool)
+        return allocated, _pool_capacity(pool) - allocated
+
+    @handle_errors
+    def recount_pool_usage(self, pool):
+        """
+        Count the allocated addresses in a pool from its allocation blocks,
+        and store the count as the pool's usage counter.  The counter is
+        created this way the first time it is needed, and this can be used to
+        correct it if a client failed between updating a block and the
+        counter.
+
+        :param IPPool or IPNetwork pool: The pool.
+        :return: The number of addresses allocated.
+        """
+        if isinstance(pool, IPPool):
+            pool = pool.cidr
+        assert isinstance(pool, IPNetwork)
+
+        key = IP_USAGE_KEY % {"version": "v%s" % pool.version,
+                              "pool": str(pool).replace("/", "-")}
+        while True:
+            try:
+                result = self.etcd_client.read(key)
+            except EtcdKeyNotFound:
+                result = None
+            allocated = sum(block.count()
+                            for block in self.get_allocation_blocks(pool))
+            try:
+                if result is None:
+                    self.etcd_client.write(key, str(allocated),
+                                           prevExist=False)
+                else:
+                    self.etcd_client.write(key, str(allocated),
+                                           prevIndex=result.modifiedIndex)
+                return allocated
+            except (ValueError, EtcdAlreadyExist):
+                # The counter was updated while we were counting, so the
+                # count may be out of date.  Count again.
+                pass
+
+    @handle_errors
+    def get_ip_pools_usage(self, version):
+        """
+        Get the number of allocated and free addresses in each configured
+        pool, from the pools' usage counters.  Only the pools and the
+        counters are read.
+
+        :param version: "v4" for IPv4, "v6" for IPv6
+        :return: List of (IPPool, allocated, free) tuples.
+        """
+        pools = self.get_ip_pools(version)
+        directory = IP_USAGE_PATH % {"version": version}
+        try:
+            leaves = self.etcd_client.read(directory, recursive=True).leaves
+        except EtcdKeyNotFound:
+            leaves = []
+        counts = dict((leaf.key.split("/")[-1], int(leaf.value))
+                      for leaf in leaves if leaf.value)
+
+        usage = []
+        for pool in pools:
+            key = str(pool.cidr).replace("/", "-")
+            if key in counts:
+                allocated = counts[key]
+            else:
+                allocated = self.recount_pool_usage(pool.cidr)
+            usage.append((pool, allocated,
+                          _pool_capacity(pool.cidr) - allocated))
+        return usage
+
+    def get_free_ip_pools(self, version):
+        """
+        Get the configured pools that have free addresses, according to their
+        usage counters, with the pools that have the most free addresses
+        first.  Only the pools and the counters are read, so full pools are
+        skipped without reading their blocks, except that a pool that looks
+        full is recounted every FULL_POOL_RECOUNT_INTERVAL in case its counter
+        has drifted.  Pools with unmigrated assignments (see
+        get_legacy_pools()) are skipped.
+
+        :param version: "v4" for IPv4, "v6" for IPv6
+        :return: List of IPPool.
+        """
+        now = time.time()
+        legacy_pools = self.get_legacy_pools(version)
+        free_pools = []
+        for pool, _, free in self.get_ip_pools_usage(version):
+            if pool.cidr in legacy_pools:
+                _log.warning("Not allocating from pool %s, which has "
+                             "unmigrated assignments.  Run \"calicoctl ipam "
+                             "migrate\" once every host has been upgraded.",
+                             pool.cidr)
+                continue
+            last_recount = self._full_pool_recounts.get(pool.cidr)
+            due = (last_recount is None or
+                   now - last_recount >= FULL_POOL_RECOUNT_INTERVAL)
+            if free <= 0 and due:
+                self._full_pool_recounts[pool.cidr] = now
+                free = (_pool_capacity(pool.cidr) -
+                        self.recount_pool_usage(pool.cidr))
+            if free > 0:
+                free_pools.append((free, pool))
+
+        # Sort on the free count only; IPPools aren't ordered.
+        free_pools.sort(key=lambda item: item[0], reverse=True)
+        return [pool for _, pool in free_pools]
+
+    def get_host_usage(self, pool):
+        """
+        Get how much of a pool each host has claimed and allocated, from a
+        single read of the pool's blocks.  Each host assigns addresses from
+        its own blocks, trying them in turn, so hosts with many full blocks
+        or with free addresses spread across many blocks assign more slowly.
+
+        :param IPPool or IPNetwork pool: The pool.
+        :return: Dict of hostname (or None, for blocks without an affinity)
+        to a tuple of the number of blocks, the number of those blocks that
+        are full, the number of addresses allocated and the number of
+        addresses free in the blocks.
+        """
+        if isinstance(pool, IPPool):
+            pool = pool.cidr
+        assert isinstance(pool, IPNetwork)
+
+        usage = {}
+        for block in self.get_allocation_blocks(pool):
+            blocks, full, allocated, free = usage.get(block.host_affinity,
+                                                      (0, 0, 0, 0))
+            block_free = block.free_count()
+            usage[block.host_affinity] = (blocks + 1,
+                                          full + (block_free == 0),
+                                          allocated + block.count(),
+                                          free + block_free)
+        return usage
+
+    @handle_errors
+    def add_to_handle(self, handle, pool, address):
+        """
+        Record an assigned address under an allocation handle, such as the ID
+        of the endpoint or container that the address is assigned to.
+
+        :param handle: The allocation handle.
+        :param IPPool or IPNetwork pool: The pool that the address is in.
+        :param IPAddress address: The address.
+        """
+        if isinstance(pool, IPPool):
+            pool = pool.cidr
+        key = IP_HANDLE_KEY % {"handle": handle, "address": address}
+        self.etcd_client.write(key, str(pool))
+
+    @handle_errors
+    def remove_from_handle(self, handle, address):
+        """
+        Remove an address from an allocation handle.  The address is not
+        unassigned.
+
+        :param handle: The allocation handle.
+        :param IPAddress address: The address.
+        :return: True if the address was removed, False if it wasn't in the
+        handle.
+        """
+        key = IP_HANDLE_KEY % {"handle": handle, "address": address}
+        try:
+            self.etcd_client.delete(key)
+        except EtcdKeyNotFound:
+            return False
+        return True
+
+    @handle_errors
+    def get_handle(self, handle):
+        """
+        Get the addresses recorded under an allocation handle.
+
+        :param handle: The allocation handle.
+        :return: List of (IPNetwork pool, IPAddress address) tuples, empty if
+        the handle doesn't exist.
+        """
+        directory = IP_HANDLE_PATH % {"handle": handle}
+        try:
+            nodes = self.etcd_client.read(directory).children
+        except EtcdKeyNotFound:
+            return []
+        return [(IPNetwork(node.value), IPAddress(node.key.split("/")[-1]))
+                for node in nodes if not node.dir]
+
+    @handle_errors
+    def remove_handle(self, handle):
+        """
+        Remove an allocation handle.  Its addresses are not unassigned.
+
+        :param handle: The allocation handle.
+        """
+        directory = IP_HANDLE_PATH % {"handle": handle}
+        try:
+            self.etcd_client.delete(directory, dir=True, recursive=True)
+        except EtcdKeyNotFound:
+            pass
+
+    @handle_errors
+    def release_by_handle(self, handle):
+        """
+        Unassign all of the addresses recorded under an allocation handle, and
+        remove the handle.  This reads only the handle and the blocks of its
+        addresses.
+
+        :param handle: The allocation handle.
+        :return: List of the IPAddresses that were unassigned.
+        """
+        released = [address for pool, address in self.get_handle(handle)
+                    if self._release_in_block(pool, address)]
+        self.remove_handle(handle)
+        return released
+
+    @handle_errors
+    def get_reserved_addresses(self, hostname, version):
+        """
+        Get the addresses in a host's reserve.
+
+        :param hostname: The host.
+        :param version: "v4" for IPv4, "v6" for IPv6
+        :return: List of (IPAddress address, IPNetwork pool) tuples.
+        """
+        directory = IP_RESERVE_PATH % {"version": version,
+                                       "hostname": hostname}
+        try:
+            nodes = self.etcd_client.read(directory).children
+        except EtcdKeyNotFound:
+            return []
+        return [(IPAddress(node.key.split("/")[-1]), IPNetwork(node.value))
+                for node in nodes if not node.dir]
+
+    @handle_errors
+    def reserve_address(self, hostname, address, pool):
+        """
+        Add an assigned address to a host's reserve.
+
+        :param hostname: The host.
+        :param IPAddress address: The address.
+        :param IPNetwork pool: The pool that the address is in.
+        """
+        key = IP_RESERVE_KEY % {"version": "v%s" % address.version,
+                                "hostname": hostname,
+                                "address": address}
+        self.etcd_client.write(key, str(pool))
+
+    @handle_errors
+    def unreserve_address(self, hostname, address):
+        """
+        Remove an address from a host's reserve.  The address remains
+        assigned.
+
+        :param hostname: The host.
+        :param IPAddress address: The address.
+        :return: True if the address was removed, False if it wasn't in the
+        reserve.
+        """
+        key = IP_RESERVE_KEY % {"version": "v%s" % address.version,
+                                "hostname": hostname,
+                                "address": address}
+        try:
+            self.etcd_client.delete(key)
+        except EtcdKeyNotFound:
+            return False
+        return True
+
+    @handle_errors
+    def release_leaked_addresses(self, dry_run=False, grace=GC_GRACE_PERIOD):
+        """
+        Find the addresses in the configured pools that are assigned but not
+        in use, and release them.  Addresses leak if a host is removed
+        without removing its endpoints, or a client fails between assigning
+        an address and writing the endpoint.
+
+        An address is in use if it belongs to an endpoint, or is in the
+        reserve of a host that still exists.  The endpoints are read one host
+        at a time and only their addresses are kept, so the memory used grows
+        with the number of addresses in use, not the size of the endpoints.
+
+        To allow for endpoints that are being created, the unused addresses
+        are only released if they are still unused after the grace period.
+        The leaked addresses in each block are released with a single write,
+        and the blocks are written concurrently.  The addresses are then
+        removed from their allocation handles.  Finally, hosts that have been
+        removed (both before and after the grace period) are removed from
+        IPAM: their blocks lose their affinity, so that other hosts can claim
+        them, blocks left empty are deleted, and their reserves are removed.
+
+        :param dry_run: If True, find the leaked addresses without waiting
+        for the grace period or releasing them.
+        :param grace: How long (seconds) to wait before checking again that
+        the addresses are unused.
+        :return: List of (IPNetwork pool, IPAddress address) tuples for the
+        addresses that were released (or, for a dry run, that are leaked).
+        """
+        hostnames = self.get_hostnames()
+        unused = self._find_unused_addresses(hostnames)
+        removed = dict((version, self._get_ipam_hostnames(version) - hostnames)
+                       for version in ("v4", "v6"))
+        if dry_run or not (unused or any(removed.itervalues())):
+            return unused
+
+        time.sleep(grace)
+        hostnames = self.get_hostnames()
+        in_use = self._get_addresses_in_use(hostnames)
+        by_block = {}
+        for pool, address in unused:
+            if int(address) not in in_use[address.version]:
+                by_block.setdefault((pool, _block_cidr(pool, address)),
+                                    []).append(address)
+        del in_use
+
+        blocks = by_block.keys()
+        results = _run_concurrently(
+                [(self._release_addresses_in_block,
+                  (pool, block_cidr, by_block[(pool, block_cidr)]))
+                 for pool, block_cidr in blocks])
+        released = [(pool, address)
+                    for (pool, _), addresses in zip(blocks, results)
+                    for address in addresses]
+        _log.info("Released %d leaked addresses", len(released))
+
+        self._remove_from_handles(set(address for _, address in released))
+        for version, removed_hostnames in removed.iteritems():
+            for hostname in removed_hostnames - hostnames:
+                self._remove_ipam_host(hostname, version)
+        return released
+
+    def _remove_ipam_host(self, hostname, version):
+        """
+        Release the block affinities of a host that has been removed, and
+        remove its reserve.
+
+        :param hostname: The removed host.
+        :param version: "v4" for IPv4, "v6" for IPv6
+        """
+        directory = IP_HOSTS_PATH % {"version": version} + hostname
+        try:
+            leaves = self.etcd_client.read(directory, recursive=True).leaves
+        except EtcdKeyNotFound:
+            return
+
+        for leaf in leaves:
+            # Affinity keys are .../host/<hostname>/<pool>/<block>.
+            parts = leaf.key.split("/")
+            if leaf.dir or len(parts) != 9 or parts[7] == "reserved":
+                continue
+            self._release_block_affinity(
+                                IPNetwork(parts[7].replace("-", "/")),
+                                IPNetwork(parts[8].replace("-", "/")),
+                                hostname)
+
+        try:
+            self.etcd_client.delete(directory, dir=True, recursive=True)
+        except EtcdKeyNotFound:
+            pass
+        _log.info("Removed host %s from %s IPAM", hostname, version)
+
+    def _release_block_affinity(self, pool, block_cidr, hostname):
+        """
+        Remove a host's affinity from a block, or delete the block if none of
+        its addresses are assigned.
+
+        :param IPNetwork pool: The pool that the block is in.
+        :param IPNetwork block_cidr: The block.
+        :param hostname: The host that the block has an affinity to.
+        """
+        while True:
+            try:
+                block = self.read_block(pool, block_cidr)
+            except KeyError:
+                return
+            if block.host_affinity != hostname:
+                return
+
+            if block.count():
+                block.host_affinity = None
+                if self.compare_and_swap_block(block):
+                    return
+                continue
+
+            try:
+                self.etcd_client.delete(
+                                block.db_result.key,
+                                prevIndex=block.db_result.modifiedIndex)
+                return
+            except EtcdKeyNotFound:
+                return
+            except ValueError:
+                # Compare failed, so an address has been assigned meanwhile.
+                continue
+
+    def _find_unused_addresses(self, hostnames):
+        """
+        Find the assigned addresses in the configured pools that aren't in
+        use by the given hosts.
+
+        :param hostnames: The hosts that exist.
+        :return: List of (IPNetwork pool, IPAddress address) tuples.
+        """
+        in_use = self._get_addresses_in_use(hostnames)
+        unused = []
+        for version in ("v4", "v6"):
+            for pool in self.get_ip_pools(version):
+                for block in self.get_allocation_blocks(pool.cidr):
+                    unused.extend((pool.cidr, address)
+                                  for address in block.allocated_addresses()
+                                  if int(address) not in
+                                  in_use[address.version])
+        return unused
+
+    def _get_addresses_in_use(self, hostnames):
+        """
+        Get the addresses of the endpoints on a number of hosts, and in the
+        hosts' reserves, reading one host at a time.
+
+        :param hostnames: The hosts.
+        :return: Dict of IP version (4 or 6) to the set of addresses in use,
+        as integers.
+        """
+        in_use = {4: set(), 6: set()}
+        for hostname in hostnames:
+            for endpoint in self.iter_endpoints(hostname=hostname):
+                for net in endpoint.ipv4_nets:
+                    in_use[4].add(net.value)
+                for net in endpoint.ipv6_nets:
+                    in_use[6].add(net.value)
+            for version in ("v4", "v6"):
+                for address, _ in self.get_reserved_addresses(hostname,
+                                                              version):
+                    in_use[address.version].add(int(address))
+        return in_use
+
+    def _get_ipam_hostnames(self, version):
+        """
+        Get the names of the hosts that have block affinities or a reserve.
+
+        :param version: "v4" for IPv4, "v6" for IPv6
+        :return: Set of hostnames.
+        """
+        directory = IP_HOSTS_PATH % {"version": version}
+        try:
+            nodes = self.etcd_client.read(directory).children
+        except EtcdKeyNotFound:
+            return set()
+        return set(node.key.split("/")[6] for node in nodes
+                   if len(node.key.split("/")) > 6)
+
+    def _remove_from_handles(self, addresses):
+        """
+        Remove released addresses from the allocation handles that they were
+        recorded under.  Handles that are left empty are removed.
+
+        :param addresses: Set of the IPAddresses that were released.
+        """
+        if not addresses:
+            return
+        try:
+            leaves = self.etcd_client.read(IP_HANDLES_PATH,
+                                           recursive=True).leaves
+        except EtcdKeyNotFound:
+            return
+
+        sizes = {}
+        stale = {}
+        for leaf in leaves:
+            packed = leaf.key.split("/")
+            if leaf.dir or len(packed) < 7:
+                continue
+            handle = packed[5]
+            sizes[handle] = sizes.get(handle, 0) + 1
+            address = IPAddress(packed[6])
+            if address in addresses:
+                stale.setdefault(handle, []).append(address)
+
+        calls = []
+        for handle, stale_addresses in stale.iteritems():
+            if len(stale_addresses) == sizes[handle]:
+                calls.append((self.remove_handle, (handle,)))
+            else:
+                calls.extend((self.remove_from_handle, (handle, address))
+                             for address in stale_addresses)
+        _run_concurrently(calls)
+
+
+class AddressReserve(object):
+    """
+    A small reserve of addresses that have already been assigned for a host,
+    so that they can be handed out without reading or writing allocation
+    blocks.
+
+    The reserved addresses are recorded in the datastore under the host's
+    IPAM tree, so they survive a restart.  A background thread, started by
+    the first call to pop(), tops the reserve up to its target size.
+    Addresses that are released can be put back in the reserve rather than
+    being unassigned.
+    """
+
+    def __init__(self, hostname, version, size, client=None):
+        """
+        Constructor.
+        :param hostname: The host to reserve addresses for.
+        :param version: "v4" for IPv4, "v6" for IPv6
+        :param size: The number of addresses to keep in the reserve.
+        :param client: The IPAMClient to use.  If not specified, a new client
+        is created.
+        """
+        assert version in ("v4", "v6")
+        self.hostname = hostname
+        self.version = version
+        self.size = size
+        self.client = client or IPAMClient()
+
+        self._lock = threading.Lock()
+        self._addresses = None
+        """Deque of the reserved (IPAddress, IPNetwork pool) tuples, or None
+        if they haven't been loaded from the datastore yet."""
+
+        self._wanted = threading.Event()
+        self._refiller = None
+
+    def pop(self):
+        """
+        Take an address from the reserve.
+
+        :return: A tuple of the IPAddress and the IPNetwork of its pool, or
+        None if the reserve is empty.
+        """
+        if not self.size:
+            return None
+        self._start()
+        with self._lock:
+            self._load()
+            entry = self._addresses.popleft() if self._addresses else None
+        self._wanted.set()
+        if entry is None:
+            return None
+
+        # Remove the address from the stored reserve before it's used, so
+        # it can't be handed out again after a restart.
+        try:
+            self.client.unreserve_address(self.hostname, entry[0])
+        except DataStoreError as e:
+            _log.warning("Failed to take %s from the reserve: %s",
+                         entry[0], e)
+            with self._lock:
+                self._addresses.appendleft(entry)
+            return None
+        return entry
+
+    def put(self, address, pool):
+        """
+        Return a released address to the reserve, if it isn't full.
+
+        :param IPAddress address: The address, which must still be assigned.
+        :param IPNetwork pool: The pool that the address is in.
+        :return: True if the address was added to the reserve, False if it
+        should be unassigned instead.
+        """
+        if isinstance(pool, IPPool):
+            pool = pool.cidr
+        entry = (address, pool)
+        with self._lock:
+            self._load()
+            if len(self._addresses) >= self.size:
+                return False
+            self._addresses.append(entry)
+
+        try:
+            self.client.reserve_address(self.hostname, address, pool)
+        except DataStoreError as e:
+            _log.warning("Failed to return %s to the reserve: %s", address, e)
+            with self._lock:
+                self._addresses.remove(entry)
+            return False
+        return True
+
+    def refill(self):
+        """
+        Assign addresses until the reserve is full, or the pools are.
+        Addresses from pools that have since been removed are dropped from
+        the reserve.
+        """
+        pools = set(pool.cidr for pool in
+                    self.client.get_ip_pools(self.version))
+        with self._lock:
+            self._load()
+            stale = [entry for entry in self._addresses
+                     if entry[1] not in pools]
+            for entry in stale:
+                self._addresses.remove(entry)
+            count = len(self._addresses)
+
+        for address, _ in stale:
+            self.client.unreserve_address(self.hostname, address)
+
+        free_pools = self.client.get_free_ip_pools(self.version)
+        assigner = RandomAssignment(self.hostname, self.client)
+        while count < self.size:
+            address = None
+            for pool in free_pools:
+                address = assigner.allocate(pool)
+                if address is not None:
+                    break
+            if address is None:
+                _log.warning("No %s addresses available to reserve",
+                             self.version)
+                return
+
+            address = IPAddress(address)
+            self.client.reserve_address(self.hostname, address, pool.cidr)
+            with self._lock:
+                self._addresses.append((address, pool.cidr))
+                count = len(self._addresses)
+
+    def _load(self):
+        """
+        Load the reserve from the datastore, if that hasn't been done yet.
+        Must be called with the lock held.
+        """
+        if self._addresses is None:
+            self._addresses = deque(
+                    self.client.get_reserved_addresses(self.hostname,
+                                                       self.version))
+
+    def _start(self):
+        """
+        Start the thread that refills the reserve.  This is idempotent.
+        """
+        with self._lock:
+            if self._refiller is None:
+                self._refiller = threading.Thread(target=self._refill_loop,
+                                                  name="ip-reserve-%s" %
+                                                       self.version)
+                self._refiller.daemon = True
+                self._refiller.start()
+
+    def _refill_loop(self):
+        while True:
+            self._wanted.wait()
+            self._wanted.clear()
+            try:
+                self.refill()
+            except DataStoreError as e:
+                _log.warning("Failed to refill the %s reserve: %s",
+                             self.version, e)
+                time.sleep(RESERVE_RETRY_DELAY)
+                self._wanted.set()
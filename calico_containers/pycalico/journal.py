@@ -0,0 +1,249 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from pycalico.datastore import _run_concurrently, WRITE_BATCH_THREADS
+
+_log = logging.getLogger(__name__)
+
+RETRY_DELAY = 5
+"""How long (seconds) to wait before retrying an entry that failed."""
+
+SUFFIX = ".json"
+
+
+class Journal(object):
+    """
+    A durable queue of work, such as tearing down endpoints, that is done by a
+    background thread after the request for it has returned.
+
+    Each entry is a JSON file in the journal's directory, written atomically,
+    so entries that haven't been done when the process stops are done by the
+    next process to recover() the journal.  The thread does up to batch_size
+    entries at once, oldest first, and retries entries that fail after
+    retry_delay.
+    """
+
+    def __init__(self, directory, handler, batch_size=WRITE_BATCH_THREADS,
+                 retry_delay=RETRY_DELAY):
+        """
+        Constructor.
+        :param directory: The directory to keep the entries in.  It is created
+        when the first entry is recorded.
+        :param handler: The function that does an entry's work, called with
+        the entry's name and data.  It returns True if the work is done, or
+        False if it should be retried.  It can record its progress with
+        update().
+        :param batch_size: The number of entries to do at once.
+        :param retry_delay: How long (seconds) to wait before retrying an
+        entry that failed.
+        """
+        self.directory = directory
+        self.handler = handler
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        """Maps the name of each entry that hasn't been done to its data,
+        oldest first."""
+        self._retry_times = {}
+        """The time each entry that failed can be retried."""
+        self._generations = {}
+        """How many times each entry has been recorded, so that an entry that
+        is recorded again while it is being done isn't removed."""
+
+        self._wanted = threading.Event()
+        self._worker = None
+
+    def record(self, name, data):
+        """
+        Add an entry, replacing any entry with the same name, and wake the
+        background thread to do it.  The entry is on disk when this returns.
+
+        :param name: The name of the entry, which must be usable as a file
+        name.
+        :param data: The entry's data, which must be serializable as JSON.
+        """
+        with self._lock:
+            self._write(name, data)
+            self._entries.pop(name, None)
+            self._entries[name] = data
+            self._retry_times.pop(name, None)
+            self._generations[name] = self._generations.get(name, 0) + 1
+        self.start()
+        self._wanted.set()
+
+    def update(self, name, data):
+        """
+        Replace the data of an entry, to record the progress of its work.
+        """
+        self._write(name, data)
+        with self._lock:
+            if name in self._entries:
+                self._entries[name] = data
+
+    def recover(self):
+        """
+        Load the entries left in the journal's directory, and start the
+        background thread to do them.
+
+        :return: The number of entries loaded.
+        """
+        try:
+            file_names = os.listdir(self.directory)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return 0
+
+        entries = []
+        for file_name in file_names:
+            if not file_name.endswith(SUFFIX):
+                # Includes temporary files left by an interrupted write.
+                continue
+            path = os.path.join(self.directory, file_name)
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except ValueError:
+                _log.error("Discarding unreadable journal entry %s", path)
+                os.remove(path)
+                continue
+            entries.append((os.path.getmtime(path),
+                            file_name[:-len(SUFFIX)], data))
+
+        with self._lock:
+            for _, name, data in sorted(entries):
+                self._entries.setdefault(name, data)
+        if entries:
+            _log.info("Recovered %d entries from %s", len(entries),
+                      self.directory)
+            self.start()
+            self._wanted.set()
+        return len(entries)
+
+    def pending(self):
+        """
+        :return: The number of entries that haven't been done.
+        """
+        with self._lock:
+            return len(self._entries)
+
+    def start(self):
+        """
+        Start the background thread that does the entries.  This is
+        idempotent.
+        """
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._work_loop,
+                                                name="journal")
+                self._worker.daemon = True
+                self._worker.start()
+
+    def do_batch(self):
+        """
+        Do a batch of the entries that are due, at once.
+
+        :return: The number of entries attempted.
+        """
+        now = time.time()
+        with self._lock:
+            batch = [(name, data, self._generations.get(name, 0))
+                     for name, data in self._entries.iteritems()
+                     if self._retry_times.get(name, 0) <= now]
+        batch = batch[:self.batch_size]
+        if not batch:
+            return 0
+
+        results = _run_concurrently([(self._do_entry, (name, data))
+                                     for name, data, _ in batch])
+        retry_time = time.time() + self.retry_delay
+        with self._lock:
+            for (name, _, generation), done in zip(batch, results):
+                if self._generations.get(name, 0) != generation:
+                    # Recorded again meanwhile, so do it again.
+                    continue
+                if done:
+                    del self._entries[name]
+                    self._retry_times.pop(name, None)
+                    self._generations.pop(name, None)
+                    self._remove(name)
+                else:
+                    self._retry_times[name] = retry_time
+        return len(batch)
+
+    def _do_entry(self, name, data):
+        try:
+            return self.handler(name, data)
+        except Exception:
+            _log.exception("Failed to do journal entry %s", name)
+            return False
+
+    def _work_loop(self):
+        while True:
+            self._wanted.wait(self.retry_delay)
+            self._wanted.clear()
+            try:
+                while self.do_batch():
+                    pass
+            except Exception:
+                _log.exception("Failed to do journal entries")
+
+    def _path(self, name):
+        return os.path.join(self.directory, name + SUFFIX)
+
+    def _write(self, name, data):
+        """
+        Write an entry to disk atomically, by writing a temporary file and
+        renaming it.
+        """
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        temp_path = os.path.join(self.directory, "." + name + ".tmp")
+        with open(temp_path, "w") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_path, self._path(name))
+        self._sync_directory()
+
+    def _remove(self, name):
+        try:
+            os.remove(self._path(name))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        self._sync_directory()
+
+    def _sync_directory(self):
+        """
+        Make sure a rename or removal in the directory is on disk.
+        """
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
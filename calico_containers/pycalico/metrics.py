@@ -0,0 +1,243 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Counters, gauges and histograms that can be reported in the Prometheus text
+format, for monitoring long-lived processes such as the libnetwork plugin.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from pycalico import datastore_stats
+from pycalico.datastore_stats import LATENCY_BUCKETS
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+"""The content type of the Prometheus text format."""
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n") \
+        .replace('"', '\\"')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, _escape(value))
+                             for name, value in zip(names, values))
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric(object):
+    """
+    A metric, with a value for each combination of values of its labels.
+    """
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        """
+        Constructor.
+        :param name: The name of the metric.
+        :param documentation: A description of the metric.
+        :param labels: The names of the metric's labels.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def samples(self):
+        """
+        Get the samples of the metric.
+        :return: List of (name, label names, label values, value) tuples.
+        """
+        with self._lock:
+            return [(self.name, self.labels, label_values, value)
+                    for label_values, value in sorted(self._values.items())]
+
+    def format(self):
+        """
+        Format the metric in the Prometheus text format.
+        """
+        lines = ["# HELP %s %s" % (self.name, self.documentation),
+                 "# TYPE %s %s" % (self.name, self.type)]
+        for name, label_names, label_values, value in self.samples():
+            lines.append("%s%s %s" % (name,
+                                      _format_labels(label_names,
+                                                     label_values),
+                                      _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+class Counter(_Metric):
+    """
+    A count that only goes up.
+    """
+    type = "counter"
+
+    def inc(self, *label_values, **kwargs):
+        """
+        Add to the count for the given label values.
+        :param amount: The amount to add (default 1).
+        """
+        amount = kwargs.get("amount", 1)
+        with self._lock:
+            self._values[label_values] = \
+                self._values.get(label_values, 0) + amount
+
+
+class Gauge(_Metric):
+    """
+    A value that can go up and down.
+    """
+    type = "gauge"
+
+    def inc(self, *label_values):
+        with self._lock:
+            self._values[label_values] = \
+                self._values.get(label_values, 0) + 1
+
+    def dec(self, *label_values):
+        with self._lock:
+            self._values[label_values] = \
+                self._values.get(label_values, 0) - 1
+
+
+class Histogram(_Metric):
+    """
+    A histogram of observed values, such as latencies.
+    """
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=LATENCY_BUCKETS):
+        """
+        Constructor.
+        :param buckets: The upper bounds of the buckets, in increasing order.
+        """
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        """
+        Add an observed value for the given label values.
+        """
+        with self._lock:
+            counts, total = self._values.get(
+                label_values, ([0] * (len(self.buckets) + 1), 0))
+            bucket = 0
+            while bucket < len(self.buckets) and value > self.buckets[bucket]:
+                bucket += 1
+            counts[bucket] += 1
+            self._values[label_values] = (counts, total + value)
+
+    @contextmanager
+    def time(self, *label_values):
+        """
+        Context manager that observes how long (seconds) its block takes.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, *label_values)
+
+    def samples(self):
+        with self._lock:
+            values = [(label_values, list(counts), total)
+                      for label_values, (counts, total)
+                      in sorted(self._values.items())]
+        return _histogram_samples(self.name, self.labels, self.buckets,
+                                  values)
+
+
+def _histogram_samples(name, labels, buckets, values):
+    """
+    Get the samples of a histogram.
+    :param values: List of (label values, count in each bucket, sum)
+    tuples, where the last bucket holds the values above all the bounds.
+    """
+    samples = []
+    bounds = list(buckets) + [float("inf")]
+    for label_values, counts, total in values:
+        cumulative = 0
+        for bound, count in zip(bounds, counts):
+            cumulative += count
+            samples.append((name + "_bucket", labels + ("le",),
+                            label_values + (_format_value(bound),),
+                            cumulative))
+        samples.append((name + "_count", labels, label_values, cumulative))
+        samples.append((name + "_sum", labels, label_values, total))
+    return samples
+
+
+class DatastoreMetrics(object):
+    """
+    Reports the statistics of datastore calls kept by datastore_stats as
+    metrics, labelled by the method called.
+    """
+
+    def format(self):
+        stats = sorted(datastore_stats.get_stats().items())
+        metrics = [
+            ("calico_datastore_calls_total", "counter",
+             "Calls to each datastore method.", "calls"),
+            ("calico_datastore_errors_total", "counter",
+             "Calls to each datastore method that raised an error.",
+             "errors"),
+            ("calico_datastore_etcd_requests_total", "counter",
+             "etcd requests made by calls to each datastore method.",
+             "etcd_requests"),
+            ("calico_datastore_cas_failures_total", "counter",
+             "Failed compare-and-swaps, which are retried, in calls to each "
+             "datastore method.", "cas_failures"),
+        ]
+        lines = []
+        for name, type, documentation, field in metrics:
+            lines.append("# HELP %s %s" % (name, documentation))
+            lines.append("# TYPE %s %s" % (name, type))
+            for method, op in stats:
+                lines.append('%s{method="%s"} %s' % (
+                    name, method, _format_value(op[field])))
+
+        name = "calico_datastore_call_duration_seconds"
+        lines.append("# HELP %s How long calls to each datastore method "
+                     "took." % name)
+        lines.append("# TYPE %s histogram" % name)
+        samples = _histogram_samples(
+            name, ("method",), LATENCY_BUCKETS,
+            [((method,), op["histogram"], op["total_time"])
+             for method, op in stats])
+        for sample_name, label_names, label_values, value in samples:
+            lines.append("%s%s %s" % (sample_name,
+                                      _format_labels(label_names,
+                                                     label_values),
+                                      _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+def format_metrics(metrics):
+    """
+    Format metrics in the Prometheus text format.
+    :param metrics: List of metrics, each with a format() method.
+    :return: The text.
+    """
+    return "".join(metric.format() for metric in metrics)
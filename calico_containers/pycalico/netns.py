@@ -14,6 +14,7 @@
 #    under the License.
 
 from subprocess import call, check_output, check_call
+import ctypes
 import socket
 import logging
 import logging.handlers
@@ -24,11 +25,18 @@ import uuid
 
 from netaddr import IPNetwork, IPAddress
 
+try:
+    from pyroute2 import IPRoute, NetlinkError
+except ImportError:
+    IPRoute = None
+
 from pycalico.datastore import IF_PREFIX
 from pycalico.datastore_datatypes import Endpoint, VETH_NAME
 
 _log = logging.getLogger(__name__)
 
+_libc = ctypes.CDLL(None, use_errno=True)
+
 HOSTNAME = socket.gethostname()
 
 ROOT_NETNS = "1"
@@ -43,6 +51,15 @@ PROC_ALIAS = "/proc_host"
 """The alias for /proc.  This is useful when the filesystem is containerized.
 """
 
+NETLINK_AVAILABLE = IPRoute is not None
+"""Whether interfaces are configured over netlink, in-process.  If pyroute2
+isn't installed, we fall back to running `ip` commands."""
+
+ADDRESS_FAMILY = {4: socket.AF_INET, 6: socket.AF_INET6}
+
+CLONE_NEWNET = 0x40000000
+RT_SCOPE_LINK = 253
+
 
 def setup_logging(logfile):
     _log.setLevel(logging.DEBUG)
@@ -119,6 +136,7 @@ def set_up_endpoint(ip, hostname, orchestrator_id, workload_id, cpid, next_hop_i
                     mac=None):
     """
     Set up an endpoint (veth) in the network namespace identified by the PID.
+    This uses netlink if pyroute2 is installed, and `ip` commands otherwise.
 
     :param ip: The IP address to assign to the endpoint (veth) as Netaddr
     IPAddress.
@@ -143,6 +161,40 @@ def set_up_endpoint(ip, hostname, orchestrator_id, workload_id, cpid, next_hop_i
     iface = IF_PREFIX + ep_id[:11]
     iface_tmp = "tmp" + ep_id[:11]
 
+    next_hop = next_hop_ips[ip.version]
+    if NETLINK_AVAILABLE:
+        mac = _set_up_veth_netlink(iface, iface_tmp, veth_name, mac, ip,
+                                   next_hop, cpid, proc_alias)
+    else:
+        mac = _set_up_veth_ip(iface, iface_tmp, veth_name, mac, ip,
+                              next_hop, cpid, proc_alias)
+
+    # Return an Endpoint.
+    network = IPNetwork(IPAddress(ip))
+    ep = Endpoint(hostname=hostname,
+                  orchestrator_id=orchestrator_id,
+                  workload_id=workload_id,
+                  endpoint_id=ep_id,
+                  state="active",
+                  mac=mac)
+    ep.if_name = veth_name
+    if network.version == 4:
+        ep.ipv4_nets.add(network)
+        ep.ipv4_gateway = next_hop
+    else:
+        ep.ipv6_nets.add(network)
+        ep.ipv6_gateway = next_hop
+    return ep
+
+
+def _set_up_veth_ip(iface, iface_tmp, veth_name, mac, ip, next_hop, cpid,
+                    proc_alias):
+    """
+    Create a veth, move one end into a namespace and configure it, using `ip`
+    commands.
+
+    :return: The MAC address of the interface in the namespace.
+    """
     # Provision the networking.  We create a temporary link from the proc
     # alias to the /var/run/netns to provide a named namespace.  If we don't
     # do this, when run from the calico-node container the PID of the
@@ -174,7 +226,6 @@ def set_up_endpoint(ip, hostname, orchestrator_id, workload_id, cpid, next_hop_i
 
     with NamedNamespace(cpid, proc=proc_alias) as ns:
         # Connected route to next hop & default route.
-        next_hop = next_hop_ips[ip.version]
         ns.check_call("ip -%(version)s route replace"
                       " %(next_hop)s dev %(device)s" %
                       {"version": ip.version,
@@ -193,22 +244,119 @@ def set_up_endpoint(ip, hostname, orchestrator_id, workload_id, cpid, next_hop_i
                 "ip link show %s | grep ether | awk '{print $2}'" %
                 (veth_name), shell=True).strip()
 
-    # Return an Endpoint.
-    network = IPNetwork(IPAddress(ip))
-    ep = Endpoint(hostname=hostname,
-                  orchestrator_id=orchestrator_id,
-                  workload_id=workload_id,
-                  endpoint_id=ep_id,
-                  state="active",
-                  mac=mac)
-    ep.if_name = veth_name
-    if network.version == 4:
-        ep.ipv4_nets.add(network)
-        ep.ipv4_gateway = next_hop
-    else:
-        ep.ipv6_nets.add(network)
-        ep.ipv6_gateway = next_hop
-    return ep
+    return mac
+
+
+def _set_up_veth_netlink(iface, iface_tmp, veth_name, mac, ip, next_hop,
+                         cpid, proc_alias):
+    """
+    Create a veth, move one end into a namespace and configure it, over
+    netlink.  Only one switch into the namespace is needed, to open a netlink
+    socket there, and no processes are forked.
+
+    :return: The MAC address of the interface in the namespace.
+    """
+    pid_dir = "%s/%s/ns/net" % (proc_alias, cpid)
+    if not os.path.exists(pid_dir):
+        raise NamespaceError("Namespace pseudofile %s does not exist." %
+                             pid_dir)
+    ns_fd = os.open(pid_dir, os.O_RDONLY)
+    host = IPRoute()
+    container = None
+    try:
+        container = _netlink_socket(ns_fd)
+
+        # Create the veth pair and move one end into container:
+        host.link("add", ifname=iface, kind="veth", peer=iface_tmp)
+        host.link("set", index=host.link_lookup(ifname=iface)[0],
+                  state="up")
+        host.link("set", index=host.link_lookup(ifname=iface_tmp)[0],
+                  net_ns_fd=ns_fd)
+
+        index = container.link_lookup(ifname=iface_tmp)[0]
+        if mac:
+            container.link("set", index=index, ifname=veth_name,
+                           address=str(mac))
+        else:
+            container.link("set", index=index, ifname=veth_name)
+        container.link("set", index=index, state="up")
+
+        # Add an IP address.
+        family = ADDRESS_FAMILY[ip.version]
+        container.addr("add", index=index, address=str(ip),
+                       mask=PREFIX_LEN[ip.version], family=family)
+
+        # Connected route to next hop & default route.
+        container.route("replace", dst=str(next_hop),
+                        dst_len=PREFIX_LEN[ip.version], oif=index,
+                        scope=RT_SCOPE_LINK, family=family)
+        container.route("replace", gateway=str(next_hop), oif=index,
+                        family=family)
+
+        # Get the MAC address.
+        return container.get_links(index)[0].get_attr("IFLA_ADDRESS")
+    except NetlinkError as e:
+        raise NamespaceError("Failed to set up %s: %s" % (iface, e))
+    finally:
+        host.close()
+        if container:
+            container.close()
+        os.close(ns_fd)
+
+
+def _netlink_socket(ns_fd):
+    """
+    Open a netlink socket in a network namespace.  The socket stays in the
+    namespace it was created in, so only the calling thread switches into the
+    namespace, and only while the socket is opened.
+
+    :param ns_fd: A file descriptor for the namespace.
+    :return: An IPRoute.
+    """
+    own_fd = os.open("/proc/self/ns/net", os.O_RDONLY)
+    try:
+        _setns(ns_fd)
+        try:
+            return IPRoute()
+        finally:
+            _setns(own_fd)
+    finally:
+        os.close(own_fd)
+
+
+def _setns(fd):
+    """
+    Move the calling thread into a network namespace.
+    :param fd: A file descriptor for the namespace.
+    """
+    if _libc.setns(fd, CLONE_NEWNET) != 0:
+        err = ctypes.get_errno()
+        raise NamespaceError("Failed to switch namespace: %s" %
+                             os.strerror(err))
+
+
+def create_veth(iface, peer, peer_mac=None):
+    """
+    Create a veth pair in this namespace over netlink, setting the first end
+    up.  Only available when NETLINK_AVAILABLE is True.
+
+    :param iface: The name of the end to set up.
+    :param peer: The name of the other end.
+    :param peer_mac: The MAC address to give the other end, or None to
+    auto assign one.
+    :return: None.  Raises NamespaceError on error.
+    """
+    ip = IPRoute()
+    try:
+        ip.link("add", ifname=iface, kind="veth", peer=peer)
+        ip.link("set", index=ip.link_lookup(ifname=iface)[0], state="up")
+        if peer_mac:
+            ip.link("set", index=ip.link_lookup(ifname=peer)[0],
+                    address=str(peer_mac))
+    except NetlinkError as e:
+        raise NamespaceError("Failed to create veth %s: %s" % (iface, e))
+    finally:
+        ip.close()
 
 
 def reinstate_endpoint(cpid, old_endpoint, next_hop_ips,
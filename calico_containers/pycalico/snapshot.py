@@ -0,0 +1,234 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A point-in-time copy of all of the Calico data in etcd.
+
+Commands that show a lot of data, such as `calicoctl profile show --detailed`,
+would otherwise make a request for each profile or endpoint.  A Snapshot is
+loaded with a single recursive read of /calico/v1 and parsed once, and then
+answers the same queries as the DatastoreClient from memory.  It is not
+updated once loaded, so it should only be used for reads.
+"""
+import json
+
+from etcd import EtcdKeyNotFound
+from netaddr import IPNetwork
+
+from pycalico.datastore import CALICO_V_PATH, handle_errors
+from pycalico.datastore_datatypes import BGPPeer, Endpoint, IPPool, Profile, \
+    Rules
+from pycalico.ipam import AllocationBlock
+
+
+class Snapshot(object):
+    """
+    All of the Calico data, parsed into:
+     - hosts: dict of hostname to a dict of the host's "bird_ip" and
+       "bird6_ip" (either may be missing).
+     - endpoints: list of Endpoint.
+     - profiles: dict of name to Profile.
+     - ip_pools: dict of "v4" or "v6" to a list of IPPool.
+     - bgp_peers: dict of "v4" or "v6" to a list of the global BGPPeers.
+     - host_bgp_peers: dict of hostname to a dict of "v4" or "v6" to a list
+       of the host's BGPPeers.
+     - blocks: dict of pool CIDR (IPNetwork) to a list of AllocationBlock.
+    """
+
+    def __init__(self):
+        self.etcd_index = None
+        self.hosts = {}
+        self.endpoints = []
+        self.profiles = {}
+        self.ip_pools = {"v4": [], "v6": []}
+        self.bgp_peers = {"v4": [], "v6": []}
+        self.host_bgp_peers = {}
+        self.blocks = {}
+
+    @classmethod
+    @handle_errors
+    def load(cls, client):
+        """
+        Load a snapshot with a single read of the datastore.
+
+        :param client: The DatastoreClient to read with.
+        :return: A Snapshot.
+        """
+        snapshot = cls()
+        try:
+            result = client.etcd_client.read(CALICO_V_PATH, recursive=True)
+        except EtcdKeyNotFound:
+            return snapshot
+
+        snapshot.etcd_index = result.etcd_index
+        for node in result.leaves:
+            snapshot._add_node(node)
+        return snapshot
+
+    def _add_node(self, node):
+        """
+        Parse a single leaf from the recursive read.
+
+        :param node: The EtcdResult for a key, or for an empty directory.
+        """
+        parts = node.key[len(CALICO_V_PATH):].strip("/").split("/")
+        if len(parts) < 2:
+            return
+
+        if parts[0] == "host":
+            self._add_host_node(parts[1], parts[2:], node)
+        elif parts[0] == "policy" and parts[1] == "profile" and \
+                len(parts) > 2:
+            profile = self.profiles.setdefault(parts[2], Profile(parts[2]))
+            if len(parts) == 4 and node.value:
+                if parts[3] == "tags":
+                    profile.tags = set(json.loads(node.value))
+                elif parts[3] == "rules":
+                    profile.rules = Rules.from_json(node.value)
+        elif parts[0] == "config" and parts[1].startswith("bgp_peer_") and \
+                len(parts) == 3 and node.value:
+            version = parts[1][len("bgp_peer_"):]
+            self.bgp_peers.setdefault(version, []).append(
+                                            BGPPeer.from_json(node.value))
+        elif parts[0] == "ipam" and len(parts) > 3 and node.value:
+            version = parts[1]
+            if parts[2] == "pool" and len(parts) == 4:
+                self.ip_pools.setdefault(version, []).append(
+                                            IPPool.from_json(node.value))
+            elif parts[2] == "block" and len(parts) == 5:
+                pool = IPNetwork(parts[3].replace("-", "/"))
+                block = AllocationBlock.from_json(node.value, pool)
+                block.db_result = node
+                self.blocks.setdefault(pool, []).append(block)
+
+    def _add_host_node(self, hostname, parts, node):
+        host = self.hosts.setdefault(hostname, {})
+        if not parts or node.dir:
+            return
+
+        if parts[0] in ("bird_ip", "bird6_ip") and len(parts) == 1:
+            host[parts[0]] = node.value
+        elif parts[0] == "workload":
+            endpoint = Endpoint.from_json(node.key, node.value)
+            if endpoint:
+                self.endpoints.append(endpoint)
+        elif parts[0].startswith("bgp_peer_") and len(parts) == 2 and \
+                node.value:
+            version = parts[0][len("bgp_peer_"):]
+            peers = self.host_bgp_peers.setdefault(hostname, {})
+            peers.setdefault(version, []).append(BGPPeer.from_json(node.value))
+
+    def get_host_ips(self, hostname):
+        """
+        :param hostname: The hostname.
+        :return: A tuple containing the IPv4 and IPv6 address.
+        """
+        host = self.hosts.get(hostname, {})
+        try:
+            return (host["bird_ip"], host["bird6_ip"])
+        except KeyError:
+            raise KeyError("BIRD configuration for host %s not found." %
+                           hostname)
+
+    def get_ip_pools(self, version):
+        """
+        :param version: "v4" for IPv4, "v6" for IPv6
+        :return: List of IPPool.
+        """
+        assert version in ("v4", "v6")
+        return list(self.ip_pools.get(version, []))
+
+    def get_bgp_peers(self, version, hostname=None):
+        """
+        :param version: "v4" for IPv4, "v6" for IPv6
+        :param hostname: Optional hostname.  If supplied, this returns the
+        node-specific BGP peers.  If None, this returns the globally configured
+        BGP peers.
+        :return: List of BGPPeer.
+        """
+        assert version in ("v4", "v6")
+        if hostname is None:
+            return list(self.bgp_peers.get(version, []))
+        return list(self.host_bgp_peers.get(hostname, {}).get(version, []))
+
+    def get_profile_names(self):
+        """
+        :return: a set of profile names
+        """
+        return set(self.profiles)
+
+    def get_profile(self, name):
+        """
+        :param name: The name of the profile.
+        :return: A Profile object.
+        """
+        try:
+            return self.profiles[name]
+        except KeyError:
+            raise KeyError("%s is not a configured profile." % name)
+
+    def get_profile_members(self, profile_name):
+        """
+        :param profile_name: Unique string name of the profile.
+        :return: a list of Endpoint objects.
+        """
+        return [endpoint for endpoint in self.endpoints
+                if profile_name in endpoint.profile_ids]
+
+    def get_all_profile_members(self):
+        """
+        :return: a dict of profile name to a list of Endpoint objects.  Only
+        profiles with members are included.
+        """
+        members = {}
+        for endpoint in self.endpoints:
+            for profile_name in endpoint.profile_ids:
+                members.setdefault(profile_name, []).append(endpoint)
+        return members
+
+    def get_endpoints(self, hostname=None, orchestrator_id=None,
+                      workload_id=None, endpoint_id=None):
+        """
+        :param hostname: The hostname that the endpoint lives on.
+        :param orchestrator_id: The orchestrator that the endpoint belongs to.
+        :param workload_id: The workload that the endpoint belongs to.
+        :param endpoint_id: The ID of the endpoint
+        :return: A list of Endpoint Objects which match the criteria, or an
+        empty list if none match
+        """
+        return [endpoint for endpoint in self.endpoints
+                if endpoint.matches(hostname=hostname,
+                                    orchestrator_id=orchestrator_id,
+                                    workload_id=workload_id,
+                                    endpoint_id=endpoint_id)]
+
+    def get_allocation_blocks(self, pool):
+        """
+        :param IPNetwork pool: The pool.
+        :return: List of AllocationBlock.
+        """
+        if isinstance(pool, IPPool):
+            pool = pool.cidr
+        return list(self.blocks.get(pool, []))
+
+    def get_assigned_addresses(self, pool):
+        """
+        :param IPPool or IPNetwork pool: The pool to get assignments for.
+        :return: The assigned addresses from the pool
+        :rtype dict of [str, str]
+        """
+        addresses = {}
+        for block in self.get_allocation_blocks(pool):
+            for address in block.allocated_addresses():
+                addresses[str(address)] = ""
+        return addresses
@@ -0,0 +1,194 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from etcd import Client as EtcdClient
+from etcd import EtcdKeyNotFound, EtcdResult
+from mock import Mock
+from nose.tools import *
+
+from pycalico.datastore_cache import CachingEtcdClient
+
+ROOT = "/calico/v1"
+POOL_PATH = ROOT + "/ipam/v4/pool"
+POOL_KEY = POOL_PATH + "/192.168.0.0-16"
+POOL_JSON = '{"cidr": "192.168.0.0/16"}'
+
+
+def etcd_result(action, node, etcd_index=10):
+    result = EtcdResult(action, node)
+    result.etcd_index = etcd_index
+    return result
+
+
+class TestCachingEtcdClient(unittest.TestCase):
+
+    def setUp(self):
+        self.etcd_client = Mock(spec=EtcdClient)
+        self.cache = CachingEtcdClient(self.etcd_client, ROOT)
+        self.cache.start = Mock()
+
+        # Prime the cache with a single pool.
+        self.etcd_client.read.return_value = etcd_result("get", {
+            "key": ROOT, "dir": True, "modifiedIndex": 1, "createdIndex": 1,
+            "nodes": [{"key": ROOT + "/ipam", "dir": True,
+                       "modifiedIndex": 2, "createdIndex": 2,
+                       "nodes": [{"key": ROOT + "/ipam/v4", "dir": True,
+                                  "modifiedIndex": 2, "createdIndex": 2,
+                                  "nodes": [{"key": POOL_PATH, "dir": True,
+                                             "modifiedIndex": 2,
+                                             "createdIndex": 2,
+                                             "nodes": [{"key": POOL_KEY,
+                                                        "value": POOL_JSON,
+                                                        "modifiedIndex": 3,
+                                                        "createdIndex": 3}]
+                                             }]}]}]})
+        self.cache._load()
+        self.etcd_client.read.reset_mock()
+
+    def test_load(self):
+        """
+        Test that the cache is primed with a single recursive read.
+        """
+        assert_true(self.cache.synced)
+        assert_equal(self.cache.read(POOL_KEY).value, POOL_JSON)
+        leaves = list(self.cache.read(POOL_PATH + "/", recursive=True).leaves)
+        assert_equal([leaf.value for leaf in leaves], [POOL_JSON])
+        assert_false(self.etcd_client.read.called)
+
+    def test_read_missing(self):
+        """
+        Test reading a key that isn't in the cache raises EtcdKeyNotFound.
+        """
+        assert_raises(EtcdKeyNotFound, self.cache.read, ROOT + "/missing")
+        assert_false(self.etcd_client.read.called)
+
+    def test_read_not_cached(self):
+        """
+        Test reads outside the cached tree go to etcd.
+        """
+        self.cache.read("/other")
+        self.etcd_client.read.assert_called_once_with("/other")
+
+    def test_read_before_load(self):
+        """
+        Test reads go to etcd until the cache is primed.
+        """
+        cache = CachingEtcdClient(self.etcd_client, ROOT)
+        cache.start = Mock()
+        cache.read(POOL_KEY)
+        self.etcd_client.read.assert_called_once_with(POOL_KEY)
+
+    def test_write_through(self):
+        """
+        Test writes go to etcd and are visible to subsequent reads.
+        """
+        key = ROOT + "/host/TEST_HOST/bird_ip"
+        self.etcd_client.write.return_value = etcd_result(
+            "set", {"key": key, "value": "1.2.3.4",
+                    "modifiedIndex": 11, "createdIndex": 11})
+        self.cache.write(key, "1.2.3.4")
+        self.etcd_client.write.assert_called_once_with(key, "1.2.3.4")
+        assert_equal(self.cache.read(key).value, "1.2.3.4")
+        assert_true(self.cache.read(ROOT + "/host/TEST_HOST").dir)
+
+    def test_write_compare_failed(self):
+        """
+        Test a failed compare-and-swap refreshes the key from etcd.
+        """
+        self.etcd_client.write.side_effect = ValueError
+        self.etcd_client.read.return_value = etcd_result(
+            "get", {"key": POOL_KEY, "value": "new",
+                    "modifiedIndex": 12, "createdIndex": 3})
+        assert_raises(ValueError, self.cache.write, POOL_KEY, "newer",
+                      prevIndex=3)
+        assert_equal(self.cache.read(POOL_KEY).value, "new")
+
+    def test_delete(self):
+        """
+        Test deletes are applied to the cache, and that older events for the
+        deleted key are ignored.
+        """
+        self.etcd_client.delete.return_value = etcd_result(
+            "delete", {"key": POOL_PATH, "modifiedIndex": 13,
+                       "createdIndex": 2})
+        self.cache.delete(POOL_PATH, dir=True, recursive=True)
+        assert_raises(EtcdKeyNotFound, self.cache.read, POOL_KEY)
+
+        self.cache._handle_event(etcd_result(
+            "set", {"key": POOL_KEY, "value": POOL_JSON,
+                    "modifiedIndex": 12, "createdIndex": 3}))
+        assert_raises(EtcdKeyNotFound, self.cache.read, POOL_KEY)
+
+    def test_watched_delete_older_than_write(self):
+        """
+        Test a watched delete doesn't remove a node that was written after
+        it.
+        """
+        self.etcd_client.write.return_value = etcd_result(
+            "set", {"key": POOL_KEY, "value": "new",
+                    "modifiedIndex": 20, "createdIndex": 20})
+        self.cache.write(POOL_KEY, "new")
+        self.cache._handle_event(etcd_result(
+            "delete", {"key": POOL_PATH, "dir": True, "modifiedIndex": 13,
+                       "createdIndex": 2}))
+        assert_equal(self.cache.read(POOL_KEY).value, "new")
+        assert_true(self.cache.read(POOL_PATH).dir)
+
+    def test_watched_delete_before_write_result(self):
+        """
+        Test a write result older than a delete that the watcher has already
+        handled doesn't bring the deleted node back.
+        """
+        def write(key, value):
+            # The watcher sees a delete made by another client after our
+            # write, before our write's result is applied.
+            self.cache._handle_event(etcd_result(
+                "delete", {"key": POOL_KEY, "modifiedIndex": 21,
+                           "createdIndex": 20}))
+            return etcd_result("set", {"key": POOL_KEY, "value": "new",
+                                       "modifiedIndex": 20,
+                                       "createdIndex": 20})
+        self.etcd_client.write.side_effect = write
+        self.cache.write(POOL_KEY, "new")
+        assert_raises(EtcdKeyNotFound, self.cache.read, POOL_KEY)
+        # Nothing older than the delete is in flight any more.
+        assert_equal(self.cache._tombstones, {})
+
+    def test_handle_events(self):
+        """
+        Test set and delete events from the watcher update the cache.
+        """
+        key = POOL_PATH + "/10.0.0.0-8"
+        self.cache._handle_event(etcd_result(
+            "create", {"key": key, "value": "{}",
+                       "modifiedIndex": 14, "createdIndex": 14}))
+        assert_equal(self.cache.read(key).value, "{}")
+        assert_equal(self.cache._index, 14)
+
+        self.cache._handle_event(etcd_result(
+            "delete", {"key": key, "modifiedIndex": 15, "createdIndex": 14}))
+        assert_raises(EtcdKeyNotFound, self.cache.read, key)
+        assert_equal(len(list(self.cache.read(POOL_PATH).leaves)), 1)
+
+    def test_delete_parent(self):
+        """
+        Test deleting a parent of the cached tree empties the cache.
+        """
+        self.cache._handle_event(etcd_result(
+            "delete", {"key": "/calico", "dir": True,
+                       "modifiedIndex": 16, "createdIndex": 1}))
+        assert_raises(EtcdKeyNotFound, self.cache.read, POOL_KEY)
+        assert_raises(EtcdKeyNotFound, self.cache.read, ROOT)
@@ -0,0 +1,222 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import unittest
+
+from etcd import Client as EtcdClient
+from etcd import EtcdAlreadyExist, EtcdEventIndexCleared, EtcdException, \
+    EtcdKeyNotFound, EtcdNotFile
+from mock import Mock, patch
+from nose.tools import *
+
+from pycalico.datastore_cluster import ClusterEtcdClient, \
+    MEMBER_RETRY_DELAY, _member_failed
+
+try:
+    from etcd import EtcdConnectionFailed
+except ImportError:
+    # python-etcd before 0.4 raises EtcdException itself.
+    class EtcdConnectionFailed(EtcdException):
+        pass
+
+MEMBERS = [("10.0.0.1", 2379), ("10.0.0.2", 2379), ("10.0.0.3", 2379)]
+KEY = "/calico/v1/Ready"
+
+
+def stats_response(state):
+    response = Mock()
+    response.data = json.dumps({"name": "member", "state": state})
+    return response
+
+
+class TestClusterEtcdClient(unittest.TestCase):
+
+    @patch("pycalico.datastore_cluster.etcd.Client", autospec=True)
+    def setUp(self, m_etcd_client):
+        self.members = []
+        for host, port in MEMBERS:
+            member = Mock(spec=EtcdClient)
+            member.http = Mock()
+            member._read_options = set(["recursive", "wait"])
+            member.version_prefix = "/v2"
+            member._MGET = "GET"
+            member.base_uri = "http://%s:%d" % (host, port)
+            member.api_execute.return_value = stats_response("StateFollower")
+            self.members.append(member)
+        m_etcd_client.side_effect = iter(self.members)
+        self.client = ClusterEtcdClient(MEMBERS)
+
+    def test_shared_pool(self):
+        """
+        Test that the members share a connection pool and can make quorum
+        reads.
+        """
+        for member in self.members:
+            assert_equal(member.http, self.client.http)
+            assert_in("quorum", member._read_options)
+
+    def test_read_round_robin(self):
+        """
+        Test that reads are spread across the members and are quorum reads.
+        """
+        for _ in range(6):
+            self.client.read(KEY)
+        for member in self.members:
+            assert_equal(member.read.call_count, 2)
+            member.read.assert_called_with(KEY, quorum=True)
+
+    def test_read_no_quorum(self):
+        """
+        Test that watches and reads when quorum reads are turned off aren't
+        quorum reads.
+        """
+        self.client.read(KEY, wait=True, waitIndex=10)
+        self.members[0].read.assert_called_once_with(KEY, wait=True,
+                                                     waitIndex=10)
+        self.client.quorum_reads = False
+        self.client.read(KEY)
+        self.members[1].read.assert_called_once_with(KEY)
+
+    @patch("pycalico.datastore_cluster.time.time", autospec=True)
+    def test_read_member_failed(self, m_time):
+        """
+        Test that a read that a member fails is retried on the next member,
+        and that the member is skipped until MEMBER_RETRY_DELAY has passed.
+        """
+        m_time.return_value = 100
+        self.members[0].read.side_effect = EtcdException(
+            "No more machines in the cluster")
+        assert_equal(self.client.read(KEY),
+                     self.members[1].read.return_value)
+
+        for _ in range(4):
+            self.client.read(KEY)
+        assert_equal(self.members[0].read.call_count, 1)
+        assert_equal(self.members[1].read.call_count, 3)
+        assert_equal(self.members[2].read.call_count, 2)
+
+        m_time.return_value = 100 + MEMBER_RETRY_DELAY
+        self.members[0].read.side_effect = None
+        for _ in range(3):
+            self.client.read(KEY)
+        assert_equal(self.members[0].read.call_count, 2)
+
+    def test_read_connection_failed(self):
+        """
+        Test that a read is retried on the next member if the connection to
+        the member fails, as python-etcd 0.4 reports it.
+        """
+        self.members[0].read.side_effect = EtcdConnectionFailed(
+            "Connection to etcd failed")
+        assert_equal(self.client.read(KEY),
+                     self.members[1].read.return_value)
+        self.client.read(KEY)
+        self.client.read(KEY)
+        assert_equal(self.members[0].read.call_count, 1)
+
+    def test_member_failed(self):
+        """
+        Test which errors mean that the member failed.
+        """
+        assert_true(_member_failed(EtcdConnectionFailed("Failed")))
+        assert_true(_member_failed(EtcdException("No more machines")))
+        assert_true(_member_failed(Exception("Raft Internal Error")))
+        assert_false(_member_failed(EtcdKeyNotFound()))
+        assert_false(_member_failed(EtcdAlreadyExist()))
+        assert_false(_member_failed(EtcdNotFile()))
+        assert_false(_member_failed(ValueError("Compare failed")))
+        assert_false(_member_failed(EtcdEventIndexCleared()))
+
+    def test_read_all_failed(self):
+        """
+        Test that a read fails if every member fails it.
+        """
+        for member in self.members:
+            member.read.side_effect = EtcdException("Failed")
+        assert_raises(EtcdException, self.client.read, KEY)
+        for member in self.members:
+            assert_equal(member.read.call_count, 1)
+
+    def test_read_key_error(self):
+        """
+        Test that errors about the key aren't retried on other members.
+        """
+        self.members[0].read.side_effect = EtcdKeyNotFound()
+        assert_raises(EtcdKeyNotFound, self.client.read, KEY)
+        assert_false(self.members[1].read.called)
+
+    def test_write_leader(self):
+        """
+        Test that writes and deletes go to the leader, which is looked up
+        once.
+        """
+        self.members[2].api_execute.return_value = \
+            stats_response("StateLeader")
+        self.client.write(KEY, "true", prevExist=False)
+        self.client.delete(KEY)
+        self.members[2].write.assert_called_once_with(KEY, "true",
+                                                      prevExist=False)
+        self.members[2].delete.assert_called_once_with(KEY)
+        for member in self.members:
+            assert_equal(member.api_execute.call_count, 1)
+            member.api_execute.assert_called_once_with("/v2/stats/self",
+                                                       "GET")
+        assert_false(self.members[0].write.called)
+
+    def test_write_leader_failed(self):
+        """
+        Test that a write that the leader fails is not retried, and that the
+        leader is looked up again for the next write.
+        """
+        self.members[0].api_execute.return_value = \
+            stats_response("StateLeader")
+        self.members[0].write.side_effect = EtcdException("Failed")
+        assert_raises(EtcdException, self.client.write, KEY, "true")
+
+        self.members[0].api_execute.return_value = \
+            stats_response("StateFollower")
+        self.members[1].api_execute.return_value = \
+            stats_response("StateLeader")
+        self.client.write(KEY, "true")
+        self.members[1].write.assert_called_once_with(KEY, "true")
+        assert_equal(self.members[0].write.call_count, 1)
+
+    def test_write_connection_failed(self):
+        """
+        Test that the leader is looked up again after the connection to it
+        fails.
+        """
+        self.members[0].api_execute.return_value = \
+            stats_response("StateLeader")
+        self.members[0].write.side_effect = EtcdConnectionFailed("Failed")
+        assert_raises(EtcdConnectionFailed, self.client.write, KEY, "true")
+        self.members[0].api_execute.return_value = \
+            stats_response("StateFollower")
+        self.members[1].api_execute.return_value = \
+            stats_response("StateLeader")
+        self.client.write(KEY, "true")
+        self.members[1].write.assert_called_once_with(KEY, "true")
+
+    def test_write_no_leader(self):
+        """
+        Test that writes go to any member if none of them says it's the
+        leader, and that the lookup isn't repeated for every write.
+        """
+        self.client.write(KEY, "true")
+        self.client.write(KEY, "true")
+        assert_equal(sum(member.write.call_count
+                         for member in self.members), 2)
+        for member in self.members:
+            assert_equal(member.api_execute.call_count, 1)
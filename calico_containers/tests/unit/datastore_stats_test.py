@@ -0,0 +1,152 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from etcd import Client as EtcdClient
+from etcd import EtcdException
+from mock import ANY, Mock, patch
+from nose.tools import *
+
+from pycalico.datastore import handle_errors, _run_concurrently
+from pycalico.datastore_errors import DataStoreError
+from pycalico.datastore_stats import count_etcd_requests, format_stats, \
+    get_stats, reset_stats, LATENCY_BUCKETS
+
+
+class FakeClient(object):
+
+    def __init__(self):
+        self.etcd_client = Mock(spec=EtcdClient)
+        self.api_execute = self.etcd_client.api_execute
+        self.api_execute.return_value = Mock()
+        count_etcd_requests(self.etcd_client)
+
+    @handle_errors
+    def read_keys(self, count):
+        for _ in range(count):
+            self.etcd_client.api_execute("/v2/keys/key", "GET")
+
+    @handle_errors
+    def read_twice(self):
+        self.read_keys(1)
+        self.read_keys(1)
+
+    @handle_errors
+    def read_concurrently(self, count):
+        _run_concurrently([(self.etcd_client.api_execute,
+                            ("/v2/keys/key", "GET"))] * count)
+
+    @handle_errors
+    def swap(self, failures):
+        self.api_execute.side_effect = iter(
+            [ValueError("Compare failed")] * failures + [Mock()])
+        for _ in range(failures + 1):
+            try:
+                return self.etcd_client.api_execute("/v2/keys/key", "PUT",
+                                                    params={"prevIndex": 1})
+            except ValueError:
+                pass
+
+    @handle_errors
+    def fail(self):
+        raise EtcdException("Failed")
+
+
+class TestDatastoreStats(unittest.TestCase):
+
+    def setUp(self):
+        reset_stats()
+        self.client = FakeClient()
+
+    def tearDown(self):
+        reset_stats()
+
+    @patch("pycalico.datastore_stats.time.time", autospec=True)
+    def test_calls(self, m_time):
+        """
+        Test the calls, latency and etcd requests of a method are recorded.
+        """
+        m_time.side_effect = iter([10, 10.003, 20, 20.2])
+        self.client.read_keys(2)
+        self.client.read_keys(3)
+        stats = get_stats()["read_keys"]
+        assert_equal(stats["calls"], 2)
+        assert_equal(stats["errors"], 0)
+        assert_almost_equal(stats["total_time"], 0.203)
+        assert_almost_equal(stats["max_time"], 0.2)
+        assert_equal(stats["etcd_requests"], 5)
+        histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+        histogram[LATENCY_BUCKETS.index(0.005)] = 1
+        histogram[LATENCY_BUCKETS.index(0.25)] = 1
+        assert_equal(stats["histogram"], histogram)
+
+    def test_nested_calls(self):
+        """
+        Test the requests of nested calls are counted for both methods.
+        """
+        self.client.read_twice()
+        stats = get_stats()
+        assert_equal(stats["read_twice"]["calls"], 1)
+        assert_equal(stats["read_twice"]["etcd_requests"], 2)
+        assert_equal(stats["read_keys"]["calls"], 2)
+        assert_equal(stats["read_keys"]["etcd_requests"], 2)
+
+    def test_concurrent_requests(self):
+        """
+        Test requests made from the threads of a batch are counted for the
+        method that made the batch.
+        """
+        self.client.read_concurrently(20)
+        assert_equal(get_stats()["read_concurrently"]["etcd_requests"], 20)
+
+    def test_cas_failures(self):
+        """
+        Test failed compare-and-swaps are counted.
+        """
+        self.client.swap(2)
+        stats = get_stats()["swap"]
+        assert_equal(stats["etcd_requests"], 3)
+        assert_equal(stats["cas_failures"], 2)
+
+    def test_errors(self):
+        """
+        Test calls that raise an error are counted, after the error has been
+        converted by handle_errors.
+        """
+        assert_raises(DataStoreError, self.client.fail)
+        assert_equal(get_stats()["fail"]["errors"], 1)
+
+    @patch("pycalico.datastore_stats._log", autospec=True)
+    @patch("pycalico.datastore_stats.time.time", autospec=True)
+    def test_slow_calls(self, m_time, m_log):
+        """
+        Test calls slower than slow_call_threshold are logged.
+        """
+        m_time.side_effect = iter([10, 10.5, 20, 21.5])
+        with patch("pycalico.datastore_stats.slow_call_threshold", 1):
+            self.client.read_keys(1)
+            assert_false(m_log.warning.called)
+            self.client.read_keys(1)
+        m_log.warning.assert_called_once_with(ANY, "read_keys", 1500, 1, 0)
+
+    def test_format_stats(self):
+        """
+        Test format_stats() makes a line for each method.
+        """
+        self.client.read_twice()
+        lines = format_stats(get_stats()).splitlines()
+        assert_equal(len(lines), 3)
+        assert_equal(lines[1].split()[0], "read_twice")
+        assert_equal(lines[2].split()[:3], ["read_keys", "2", "0"])
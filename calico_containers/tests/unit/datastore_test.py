@@ -13,7 +13,8 @@
 # limitations under the License.
 
 from etcd import Client as EtcdClient
-from etcd import EtcdKeyNotFound, EtcdResult, EtcdException
+from etcd import EtcdKeyNotFound, EtcdResult, EtcdException, \
+    EtcdAlreadyExist
 import json
 import unittest
 
@@ -23,11 +24,14 @@ from nose.tools import *
 from mock import patch, Mock, call
 
 from pycalico.datastore import (DatastoreClient,
-                                                  CALICO_V_PATH)
+                                                  CALICO_V_PATH,
+                                                  parse_etcd_authority,
+                                                  WRITE_BATCH_THREADS,
+                                                  _run_concurrently)
 from pycalico.datastore_errors import DataStoreError, ProfileNotInEndpoint, ProfileAlreadyInEndpoint, \
-    MultipleEndpointsMatch
+    MultipleEndpointsMatch, BatchWriteError
 from pycalico.datastore_datatypes import Rules, BGPPeer, IPPool, \
-    Endpoint, Profile, Rule
+    IPPoolSet, Endpoint, Profile, Rule, _shared, _SHARED_STRINGS
 
 TEST_HOST = "TEST_HOST"
 TEST_ORCH_ID = "docker"
@@ -51,6 +55,10 @@ TEST_ENDPOINT_PATH = CALICO_V_PATH + "/host/TEST_HOST/workload/docker/1234/" \
 TEST_CONT_ENDPOINTS_PATH = CALICO_V_PATH + "/host/TEST_HOST/workload/docker/" \
                                           "1234/"
 TEST_CONT_PATH = CALICO_V_PATH + "/host/TEST_HOST/workload/docker/1234/"
+TEST_ENDPOINT_INDEX_KEY = CALICO_V_PATH + "/index/endpoint/1234567890ab"
+TEST_WORKLOAD_INDEX_KEY = CALICO_V_PATH + "/index/workload/1234/1234567890ab"
+TEST_PROFILE_INDEX_KEY = CALICO_V_PATH + "/index/profile/UNIT/1234567890ab"
+ALL_PROFILES_INDEX_PATH = CALICO_V_PATH + "/index/profile/"
 CONFIG_PATH = CALICO_V_PATH + "/config/"
 BGP_NODE_DEF_AS_PATH = CALICO_V_PATH + "/config/bgp_as"
 BGP_NODE_MESH_PATH = CALICO_V_PATH + "/config/bgp_node_mesh"
@@ -283,6 +291,53 @@ class TestEndpoint(unittest.TestCase):
         assert_set_equal(endpoint.ipv4_nets, endpoint2.ipv4_nets)
         assert_set_equal(endpoint.ipv6_nets, endpoint2.ipv6_nets)
 
+    @patch("pycalico.datastore_datatypes.IPNetwork", autospec=True)
+    def test_from_json_lazy(self, m_IPNetwork):
+        """
+        Test from_json() only converts the addresses when they are used, and
+        that they can be replaced before then.
+        """
+        m_IPNetwork.side_effect = IPNetwork
+        endpoint = Endpoint.from_json(TEST_ENDPOINT_PATH, EP_12.to_json())
+        endpoint2 = endpoint.copy()
+        assert_equal(endpoint.profile_ids, ["UNIT"])
+        assert_false(m_IPNetwork.called)
+
+        assert_set_equal(endpoint.ipv4_nets, set())
+        endpoint.ipv6_nets.add(IPNetwork("fd20::4:2:1/128"))
+        assert_equal(json.loads(endpoint.to_json())["ipv6_nets"],
+                     ["fd20::4:2:1/128"])
+
+        endpoint2.ipv4_nets = set([IPNetwork("10.3.4.23/32")])
+        assert_set_equal(endpoint2.ipv4_nets, {IPNetwork("10.3.4.23/32")})
+        assert_set_equal(endpoint2.ipv6_nets, set())
+
+    def test_compact(self):
+        """
+        Test endpoints don't have an instance dict, and that endpoints read
+        from JSON share strings that are likely to be repeated.
+        """
+        endpoint = Endpoint.from_json(TEST_ENDPOINT_PATH, EP_12.to_json())
+        endpoint2 = Endpoint.from_json(TEST_ENDPOINT_PATH, EP_12.to_json())
+        assert_false(hasattr(endpoint, "__dict__"))
+        assert_raises(AttributeError, setattr, endpoint, "other", 1)
+        assert_equal(endpoint.name, "cali1234567890a")
+        assert_true(endpoint.hostname is endpoint2.hostname)
+        assert_true(endpoint.profile_ids[0] is endpoint2.profile_ids[0])
+        assert_false(endpoint.profile_ids is endpoint2.profile_ids)
+
+    def test_shared_strings_bounded(self):
+        """
+        Test the shared strings are dropped when there are too many of them.
+        """
+        with patch("pycalico.datastore_datatypes.MAX_SHARED_STRINGS", 2):
+            _SHARED_STRINGS.clear()
+            assert_equal(_shared(u"a"), u"a")
+            _shared(u"b")
+            assert_equal(len(_SHARED_STRINGS), 2)
+            _shared(u"c")
+            assert_equal(_SHARED_STRINGS, {u"c": u"c"})
+
     def test_operators(self):
         """
         Test Endpoint operators __eq__, __ne__ and copy.
@@ -374,6 +429,139 @@ class TestIPPool(unittest.TestCase):
                       str(IPPool("1.2.3.4/24", ipip=True, masquerade=True)))
 
 
+class TestIPPoolSet(unittest.TestCase):
+    def setUp(self):
+        self.pools = [IPPool("10.0.0.0/8"), IPPool("10.1.0.0/16"),
+                      IPPool("10.1.2.0/24"), IPPool("192.168.0.0/16"),
+                      IPPool("fd80::/64")]
+        self.pool_set = IPPoolSet(self.pools)
+
+    def test_get_pool(self):
+        """
+        Test get_pool() uses the pool with the longest matching prefix.
+        """
+        assert_equal(self.pool_set.get_pool(IPAddress("10.1.2.3")),
+                     IPPool("10.1.2.0/24"))
+        assert_equal(self.pool_set.get_pool(IPAddress("10.1.3.3")),
+                     IPPool("10.1.0.0/16"))
+        assert_equal(self.pool_set.get_pool(IPAddress("10.2.0.0")),
+                     IPPool("10.0.0.0/8"))
+        assert_equal(self.pool_set.get_pool(IPAddress("192.168.255.255")),
+                     IPPool("192.168.0.0/16"))
+        assert_equal(self.pool_set.get_pool(IPAddress("fd80::1")),
+                     IPPool("fd80::/64"))
+        assert_is_none(self.pool_set.get_pool(IPAddress("11.0.0.1")))
+        # IPv4 and IPv6 addresses with the same value aren't confused.
+        assert_is_none(self.pool_set.get_pool(IPAddress("::10.1.2.3")))
+
+    def test_get_pool_single_address(self):
+        """
+        Test get_pool() with pools that cover one address or every address.
+        """
+        pool_set = IPPoolSet([IPPool("10.0.0.1/32"), IPPool("0.0.0.0/0")])
+        assert_equal(pool_set.get_pool(IPAddress("10.0.0.1")),
+                     IPPool("10.0.0.1/32"))
+        assert_equal(pool_set.get_pool(IPAddress("10.0.0.2")),
+                     IPPool("0.0.0.0/0"))
+
+    def test_add_replaces(self):
+        """
+        Test adding a pool with an existing CIDR replaces the pool.
+        """
+        self.pool_set.add(IPPool("10.1.0.0/16", ipip=True))
+        assert_equal(self.pool_set.get_pool(IPAddress("10.1.3.3")),
+                     IPPool("10.1.0.0/16", ipip=True))
+
+    def test_get_overlapping_pools(self):
+        """
+        Test get_overlapping_pools() finds pools that contain the CIDR and
+        pools that are contained in it.
+        """
+        def overlapping(cidr):
+            return sorted(str(pool) for pool in
+                          self.pool_set.get_overlapping_pools(IPNetwork(cidr)))
+
+        assert_equal(overlapping("10.1.0.0/20"),
+                     ["10.0.0.0/8", "10.1.0.0/16", "10.1.2.0/24"])
+        assert_equal(overlapping("10.1.2.128/25"),
+                     ["10.0.0.0/8", "10.1.0.0/16", "10.1.2.0/24"])
+        assert_equal(overlapping("192.0.0.0/8"), ["192.168.0.0/16"])
+        assert_equal(overlapping("192.169.0.0/16"), [])
+        assert_equal(overlapping("fd80::/48"), ["fd80::/64"])
+
+
+class TestRunConcurrently(unittest.TestCase):
+
+    def test_run_concurrently(self):
+        """
+        Test _run_concurrently() returns the results in the order of the
+        calls.
+        """
+        calls = [(pow, (2, power)) for power in range(20)]
+        assert_equal(_run_concurrently(calls),
+                     [2 ** power for power in range(20)])
+        assert_equal(_run_concurrently([]), [])
+
+    def test_run_concurrently_one_error(self):
+        """
+        Test _run_concurrently() raises the exception of the only call that
+        fails, after making the other calls.
+        """
+        write = Mock()
+        write.side_effect = iter([None, KeyError("key"), None])
+        assert_raises(KeyError, _run_concurrently,
+                      [(write, (1,)), (write, (2,)), (write, (3,))])
+        assert_equal(len(write.call_args_list), 3)
+
+    def test_run_concurrently_many_errors(self):
+        """
+        Test _run_concurrently() reports every error together when more than
+        one call fails.
+        """
+        errors = [EtcdException("first"), EtcdException("second")]
+        write = Mock()
+        write.side_effect = iter(errors + [None])
+        with assert_raises(BatchWriteError) as context:
+            _run_concurrently([(write, (1,)), (write, (2,)), (write, (3,))])
+        assert_equal(set(context.exception.errors), set(errors))
+        assert_true(isinstance(context.exception, DataStoreError))
+
+
+class TestEtcdAuthority(unittest.TestCase):
+
+    def test_parse_etcd_authority(self):
+        """
+        Test parse_etcd_authority() with one member and with several.
+        """
+        assert_equal(parse_etcd_authority("127.0.0.1:4001"),
+                     [("127.0.0.1", 4001)])
+        assert_equal(parse_etcd_authority("10.0.0.1:2379, 10.0.0.2:2379"),
+                     [("10.0.0.1", 2379), ("10.0.0.2", 2379)])
+
+    @patch("pycalico.datastore.datastore_stats.count_etcd_requests",
+           autospec=True)
+    @patch("pycalico.datastore.os.getenv", autospec=True)
+    @patch("pycalico.datastore.ClusterEtcdClient", autospec=True)
+    def test_cluster(self, m_cluster_client, m_getenv, m_count):
+        """
+        Test that DatastoreClient uses a ClusterEtcdClient when
+        ETCD_AUTHORITY lists several members, and counts the requests to each
+        member.
+        """
+        env = {"ETCD_AUTHORITY": "10.0.0.1:2379,10.0.0.2:2379",
+               "ETCD_QUORUM_READS": "False"}
+        m_getenv.side_effect = lambda name, default=None: \
+            env.get(name, default)
+        members = [Mock(spec=EtcdClient), Mock(spec=EtcdClient)]
+        m_cluster_client.return_value.members = members
+        m_cluster_client.return_value.http = Mock(connection_pool_kw={})
+        datastore = DatastoreClient()
+        m_cluster_client.assert_called_once_with(
+            [("10.0.0.1", 2379), ("10.0.0.2", 2379)], False)
+        assert_equal(datastore.etcd_client, m_cluster_client.return_value)
+        m_count.assert_has_calls([call(members[0]), call(members[1])])
+
+
 class TestDatastoreClient(unittest.TestCase):
 
     @patch("pycalico.datastore.os.getenv", autospec=True)
@@ -381,16 +569,24 @@ class TestDatastoreClient(unittest.TestCase):
     def setUp(self, m_etcd_client, m_getenv):
         m_getenv.return_value = "127.0.0.2:4002"
         self.etcd_client = Mock(spec=EtcdClient)
+        self.etcd_client.http = Mock(connection_pool_kw={})
         m_etcd_client.return_value = self.etcd_client
         self.datastore = DatastoreClient()
         m_etcd_client.assert_called_once_with(host="127.0.0.2", port=4002)
 
+    def test_connection_pool_size(self):
+        """
+        Test that the client keeps enough connections open for the writes it
+        makes at once.
+        """
+        assert_equal(self.etcd_client.http.connection_pool_kw["maxsize"],
+                     WRITE_BATCH_THREADS)
+
     def test_ensure_global_config(self):
         """
         Test ensure_global_config when it doesn't already exist.
         """
         int_prefix_path = CONFIG_PATH + "InterfacePrefix"
-        self.etcd_client.read.side_effect = EtcdKeyNotFound
 
         # We only write the interface prefix if there is no entry in the
         # etcd database.  Note it is not sufficient to just check for the
@@ -398,27 +594,32 @@ class TestDatastoreClient(unittest.TestCase):
         # the interface prefix since the config directory may contain other
         # global configuration.
         self.datastore.ensure_global_config()
-        self.etcd_client.read.assert_called_once_with(int_prefix_path)
-        expected_writes = [call(int_prefix_path, "cali"),
+        expected_writes = [call(int_prefix_path, "cali", prevExist=False),
                            call(CALICO_V_PATH + "/Ready", "true")]
-        self.etcd_client.write.assert_has_calls(expected_writes)
+        self.etcd_client.write.assert_has_calls(expected_writes,
+                                                any_order=True)
+        assert_equal(len(self.etcd_client.write.call_args_list), 2)
 
     def test_ensure_global_config_exists(self):
         """
         Test ensure_global_config() when it already exists.
         """
+        def mock_write(path, value, **kwargs):
+            if kwargs.get("prevExist") is False:
+                raise EtcdAlreadyExist()
+
+        self.etcd_client.write.side_effect = mock_write
         self.datastore.ensure_global_config()
-        self.etcd_client.read.assert_called_once_with(
-                                               CONFIG_PATH + "InterfacePrefix")
+        self.etcd_client.write.assert_any_call(CALICO_V_PATH + "/Ready",
+                                               "true")
 
     def test_ensure_global_config_exists_etcd_exc(self):
         """
         Test ensure_global_config() when etcd raises an EtcdException.
         """
-        self.etcd_client.read.side_effect = EtcdException
+        self.etcd_client.write.side_effect = EtcdException
         self.assertRaises(DataStoreError, self.datastore.ensure_global_config)
-        self.etcd_client.read.assert_called_once_with(
-                                               CONFIG_PATH + "InterfacePrefix")
+        assert_equal(len(self.etcd_client.write.call_args_list), 2)
 
     def test_get_profile(self):
         """
@@ -662,14 +863,12 @@ class TestDatastoreClient(unittest.TestCase):
         Test create_host() when the .../workload key already exists.
         :return: None
         """
-        def mock_read_success(path):
-            result = Mock(spec=EtcdResult)
+        def mock_write(path, value, **kwargs):
             if path == TEST_HOST_PATH + "/workload":
-                return result
-            else:
-                assert False
+                assert_equal(kwargs, {"dir": True, "prevExist": False})
+                raise EtcdAlreadyExist()
 
-        self.etcd_client.read.side_effect = mock_read_success
+        self.etcd_client.write.side_effect = mock_write
 
         bird_ip = "192.168.2.4"
         bird6_ip = "fd80::4"
@@ -678,25 +877,22 @@ class TestDatastoreClient(unittest.TestCase):
         expected_writes = [call(TEST_HOST_PATH + "/bird_ip", bird_ip),
                            call(TEST_HOST_PATH + "/bird6_ip", bird6_ip),
                            call(TEST_HOST_PATH + "/bgp_as", bgp_as),
-                           call(TEST_HOST_PATH + "/config/marker",
-                                "created")]
+                           call(TEST_HOST_PATH + "/workload",
+                                None, dir=True, prevExist=False)]
         self.etcd_client.write.assert_has_calls(expected_writes,
                                                 any_order=True)
-        assert_equal(self.etcd_client.write.call_count, 4)
+        assert_equal(len(self.etcd_client.write.call_args_list), 5)
+
+        # The marker is written last.
+        assert_equal(self.etcd_client.write.call_args,
+                     call(TEST_HOST_PATH + "/config/marker", "created"))
+        assert_false(self.etcd_client.delete.called)
 
     def test_create_host_mainline(self):
         """
-        Test create_host() when none of the keys exists (specifically,
-        .../workload is checked and doesn't exist).
+        Test create_host() when none of the keys exists.
         :return: None
         """
-        def mock_read(path):
-            if path == CALICO_V_PATH + "/host/TEST_HOST/workload":
-                raise EtcdKeyNotFound()
-            else:
-                assert False
-
-        self.etcd_client.read.side_effect = mock_read
         self.etcd_client.delete.side_effect = EtcdKeyNotFound()
 
         bird_ip = "192.168.2.4"
@@ -705,13 +901,32 @@ class TestDatastoreClient(unittest.TestCase):
         self.datastore.create_host(TEST_HOST, bird_ip, bird6_ip, bgp_as)
         expected_writes = [call(TEST_HOST_PATH + "/bird_ip", bird_ip),
                            call(TEST_HOST_PATH + "/bird6_ip", bird6_ip),
-                           call(TEST_HOST_PATH + "/config/marker",
-                                "created"),
                            call(TEST_HOST_PATH + "/workload",
-                                None, dir=True)]
+                                None, dir=True, prevExist=False)]
         self.etcd_client.write.assert_has_calls(expected_writes,
                                                 any_order=True)
-        assert_equal(self.etcd_client.write.call_count, 4)
+        assert_equal(len(self.etcd_client.write.call_args_list), 4)
+        assert_equal(self.etcd_client.write.call_args,
+                     call(TEST_HOST_PATH + "/config/marker", "created"))
+        self.etcd_client.delete.assert_called_once_with(
+                                                TEST_HOST_PATH + "/bgp_as")
+
+    def test_create_host_write_fails(self):
+        """
+        Test create_host() when one of the host's keys can't be written: the
+        error is reported and the marker isn't written.
+        :return: None
+        """
+        def mock_write(path, value, **kwargs):
+            if path == TEST_HOST_PATH + "/bird6_ip":
+                raise EtcdException("Write failed")
+
+        self.etcd_client.write.side_effect = mock_write
+        self.assertRaises(DataStoreError, self.datastore.create_host,
+                          TEST_HOST, "192.168.2.4", "fd80::4", 65531)
+        assert_equal(len(self.etcd_client.write.call_args_list), 4)
+        assert_not_in(call(TEST_HOST_PATH + "/config/marker", "created"),
+                      self.etcd_client.write.call_args_list)
 
     def test_remove_host_mainline(self):
         """
@@ -732,6 +947,33 @@ class TestDatastoreClient(unittest.TestCase):
         self.etcd_client.delete.side_effect = EtcdKeyNotFound
         self.datastore.remove_host(TEST_HOST)
 
+    def test_get_hostnames(self):
+        """
+        Test get_hostnames() lists the host directories.
+        """
+        children = []
+        for key in [TEST_HOST_PATH, ALL_HOSTS_PATH + "TEST_HOST2"]:
+            child = Mock(spec=EtcdResult)
+            child.key = key
+            children.append(child)
+        self.etcd_client.read.return_value.children = iter(children)
+        assert_set_equal(self.datastore.get_hostnames(),
+                         {TEST_HOST, "TEST_HOST2"})
+        self.etcd_client.read.assert_called_once_with(ALL_HOSTS_PATH)
+
+    def test_get_hostnames_no_hosts(self):
+        """
+        Test get_hostnames() when there are no hosts, or the hosts directory
+        doesn't exist.
+        """
+        child = Mock(spec=EtcdResult)
+        child.key = ALL_HOSTS_PATH.rstrip("/")
+        self.etcd_client.read.return_value.children = iter([child])
+        assert_set_equal(self.datastore.get_hostnames(), set())
+
+        self.etcd_client.read.side_effect = EtcdKeyNotFound
+        assert_set_equal(self.datastore.get_hostnames(), set())
+
     def test_get_ip_pools(self):
         """
         Test getting IP pools from the datastore when there are some pools.
@@ -766,6 +1008,31 @@ class TestDatastoreClient(unittest.TestCase):
         pools = self.datastore.get_ip_pools("v4")
         assert_list_equal([], pools)
 
+    def test_get_ip_pool_set(self):
+        """
+        Test get_ip_pool_set() only rebuilds the set when the pools change.
+        """
+        nodes = []
+        for net in ["192.168.3.0/24", "192.168.5.0/24"]:
+            node = Mock(spec=EtcdResult)
+            node.value = IPPool(net).to_json()
+            node.key = IPV4_POOLS_PATH + net.replace("/", "-")
+            node.modifiedIndex = 10
+            nodes.append(node)
+        self.etcd_client.read.return_value.leaves = nodes
+
+        pool_set = self.datastore.get_ip_pool_set("v4")
+        assert_equal(pool_set.get_pool(IPAddress("192.168.5.1")),
+                     IPPool("192.168.5.0/24"))
+        assert_is(self.datastore.get_ip_pool_set("v4"), pool_set)
+
+        nodes[1].value = IPPool("192.168.5.0/24", ipip=True).to_json()
+        nodes[1].modifiedIndex = 11
+        new_pool_set = self.datastore.get_ip_pool_set("v4")
+        assert_is_not(new_pool_set, pool_set)
+        assert_equal(new_pool_set.get_pool(IPAddress("192.168.5.1")),
+                     IPPool("192.168.5.0/24", ipip=True))
+
     def test_get_ip_pool_config(self):
         """
         Test get_ip_pool_config where valid data is returned..
@@ -873,6 +1140,7 @@ class TestDatastoreClient(unittest.TestCase):
         expected_calls = [call(TEST_PROFILE_PATH + "tags", '["TEST"]'),
                           call(TEST_PROFILE_PATH + "rules", rules.to_json())]
         self.etcd_client.write.assert_has_calls(expected_calls, any_order=True)
+        assert_equal(len(self.etcd_client.write.call_args_list), 2)
 
     def test_delete_profile(self):
         """
@@ -910,27 +1178,48 @@ class TestDatastoreClient(unittest.TestCase):
 
     def test_get_profile_members(self):
         """
-        Test get_profile_members() when there are endpoints.
+        Test get_profile_members() reads the members from the profile index,
+        ignoring entries for endpoints that have left the profile or been
+        removed.
         """
-        self.maxDiff = 1000
-        self.etcd_client.read.side_effect = mock_read_4_endpoints
+        self.etcd_client.read.side_effect = mock_read_profile_index
         members = self.datastore.get_profile_members("TEST")
-        assert_list_equal(members, [EP_56, EP_78])
+        assert_list_equal(members, [EP_56])
 
         members = self.datastore.get_profile_members("UNIT")
-        assert_list_equal(members, [EP_90, EP_12])
+        assert_list_equal(members, [EP_90])
 
         members = self.datastore.get_profile_members("UNIT_TEST")
         assert_list_equal(members, [])
 
     def test_get_profile_members_no_key(self):
         """
-        Test get_profile_members() when the endpoints path has not been
+        Test get_profile_members() when the profile index has not been
         set up.
         """
-        self.etcd_client.read.side_effect = mock_read_endpoints_key_error
+        self.etcd_client.read.side_effect = EtcdKeyNotFound
         members = self.datastore.get_profile_members("UNIT_TEST")
         assert_list_equal(members, [])
+        self.etcd_client.read.assert_called_once_with(
+            ALL_PROFILES_INDEX_PATH + "UNIT_TEST/")
+
+    def test_get_all_profile_members(self):
+        """
+        Test get_all_profile_members() reads the whole profile index once
+        and each endpoint once.
+        """
+        self.etcd_client.read.side_effect = mock_read_profile_index
+        members = self.datastore.get_all_profile_members()
+        assert_dict_equal(members, {"TEST": [EP_56], "UNIT": [EP_90]})
+        assert_equal(self.etcd_client.read.call_count, 5)
+
+    def test_get_all_profile_members_no_key(self):
+        """
+        Test get_all_profile_members() when the profile index has not been
+        set up.
+        """
+        self.etcd_client.read.side_effect = EtcdKeyNotFound
+        assert_dict_equal(self.datastore.get_all_profile_members(), {})
 
     def test_get_endpoint_exists(self):
         """
@@ -960,6 +1249,25 @@ class TestDatastoreClient(unittest.TestCase):
                       hostname=TEST_HOST, orchestrator_id=TEST_ORCH_ID,
                       workload_id=TEST_CONT_ID, endpoint_id=TEST_ENDPOINT_ID)
 
+    def test_get_endpoint_index(self):
+        """
+        Test get_endpoint_index() reads the endpoint's key without recursing.
+        """
+        self.etcd_client.read.return_value = Mock(modifiedIndex=12)
+        assert_equal(self.datastore.get_endpoint_index(TEST_HOST,
+                                                       TEST_ORCH_ID,
+                                                       TEST_CONT_ID,
+                                                       TEST_ENDPOINT_ID), 12)
+        self.etcd_client.read.assert_called_once_with(TEST_ENDPOINT_PATH)
+
+    def test_get_endpoint_index_doesnt_exist(self):
+        """
+        Test get_endpoint_index() for an endpoint that doesn't exist.
+        """
+        self.etcd_client.read.side_effect = EtcdKeyNotFound
+        assert_raises(KeyError, self.datastore.get_endpoint_index,
+                      TEST_HOST, TEST_ORCH_ID, TEST_CONT_ID, TEST_ENDPOINT_ID)
+
     def test_get_endpoints_multiple(self):
         """
         Test get_endpoints() with more than a single result.
@@ -974,19 +1282,26 @@ class TestDatastoreClient(unittest.TestCase):
         Test set_endpoint().
         """
         EP_12._original_json = ""
-        self.datastore.set_endpoint(EP_12)
-        self.etcd_client.write.assert_called_once_with(TEST_ENDPOINT_PATH,
-                                                       EP_12.to_json())
+        self.etcd_client.write.return_value = Mock(modifiedIndex=7)
+        assert_equal(self.datastore.set_endpoint(EP_12), 7)
+        self.etcd_client.write.assert_has_calls([
+            call(TEST_PROFILE_INDEX_KEY, TEST_ENDPOINT_PATH),
+            call(TEST_ENDPOINT_PATH, EP_12.to_json()),
+            call(TEST_ENDPOINT_INDEX_KEY, TEST_ENDPOINT_PATH),
+            call(TEST_WORKLOAD_INDEX_KEY, TEST_ENDPOINT_PATH)])
         assert_equal(EP_12._original_json, EP_12.to_json())
+        assert_false(self.etcd_client.delete.called)
 
     def test_remove_endpoint(self):
         """
         Test remove_endpoint().
         """
         self.datastore.remove_endpoint(EP_12)
-        self.etcd_client.delete.assert_called_once_with(TEST_ENDPOINT_PATH,
-                                                        recursive=True,
-                                                        dir=True)
+        self.etcd_client.delete.assert_has_calls([
+            call(TEST_ENDPOINT_PATH, recursive=True, dir=True),
+            call(TEST_ENDPOINT_INDEX_KEY),
+            call(TEST_WORKLOAD_INDEX_KEY),
+            call(TEST_PROFILE_INDEX_KEY)])
 
     def test_update_endpoint(self):
         """
@@ -1000,9 +1315,14 @@ class TestDatastoreClient(unittest.TestCase):
         assert_not_equal(ep._original_json, ep.to_json())
 
         self.datastore.update_endpoint(ep)
-        self.etcd_client.write.assert_called_once_with(TEST_ENDPOINT_PATH,
-                                                     ep.to_json(),
-                                                     prevValue=original_json)
+        index_calls = [call(ALL_PROFILES_INDEX_PATH + "%s/1234567890ab" %
+                            profile_id, TEST_ENDPOINT_PATH)
+                       for profile_id in ep.profile_ids]
+        assert_equal(self.etcd_client.write.mock_calls,
+                     index_calls + [call(TEST_ENDPOINT_PATH,
+                                         ep.to_json(),
+                                         prevValue=original_json)])
+        self.etcd_client.delete.assert_called_once_with(TEST_PROFILE_INDEX_KEY)
         assert_not_equal(ep._original_json, original_json)
         assert_equals(ep._original_json, ep.to_json())
 
@@ -1076,6 +1396,107 @@ class TestDatastoreClient(unittest.TestCase):
                                            workload_id=TEST_CONT_ID)
         assert_equal(eps, [])
 
+    def test_iter_endpoints(self):
+        """
+        Test iter_endpoints() only parses endpoints whose keys match.
+        """
+        leaves = [Mock(key=TEST_ENDPOINT_PATH, value=EP_12.to_json()),
+                  Mock(key=TEST_CONT_PATH + "endpoint/7890abcdef12",
+                       value="not JSON"),
+                  Mock(key=TEST_HOST_PATH + "/bird_ip", value="10.0.0.1")]
+        self.etcd_client.read.return_value = Mock(leaves=iter(leaves))
+        eps = self.datastore.iter_endpoints(endpoint_id=TEST_ENDPOINT_ID)
+        self.etcd_client.read.assert_called_once_with(ALL_ENDPOINTS_PATH,
+                                                      recursive=True)
+        assert_equal(list(eps), [EP_12])
+
+    def test_iter_endpoints_doesnt_exist(self):
+        """
+        Test iter_endpoints() when there are no endpoints.
+        """
+        self.etcd_client.read.side_effect = EtcdKeyNotFound
+        assert_equal(list(self.datastore.iter_endpoints()), [])
+
+    def test_get_endpoints_indexed(self):
+        """
+        Test get_endpoints() uses the endpoint index when the hostname isn't
+        known.
+        """
+        def mock_read(path):
+            if path == TEST_ENDPOINT_INDEX_KEY:
+                return Mock(value=TEST_ENDPOINT_PATH)
+            assert_equal(path, TEST_ENDPOINT_PATH)
+            return Mock(key=TEST_ENDPOINT_PATH, value=EP_12.to_json())
+        self.etcd_client.read.side_effect = mock_read
+        eps = self.datastore.get_endpoints(endpoint_id=TEST_ENDPOINT_ID)
+        assert_equal(len(eps), 1)
+        assert_equal(eps[0].to_json(), EP_12.to_json())
+
+    def test_get_endpoints_indexed_workload(self):
+        """
+        Test get_endpoints() uses the workload index when the hostname isn't
+        known.
+        """
+        def mock_read(path):
+            if path == CALICO_V_PATH + "/index/workload/1234/":
+                return Mock(children=[Mock(dir=False,
+                                           value=TEST_ENDPOINT_PATH)])
+            assert_equal(path, TEST_ENDPOINT_PATH)
+            return Mock(key=TEST_ENDPOINT_PATH, value=EP_12.to_json())
+        self.etcd_client.read.side_effect = mock_read
+        eps = self.datastore.get_endpoints(workload_id=TEST_CONT_ID)
+        assert_equal(len(eps), 1)
+        assert_equal(eps[0].endpoint_id, TEST_ENDPOINT_ID)
+
+    def test_get_endpoints_not_indexed(self):
+        """
+        Test get_endpoints() searches every host if the endpoint isn't in the
+        index.
+        """
+        search = get_mock_read_2_ep_for_cont(ALL_ENDPOINTS_PATH, True)
+        def mock_read(path, recursive=None):
+            if path == TEST_ENDPOINT_INDEX_KEY:
+                raise EtcdKeyNotFound()
+            return search(path, recursive=recursive)
+        self.etcd_client.read.side_effect = mock_read
+        eps = self.datastore.get_endpoints(endpoint_id=TEST_ENDPOINT_ID)
+        assert_equal(len(eps), 1)
+        assert_equal(eps[0].endpoint_id, TEST_ENDPOINT_ID)
+
+    def test_check_endpoint_index(self):
+        """
+        Test check_endpoint_index() finds and repairs missing and stale
+        index entries.
+        """
+        search = get_mock_read_2_ep_for_cont(ALL_ENDPOINTS_PATH, True)
+        stale_key = CALICO_V_PATH + "/index/endpoint/deadbeef"
+        def mock_read(path, recursive=None):
+            if path == CALICO_V_PATH + "/index/":
+                return Mock(leaves=[
+                    Mock(dir=False, key=TEST_ENDPOINT_INDEX_KEY,
+                         value=TEST_ENDPOINT_PATH),
+                    Mock(dir=False, key=TEST_WORKLOAD_INDEX_KEY,
+                         value=TEST_ENDPOINT_PATH),
+                    Mock(dir=False, key=TEST_PROFILE_INDEX_KEY,
+                         value=TEST_ENDPOINT_PATH),
+                    Mock(dir=False, key=stale_key, value="/gone")])
+            return search(path, recursive=recursive)
+        self.etcd_client.read.side_effect = mock_read
+
+        ep_78_path = TEST_CONT_PATH + "endpoint/7890abcdef12"
+        missing = [CALICO_V_PATH + "/index/endpoint/7890abcdef12",
+                   CALICO_V_PATH + "/index/profile/TEST/7890abcdef12",
+                   CALICO_V_PATH + "/index/workload/1234/7890abcdef12"]
+        assert_equal(self.datastore.check_endpoint_index(),
+                     (missing, [stale_key]))
+        assert_false(self.etcd_client.write.called)
+
+        self.datastore.check_endpoint_index(repair=True)
+        self.etcd_client.write.assert_has_calls([call(missing[0], ep_78_path),
+                                                 call(missing[1], ep_78_path),
+                                                 call(missing[2], ep_78_path)])
+        self.etcd_client.delete.assert_called_once_with(stale_key)
+
     def test_get_default_next_hops(self):
         """
         Test get_default_next_hops when both are present.
@@ -1140,10 +1561,14 @@ class TestDatastoreClient(unittest.TestCase):
         """
         Test remove_workload()
         """
+        self.etcd_client.read.side_effect = \
+            get_mock_read_2_ep_for_cont(TEST_CONT_PATH, True)
         self.datastore.remove_workload(TEST_HOST, TEST_ORCH_ID, TEST_CONT_ID)
-        self.etcd_client.delete.assert_called_once_with(TEST_CONT_PATH,
-                                                        recursive=True,
-                                                        dir=True)
+        self.etcd_client.delete.assert_has_calls([
+            call(TEST_CONT_PATH, recursive=True, dir=True),
+            call(TEST_ENDPOINT_INDEX_KEY),
+            call(TEST_WORKLOAD_INDEX_KEY),
+            call(TEST_PROFILE_INDEX_KEY)])
 
     @raises(KeyError)
     def test_remove_workload_missing(self):
@@ -1151,6 +1576,7 @@ class TestDatastoreClient(unittest.TestCase):
         Test remove_workload() raises a KeyError if the container does not
         exist.
         """
+        self.etcd_client.read.side_effect = EtcdKeyNotFound
         self.etcd_client.delete.side_effect = EtcdKeyNotFound
         self.datastore.remove_workload(TEST_HOST, TEST_ORCH_ID, TEST_CONT_ID)
 
@@ -1495,40 +1921,35 @@ def mock_read_profiles_key_error(path, recursive):
     raise EtcdKeyNotFound()
 
 
-def mock_read_4_endpoints(path, recursive):
-    assert path == ALL_ENDPOINTS_PATH
-    assert recursive
-    leaves = []
-
-    specs = [
-        (CALICO_V_PATH + "/host/TEST_HOST/bird_ip", "192.168.1.1"),
-        (CALICO_V_PATH + "/host/TEST_HOST/bird6_ip", "fd80::4"),
-        (CALICO_V_PATH + "/host/TEST_HOST/config/marker", "created"),
-        (CALICO_V_PATH + "/host/TEST_HOST/workload/docker/1234/endpoint/567890abcdef",
-         EP_56.to_json()),
-        (CALICO_V_PATH + "/host/TEST_HOST/workload/docker/5678/endpoint/90abcdef1234",
-         EP_90.to_json()),
-        (CALICO_V_PATH + "/host/TEST_HOST2/bird_ip", "192.168.1.2"),
-        (CALICO_V_PATH + "/host/TEST_HOST2/bird6_ip", "fd80::3"),
-        (CALICO_V_PATH + "/host/TEST_HOST2/config/marker", "created"),
-        (CALICO_V_PATH + "/host/TEST_HOST2/workload/docker/1234/endpoint/7890abcdef12",
-         EP_78.to_json()),
-        (CALICO_V_PATH + "/host/TEST_HOST2/workload/docker/5678/endpoint/1234567890ab",
-         EP_12.to_json())]
-    for spec in specs:
-        leaf = Mock(spec=EtcdResult)
-        leaf.key = spec[0]
-        leaf.value = spec[1]
-        leaves.append(leaf)
-
-    result = Mock(spec=EtcdResult)
-    result.leaves = iter(leaves)
-    return result
-
-
-def mock_read_endpoints_key_error(path, recursive):
-    assert path == ALL_ENDPOINTS_PATH
-    assert recursive
+def mock_read_profile_index(path, recursive=None):
+    """
+    The profile index lists EP_56 in TEST and EP_90 in UNIT.  It also lists
+    EP_78 in UNIT, which it has left, and an endpoint in TEST which has been
+    removed.
+    """
+    ep_paths = {
+        TEST_CONT_PATH + "endpoint/567890abcdef": EP_56,
+        TEST_CONT_PATH + "endpoint/7890abcdef12": EP_78,
+        TEST_CONT_PATH + "endpoint/90abcdef1234": EP_90}
+    index = [("TEST", "567890abcdef"),
+             ("TEST", "deadbeef"),
+             ("UNIT", "7890abcdef12"),
+             ("UNIT", "90abcdef1234")]
+    leaves = [Mock(dir=False,
+                   key=ALL_PROFILES_INDEX_PATH + "%s/%s" % (profile, ep_id),
+                   value=TEST_CONT_PATH + "endpoint/" + ep_id)
+              for profile, ep_id in index]
+
+    if path == ALL_PROFILES_INDEX_PATH:
+        assert recursive
+        return Mock(leaves=iter(leaves))
+    elif path.startswith(ALL_PROFILES_INDEX_PATH):
+        children = [leaf for leaf in leaves if leaf.key.startswith(path)]
+        if not children:
+            raise EtcdKeyNotFound()
+        return Mock(children=iter(children))
+    elif path in ep_paths:
+        return Mock(key=path, value=ep_paths[path].to_json())
     raise EtcdKeyNotFound()
 
 
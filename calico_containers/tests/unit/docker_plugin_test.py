@@ -15,12 +15,15 @@
 import json
 import unittest
 
-from mock import Mock, ANY
+from mock import Mock, ANY, patch
 from netaddr import IPAddress, IPNetwork
-from nose.tools import assert_equal, assert_dict_equal
+from nose.tools import assert_equal, assert_dict_equal, assert_false, \
+    assert_true
 
 import docker_plugin
-from pycalico.datastore_datatypes import Endpoint
+from pycalico.datastore_datatypes import Endpoint, IPPool, IPPoolSet
+from pycalico.datastore_errors import DataStoreError
+from pycalico.ipam import DualStackAllocation
 
 TEST_ID = "TEST_ID"
 
@@ -28,6 +31,7 @@ class TestPlugin(unittest.TestCase):
 
     def setUp(self):
         self.app = docker_plugin.app.test_client()
+        docker_plugin.endpoint_cache.clear()
 
     def tearDown(self):
         pass
@@ -62,6 +66,64 @@ class TestPlugin(unittest.TestCase):
                            data='{"EndpointID": "%s"}' % TEST_ID)
         assert_equal(rv.data, '{\n  "Value": {}\n}')
 
+    @patch("docker_plugin.netns.NETLINK_AVAILABLE", False)
+    @patch("docker_plugin.check_call", autospec=True)
+    def test_create_endpoint(self, m_check_call):
+        docker_plugin.client.allocate_dual_stack = Mock(
+            return_value=DualStackAllocation(
+                IPAddress("192.168.0.2"), IPNetwork("192.168.0.0/16"),
+                IPAddress("10.0.0.1"), IPAddress("fd80::2"),
+                IPNetwork("fd80::/64"), IPAddress("fd00::1")))
+        docker_plugin.client.set_endpoint = Mock()
+
+        rv = self.app.post('/NetworkDriver.CreateEndpoint',
+                           data='{"EndpointID": "%s", "NetworkID": "%s"}' %
+                                (TEST_ID, TEST_ID))
+        assert_dict_equal(json.loads(rv.data),
+                          {"Interfaces": [{"ID": 0,
+                                           "Address": "192.168.0.2/32",
+                                           "AddressIPv6": "fd80::2/128",
+                                           "MacAddress": "EE:EE:EE:EE:EE:EE"}]})
+        docker_plugin.client.allocate_dual_stack.assert_called_once_with(
+            docker_plugin.hostname, TEST_ID,
+            reserves=docker_plugin.ip_reserves)
+        assert_equal(m_check_call.call_count, 3)
+        ep = docker_plugin.client.set_endpoint.call_args[0][0]
+        assert_equal(ep.ipv4_gateway, IPAddress("10.0.0.1"))
+        assert_equal(ep.ipv6_gateway, IPAddress("fd00::1"))
+
+        # Joining the endpoint uses the endpoint we wrote.
+        docker_plugin.client.get_endpoint = Mock()
+        rv = self.app.post('/NetworkDriver.Join',
+                           data='{"EndpointID": "%s"}' % TEST_ID)
+        assert_equal(json.loads(rv.data)["Gateway"], "10.0.0.1")
+        assert_false(docker_plugin.client.get_endpoint.called)
+
+    @patch("docker_plugin.netns.NETLINK_AVAILABLE", True)
+    @patch("docker_plugin.netns.create_veth", autospec=True)
+    @patch("docker_plugin.check_call", autospec=True)
+    def test_create_veth_netlink(self, m_check_call, m_create_veth):
+        ep = Endpoint("hostname", "docker", "libnetwork", TEST_ID, "active",
+                      "mac")
+        docker_plugin.create_veth(ep)
+        m_create_veth.assert_called_once_with("caliTEST_ID", "tmpTEST_ID",
+                                              peer_mac="EE:EE:EE:EE:EE:EE")
+        assert_false(m_check_call.called)
+
+    @patch("docker_plugin.create_veth", autospec=True)
+    def test_create_endpoint_no_ipv4(self, m_create_veth):
+        """
+        Test the request fails, without creating the veth, if no IPv4 address
+        is available.
+        """
+        docker_plugin.client.allocate_dual_stack = Mock(return_value=None)
+
+        rv = self.app.post('/NetworkDriver.CreateEndpoint',
+                           data='{"EndpointID": "%s", "NetworkID": "%s"}' %
+                                (TEST_ID, TEST_ID))
+        assert_equal(rv.status_code, 500)
+        assert_false(m_create_veth.called)
+
     def test_join(self):
         endpoint_mock = Mock()
         endpoint = Endpoint("hostname",
@@ -111,9 +173,164 @@ class TestPlugin(unittest.TestCase):
         assert_dict_equal(json.loads(rv.data),
                           json.loads(expected_response))
 
+    @patch("docker_plugin.datastore_stats.get_stats", autospec=True)
+    def test_stats(self, m_get_stats):
+        m_get_stats.return_value = {"get_endpoint": {"calls": 1}}
+        rv = self.app.get('/stats')
+        assert_equal(json.loads(rv.data), {"get_endpoint": {"calls": 1}})
+
+    def test_metrics(self):
+        """
+        Test /metrics reports the requests made to each route.
+        """
+        self.app.post('/Plugin.Activate')
+        rv = self.app.get('/metrics')
+        assert_equal(rv.status_code, 200)
+        assert_true(rv.content_type.startswith("text/plain; version=0.0.4"))
+        assert_true('calico_plugin_requests_total{route="/Plugin.Activate",'
+                    'status="200"}' in rv.data)
+        assert_true('calico_plugin_request_duration_seconds_count'
+                    '{route="/Plugin.Activate"}' in rv.data)
+        # The /metrics request itself is still in flight.
+        assert_true('calico_plugin_requests_in_flight{route="/metrics"} 1.0'
+                    in rv.data)
+
+    @patch("docker_plugin.teardowns", autospec=True)
+    def test_delete_endpoint(self, m_teardowns):
+        """
+        Test the teardown is recorded in the journal, to be done later.
+        """
+        rv = self.app.post('/NetworkDriver.DeleteEndpoint',
+                           data='{"EndpointID": "%s"}' % TEST_ID)
+        assert_equal(rv.data, '{}')
+        m_teardowns.record.assert_called_once_with(
+            TEST_ID, {"stage": docker_plugin.STAGE_RELEASE_IPS})
+
+    @patch("docker_plugin.teardowns", autospec=True)
+    @patch("docker_plugin.remove_veth", autospec=True)
+    @patch("docker_plugin.backout_ip_assignments", autospec=True)
+    def test_teardown_endpoint(self, m_backout, m_remove_veth, m_teardowns):
+        """
+        Test an endpoint's teardown, and that the release of its IPs is
+        recorded before it is done.
+        """
+        ep = Endpoint("hostname", "docker", "libnetwork", TEST_ID, "active",
+                      "mac")
+        docker_plugin.client.get_endpoint = Mock(return_value=ep)
+        docker_plugin.client.remove_endpoint = Mock()
+        m_backout.side_effect = \
+            lambda ep: assert_true(m_teardowns.update.called)
+
+        teardown = {"stage": docker_plugin.STAGE_RELEASE_IPS}
+        assert_true(docker_plugin.teardown_endpoint(TEST_ID, teardown))
+        m_teardowns.update.assert_called_once_with(
+            TEST_ID, {"stage": docker_plugin.STAGE_REMOVE_ENDPOINT})
+        m_backout.assert_called_once_with(ep)
+        docker_plugin.client.remove_endpoint.assert_called_once_with(ep)
+        m_remove_veth.assert_called_once_with(ep)
+
+    @patch("docker_plugin.teardowns", autospec=True)
+    @patch("docker_plugin.remove_veth", autospec=True)
+    @patch("docker_plugin.backout_ip_assignments", autospec=True)
+    def test_teardown_endpoint_retry(self, m_backout, m_remove_veth,
+                                     m_teardowns):
+        """
+        Test a teardown is retried if the datastore can't be reached, and that
+        the IPs aren't released again by the retry.
+        """
+        ep = Endpoint("hostname", "docker", "libnetwork", TEST_ID, "active",
+                      "mac")
+        docker_plugin.client.get_endpoint = Mock(return_value=ep)
+        docker_plugin.client.remove_endpoint = Mock(
+            side_effect=iter([DataStoreError(), None]))
+
+        teardown = {"stage": docker_plugin.STAGE_RELEASE_IPS}
+        assert_false(docker_plugin.teardown_endpoint(TEST_ID, teardown))
+        assert_false(m_remove_veth.called)
+        assert_true(docker_plugin.teardown_endpoint(TEST_ID, teardown))
+        assert_equal(m_backout.call_count, 1)
+        m_remove_veth.assert_called_once_with(ep)
+
+    @patch("docker_plugin.remove_veth", autospec=True)
+    @patch("docker_plugin.backout_ip_assignments", autospec=True)
+    def test_teardown_endpoint_unreachable(self, m_backout, m_remove_veth):
+        """
+        Test nothing is done if the endpoint can't be read.
+        """
+        docker_plugin.client.get_endpoint = Mock(side_effect=DataStoreError)
+        teardown = {"stage": docker_plugin.STAGE_RELEASE_IPS}
+        assert_false(docker_plugin.teardown_endpoint(TEST_ID, teardown))
+        assert_false(m_backout.called)
+        assert_false(m_remove_veth.called)
+
+    @patch("docker_plugin.teardowns", autospec=True)
+    @patch("docker_plugin.remove_veth", autospec=True)
+    @patch("docker_plugin.backout_ip_assignments", autospec=True)
+    def test_teardown_endpoint_not_found(self, m_backout, m_remove_veth,
+                                         m_teardowns):
+        """
+        Test the IPs are released by the endpoint's allocation handle, and the
+        veth is still removed, if the endpoint has gone from the datastore.
+        """
+        docker_plugin.client.get_endpoint = Mock(side_effect=KeyError)
+        docker_plugin.client.release_by_handle = Mock()
+        teardown = {"stage": docker_plugin.STAGE_RELEASE_IPS}
+        assert_true(docker_plugin.teardown_endpoint(TEST_ID, teardown))
+        m_teardowns.update.assert_called_once_with(
+            TEST_ID, {"stage": docker_plugin.STAGE_REMOVE_ENDPOINT})
+        docker_plugin.client.release_by_handle.assert_called_once_with(
+            TEST_ID)
+        assert_false(m_backout.called)
+        assert_equal(m_remove_veth.call_args[0][0].name, "cali" + TEST_ID)
+
+        # Once the IPs have been released, they aren't released again.
+        assert_true(docker_plugin.teardown_endpoint(TEST_ID, teardown))
+        assert_equal(docker_plugin.client.release_by_handle.call_count, 1)
+
     def test_leave(self):
         rv = self.app.post('/NetworkDriver.Leave',
                            data='{"EndpointID": "%s"}' % TEST_ID)
         assert_equal(rv.data, '{}')
 
+    def test_unassign_ip_reserve(self):
+        """
+        Test that an address is returned to the reserve, and only unassigned
+        when the reserve is full.
+        """
+        docker_plugin.client.get_ip_pool_set = Mock(
+            return_value=IPPoolSet([IPPool("1.2.3.0/24")]))
+        docker_plugin.client.unassign_address = Mock(return_value=True)
+        with patch.dict(docker_plugin.ip_reserves, {"v4": Mock()}):
+            docker_plugin.ip_reserves["v4"].put.return_value = True
+            assert_true(docker_plugin.unassign_ip(IPAddress("1.2.3.4")))
+            assert_false(docker_plugin.client.unassign_address.called)
+
+            docker_plugin.ip_reserves["v4"].put.return_value = False
+            assert_true(docker_plugin.unassign_ip(IPAddress("1.2.3.4")))
+            docker_plugin.client.unassign_address.assert_called_once_with(
+                IPNetwork("1.2.3.0/24"), IPAddress("1.2.3.4"))
+
+    def test_backout_ip_assignments_handle(self):
+        """
+        Test that an endpoint's IPs are released using its allocation handle,
+        without reading the pools.
+        """
+        ep = Endpoint("hostname", "docker", "libnetwork", TEST_ID, "active",
+                      "mac")
+        docker_plugin.client.get_ip_pool_set = Mock()
+        docker_plugin.client.get_handle = Mock(return_value=[
+            (IPNetwork("1.2.3.0/24"), IPAddress("1.2.3.4")),
+            (IPNetwork("fd80::/64"), IPAddress("fd80::4"))])
+        docker_plugin.client.unassign_address = Mock(return_value=True)
+        docker_plugin.client.remove_handle = Mock()
+        with patch.dict(docker_plugin.ip_reserves, {"v4": Mock(),
+                                                    "v6": Mock()}):
+            docker_plugin.ip_reserves["v4"].put.return_value = True
+            docker_plugin.ip_reserves["v6"].put.return_value = False
+            docker_plugin.backout_ip_assignments(ep)
+        docker_plugin.client.unassign_address.assert_called_once_with(
+            IPNetwork("fd80::/64"), IPAddress("fd80::4"))
+        docker_plugin.client.remove_handle.assert_called_once_with(TEST_ID)
+        assert_false(docker_plugin.client.get_ip_pool_set.called)
+
 # TODO - test_delete_endpoint and test_create_endpoint
\ No newline at end of file
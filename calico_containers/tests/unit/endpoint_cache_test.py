@@ -0,0 +1,129 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from mock import Mock, patch
+from nose.tools import *
+
+from pycalico.datastore_datatypes import Endpoint
+from pycalico.endpoint_cache import EndpointCache
+from pycalico.ipam import IPAMClient
+
+KEY = ("host", "docker", "libnetwork", "ep1")
+
+
+def make_endpoint(endpoint_id):
+    return Endpoint("host", "docker", "libnetwork", endpoint_id, "active",
+                    "mac")
+
+
+class TestEndpointCache(unittest.TestCase):
+
+    def setUp(self):
+        self.client = Mock(spec=IPAMClient)
+        self.cache = EndpointCache(self.client, max_size=2, ttl=10)
+        self.endpoint = make_endpoint("ep1")
+
+    @patch("pycalico.endpoint_cache.time.time", autospec=True)
+    def test_hit(self, m_time):
+        """
+        Test an endpoint is used without reading the datastore within the TTL.
+        """
+        m_time.return_value = 100
+        self.cache.put(self.endpoint, 5)
+        m_time.return_value = 109
+        assert_is(self.cache.get_endpoint(*KEY), self.endpoint)
+        assert_false(self.client.get_endpoint_index.called)
+        assert_false(self.client.get_endpoint.called)
+
+    def test_miss(self):
+        """
+        Test an endpoint that isn't in the cache is read from the datastore.
+        """
+        assert_is(self.cache.get_endpoint(*KEY),
+                  self.client.get_endpoint.return_value)
+        self.client.get_endpoint.assert_called_once_with(
+            hostname="host", orchestrator_id="docker",
+            workload_id="libnetwork", endpoint_id="ep1")
+
+    @patch("pycalico.endpoint_cache.time.time", autospec=True)
+    def test_stale_unchanged(self, m_time):
+        """
+        Test an endpoint older than the TTL is used if its index is current,
+        and isn't checked again until the TTL has passed again.
+        """
+        m_time.return_value = 100
+        self.cache.put(self.endpoint, 5)
+        self.client.get_endpoint_index.return_value = 5
+        m_time.return_value = 111
+        assert_is(self.cache.get_endpoint(*KEY), self.endpoint)
+        self.client.get_endpoint_index.assert_called_once_with(*KEY)
+        m_time.return_value = 120
+        assert_is(self.cache.get_endpoint(*KEY), self.endpoint)
+        assert_equal(self.client.get_endpoint_index.call_count, 1)
+        assert_false(self.client.get_endpoint.called)
+
+    @patch("pycalico.endpoint_cache.time.time", autospec=True)
+    def test_stale_changed(self, m_time):
+        """
+        Test an endpoint older than the TTL is read again if it has changed,
+        and dropped from the cache.
+        """
+        m_time.return_value = 100
+        self.cache.put(self.endpoint, 5)
+        self.client.get_endpoint_index.return_value = 6
+        m_time.return_value = 111
+        assert_is(self.cache.get_endpoint(*KEY),
+                  self.client.get_endpoint.return_value)
+        self.cache.get_endpoint(*KEY)
+        assert_equal(self.client.get_endpoint_index.call_count, 1)
+        assert_equal(self.client.get_endpoint.call_count, 2)
+
+    @patch("pycalico.endpoint_cache.time.time", autospec=True)
+    def test_stale_deleted(self, m_time):
+        """
+        Test the datastore's KeyError is raised for an endpoint that has been
+        deleted from the datastore.
+        """
+        m_time.return_value = 100
+        self.cache.put(self.endpoint, 5)
+        self.client.get_endpoint_index.side_effect = KeyError
+        self.client.get_endpoint.side_effect = KeyError
+        m_time.return_value = 111
+        assert_raises(KeyError, self.cache.get_endpoint, *KEY)
+
+    def test_invalidate(self):
+        """
+        Test an invalidated endpoint is read from the datastore.
+        """
+        self.cache.put(self.endpoint, 5)
+        self.cache.invalidate(*KEY)
+        self.cache.get_endpoint(*KEY)
+        assert_true(self.client.get_endpoint.called)
+
+    def test_lru(self):
+        """
+        Test the least recently used endpoint is dropped when the cache is
+        full.
+        """
+        endpoint2 = make_endpoint("ep2")
+        self.cache.put(self.endpoint, 5)
+        self.cache.put(endpoint2, 6)
+        self.cache.get_endpoint(*KEY)
+        self.cache.put(make_endpoint("ep3"), 7)
+        assert_is(self.cache.get_endpoint(*KEY), self.endpoint)
+        assert_false(self.client.get_endpoint.called)
+        self.cache.get_endpoint("host", "docker", "libnetwork", "ep2")
+        assert_true(self.client.get_endpoint.called)
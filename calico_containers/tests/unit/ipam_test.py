@@ -11,11 +11,16 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from mock import patch
 from netaddr import IPNetwork, IPAddress
-from nose.tools import assert_equal, assert_true, assert_false
+from nose.tools import assert_equal, assert_true, assert_false, \
+    assert_raises
 
-from pycalico.ipam import SequentialAssignment, IPAMClient
-from pycalico.datastore_datatypes import IPPool
+from pycalico.ipam import SequentialAssignment, BlockAssignment, \
+    RandomAssignment, AllocationBlock, IPAMClient, AddressReserve, \
+    FULL_POOL_RECOUNT_INTERVAL
+from pycalico.datastore_datatypes import Endpoint, IPPool
+from pycalico.datastore_errors import DataStoreError
 
 network = IPNetwork("192.168.0.0/16")
 pool = IPPool(network)
@@ -24,6 +29,7 @@ client = IPAMClient()
 class TestIPAMClient:
     def setup(self):
         client.remove_all_data()
+        client._full_pool_recounts.clear()
 
     def test_get_empty_assignments(self):
         assert_equal(client.get_assigned_addresses(pool),
@@ -66,6 +72,55 @@ class TestIPAMClient:
         assigner = SequentialAssignment()
         assert_equal(None, assigner.allocate(IPNetwork("192.168.0.0/31")))
 
+    def test_migrate_assignments(self):
+        directory = "/calico/v1/ipam/v4/assignment/192.168.0.0-16/"
+        client.etcd_client.write(directory + "192.168.0.1", "")
+        client.etcd_client.write(directory + "192.168.1.2", "")
+        assert_true(client.assign_address(pool, IPAddress("192.168.0.3")))
+
+        assert_equal(client.migrate_assignments(pool), 2)
+        assert_equal(client.get_assigned_addresses(pool),
+                     {"192.168.0.1": "", "192.168.0.3": "",
+                      "192.168.1.2": ""})
+        assert_equal(client.migrate_assignments(pool), 0)
+
+    def test_legacy_assignments(self):
+        """
+        Test an address assigned under a legacy key isn't assigned again, and
+        its pool isn't allocated from automatically until it is migrated.
+        """
+        client.add_ip_pool("v4", pool)
+        directory = "/calico/v1/ipam/v4/assignment/192.168.0.0-16/"
+        client.etcd_client.write(directory + "192.168.0.1", "")
+        assert_equal(client.get_legacy_pools("v4"), {network})
+        assert_false(client.assign_address(pool, IPAddress("192.168.0.1")))
+        assert_true(client.assign_address(pool, IPAddress("192.168.0.2")))
+        assert_equal(client.get_free_ip_pools("v4"), [])
+        assert_equal(client.allocate_many(pool, 2), [])
+
+        assert_equal(client.migrate_assignments(pool), 1)
+        assert_equal(client.get_legacy_pools("v4"), set())
+        assert_equal(client.get_free_ip_pools("v4"), [pool])
+        assert_false(client.assign_address(pool, IPAddress("192.168.0.1")))
+
+    def test_legacy_assignments_allocators(self):
+        """
+        Test the allocators don't hand out an address assigned under a legacy
+        key.
+        """
+        directory = "/calico/v1/ipam/v4/assignment/192.168.0.0-16/"
+        client.etcd_client.write(directory + "192.168.0.1", "")
+        assert_equal(client.get_legacy_assignments(network),
+                     [IPAddress("192.168.0.1")])
+        assert_equal(SequentialAssignment().allocate(pool), "192.168.0.2")
+        assert_equal(BlockAssignment("host1", client).allocate(pool), None)
+        v6_pool = IPNetwork("fd80::/64")
+        assert_true(RandomAssignment("host1", client).allocate(v6_pool))
+        v6_directory = "/calico/v1/ipam/v6/assignment/fd80::-64/"
+        client.etcd_client.write(v6_directory + "fd80::2", "")
+        assert_equal(RandomAssignment("host1", client).allocate(v6_pool),
+                     None)
+
     def test_sequential_assignment_full_pool(self):
         four_pool = IPNetwork("192.168.0.0/30")
         assigner = SequentialAssignment()
@@ -74,3 +129,503 @@ class TestIPAMClient:
         assert_equal("192.168.0.2", assigner.allocate(four_pool))
         assert_equal(None, assigner.allocate(four_pool))
 
+    def test_pool_usage(self):
+        assert_equal(client.get_pool_usage(pool), (0, 65534))
+        assert_true(client.assign_address(pool, IPAddress("192.168.0.1")))
+        assert_true(client.assign_address(pool, IPAddress("192.168.1.1")))
+        assert_false(client.assign_address(pool, IPAddress("192.168.0.1")))
+        assert_equal(client.get_pool_usage(pool), (2, 65532))
+        assert_true(client.unassign_address(pool, IPAddress("192.168.0.1")))
+        assert_equal(client.get_pool_usage(network), (1, 65533))
+
+    def test_pool_usage_recount(self):
+        assert_true(client.assign_address(pool, IPAddress("192.168.0.1")))
+        client.etcd_client.write("/calico/v1/ipam/v4/usage/192.168.0.0-16",
+                                 "7")
+        assert_equal(client.recount_pool_usage(pool), 1)
+        assert_equal(client.get_pool_usage(pool), (1, 65533))
+
+    def test_pool_usage_update_fails(self):
+        """
+        Test an assignment stands if the block was written but the usage
+        counter couldn't be updated.
+        """
+        with patch.object(client, "_update_pool_usage", autospec=True,
+                          side_effect=DataStoreError("Failed")):
+            assert_true(client.assign_address(pool,
+                                              IPAddress("192.168.0.1")))
+        assert_equal(client.get_assigned_addresses(pool),
+                     {"192.168.0.1": ""})
+        assert_equal(client.recount_pool_usage(pool), 1)
+
+    def test_get_free_ip_pools_recount(self):
+        """
+        Test a pool whose counter wrongly says it's full is recounted, but
+        only once every FULL_POOL_RECOUNT_INTERVAL.
+        """
+        small_pool = IPPool("10.0.0.0/30")
+        client.add_ip_pool("v4", small_pool)
+        key = "/calico/v1/ipam/v4/usage/10.0.0.0-30"
+        with patch("pycalico.ipam.time.time", autospec=True) as m_time:
+            m_time.return_value = 100
+            client.etcd_client.write(key, "2")
+            assert_equal(client.get_free_ip_pools("v4"), [small_pool])
+
+            client.etcd_client.write(key, "2")
+            m_time.return_value = 100 + FULL_POOL_RECOUNT_INTERVAL - 1
+            assert_equal(client.get_free_ip_pools("v4"), [])
+            m_time.return_value = 100 + FULL_POOL_RECOUNT_INTERVAL
+            assert_equal(client.get_free_ip_pools("v4"), [small_pool])
+
+    def test_get_free_ip_pools(self):
+        small_pool = IPPool("10.0.0.0/30")
+        client.add_ip_pool("v4", pool)
+        client.add_ip_pool("v4", small_pool)
+        # The pool with the most free addresses comes first.
+        assert_equal(client.get_free_ip_pools("v4"), [pool, small_pool])
+
+        # Fill the small pool; it is then skipped.
+        assert_true(client.assign_address(small_pool,
+                                          IPAddress("10.0.0.1")))
+        assert_true(client.assign_address(small_pool,
+                                          IPAddress("10.0.0.2")))
+        assert_equal(client.get_free_ip_pools("v4"), [pool])
+
+    def test_get_ip_pools_usage(self):
+        small_pool = IPPool("10.0.0.0/30")
+        client.add_ip_pool("v4", pool)
+        client.add_ip_pool("v4", small_pool)
+        assert_true(client.assign_address(small_pool,
+                                          IPAddress("10.0.0.1")))
+        usage = dict((str(usage_pool.cidr), (allocated, free))
+                     for usage_pool, allocated, free
+                     in client.get_ip_pools_usage("v4"))
+        assert_equal(usage, {"10.0.0.0/30": (1, 1),
+                             "192.168.0.0/16": (0, 65534)})
+
+    def test_get_host_usage(self):
+        assigner = BlockAssignment("host1", client)
+        for _ in range(64):
+            assigner.allocate(pool)
+        assert_true(client.assign_address(pool, IPAddress("192.168.1.1")))
+        # host1's first block is full, with the pool's network address
+        # unusable, and it has claimed a second block.
+        assert_equal(client.get_host_usage(pool),
+                     {"host1": (2, 1, 64, 63), None: (1, 0, 1, 63)})
+
+    def test_allocate_many(self):
+        assert_true(client.assign_address(pool, IPAddress("192.168.0.2")))
+        addresses = client.allocate_many(pool, 70, handle="job1")
+        # The first block has 62 free addresses, and the rest come from a new
+        # block.
+        assert_equal(len(addresses), 70)
+        assert_equal(addresses[:2], [IPAddress("192.168.0.1"),
+                                     IPAddress("192.168.0.3")])
+        assert_equal(addresses[-1], IPAddress("192.168.0.71"))
+        assert_equal(len(client.get_assigned_addresses(pool)), 71)
+        assert_equal(len(client.get_handle("job1")), 70)
+        assert_equal(client.get_pool_usage(pool), (71, 65463))
+
+    def test_allocate_many_pools(self):
+        small_pool = IPNetwork("10.0.0.0/29")
+        addresses = client.allocate_many([IPPool(small_pool), pool], 8)
+        # The small pool has 6 usable addresses.
+        assert_equal(addresses, [IPAddress("10.0.0.%d" % i)
+                                 for i in range(1, 7)] +
+                                [IPAddress("192.168.0.1"),
+                                 IPAddress("192.168.0.2")])
+        assert_equal(client.allocate_many(small_pool, 1), [])
+
+    def test_allocate_many_error(self):
+        """
+        Test the addresses already allocated are released if writing a block
+        fails.
+        """
+        claim_block = IPAMClient._claim_block
+
+        def claim_or_fail(self, pool, block):
+            if block.cidr == IPNetwork("192.168.0.64/26"):
+                raise DataStoreError("Failed to write block")
+            return claim_block(self, pool, block)
+
+        with patch.object(IPAMClient, "_claim_block", claim_or_fail):
+            assert_raises(DataStoreError, client.allocate_many, pool, 70,
+                          handle="job1")
+        assert_equal(client.get_assigned_addresses(pool), {})
+        assert_equal(client.get_handle("job1"), [])
+        assert_equal(client.get_pool_usage(pool), (0, 65534))
+
+    def test_allocate_many_conflict(self):
+        assert_true(client.assign_address(pool, IPAddress("192.168.0.1")))
+        pick_free = IPAMClient._pick_free
+        conflicts = [IPAddress("192.168.0.50")]
+
+        def pick_then_conflict(self, pool, count):
+            picks = pick_free(self, pool, count)
+            if conflicts:
+                # Another client updates the block before it is written.
+                assert_true(client.assign_address(pool, conflicts.pop()))
+            return picks
+
+        with patch.object(IPAMClient, "_pick_free", pick_then_conflict):
+            addresses = client.allocate_many(pool, 2)
+        assert_equal(addresses, [IPAddress("192.168.0.2"),
+                                 IPAddress("192.168.0.3")])
+        assert_equal(sorted(client.get_assigned_addresses(pool)),
+                     ["192.168.0.1", "192.168.0.2", "192.168.0.3",
+                      "192.168.0.50"])
+
+    def test_handle(self):
+        v6_pool = IPNetwork("fd80::/64")
+        assert_true(client.assign_address(pool, IPAddress("192.168.0.1"),
+                                          handle="ep1"))
+        assert_true(client.assign_address(v6_pool, IPAddress("fd80::1"),
+                                          handle="ep1"))
+        assert_true(client.assign_address(pool, IPAddress("192.168.0.2"),
+                                          handle="ep2"))
+        assert_equal(sorted(client.get_handle("ep1")),
+                     [(network, IPAddress("192.168.0.1")),
+                      (v6_pool, IPAddress("fd80::1"))])
+
+        assert_equal(sorted(client.release_by_handle("ep1")),
+                     [IPAddress("192.168.0.1"), IPAddress("fd80::1")])
+        assert_equal(client.get_handle("ep1"), [])
+        assert_equal(client.get_assigned_addresses(pool),
+                     {"192.168.0.2": ""})
+        assert_equal(client.get_assigned_addresses(v6_pool), {})
+        assert_equal(client.release_by_handle("ep1"), [])
+
+    def test_handle_unassign(self):
+        assert_true(client.assign_address(pool, IPAddress("192.168.0.1"),
+                                          handle="ep1"))
+        assert_true(client.unassign_address(pool, IPAddress("192.168.0.1"),
+                                            handle="ep1"))
+        assert_equal(client.get_handle("ep1"), [])
+
+    def _leak_addresses(self):
+        """
+        Assign addresses to an endpoint on host1 and to host1's reserve, and
+        leak one address with a handle and one in the reserve of host2, which
+        has been removed.
+        """
+        client.add_ip_pool("v4", pool)
+        client.create_host("host1", "10.0.0.1", "", None)
+        endpoint = Endpoint("host1", "docker", "workload1", "ep1", "active",
+                            "11-22-33-44-55-66")
+        endpoint.ipv4_nets.add(IPNetwork("192.168.0.1/32"))
+        client.set_endpoint(endpoint)
+        assert_true(client.assign_address(pool, IPAddress("192.168.0.1"),
+                                          handle="ep1"))
+        assert_true(client.assign_address(pool, IPAddress("192.168.0.2"),
+                                          handle="ep2"))
+        assert_true(client.assign_address(pool, IPAddress("192.168.0.3")))
+        client.reserve_address("host1", IPAddress("192.168.0.3"), network)
+        assert_true(client.assign_address(pool, IPAddress("192.168.0.4")))
+        client.reserve_address("host2", IPAddress("192.168.0.4"), network)
+
+    def test_release_leaked_addresses_dry_run(self):
+        self._leak_addresses()
+        assert_equal(client.release_leaked_addresses(dry_run=True),
+                     [(network, IPAddress("192.168.0.2")),
+                      (network, IPAddress("192.168.0.4"))])
+        assert_equal(len(client.get_assigned_addresses(pool)), 4)
+
+    def test_release_leaked_addresses(self):
+        self._leak_addresses()
+        assert_equal(sorted(client.release_leaked_addresses(grace=0)),
+                     [(network, IPAddress("192.168.0.2")),
+                      (network, IPAddress("192.168.0.4"))])
+        assert_equal(client.get_assigned_addresses(pool),
+                     {"192.168.0.1": "", "192.168.0.3": ""})
+        assert_equal(client.get_pool_usage(pool), (2, 65532))
+        assert_equal(client.get_handle("ep1"),
+                     [(network, IPAddress("192.168.0.1"))])
+        assert_equal(client.get_handle("ep2"), [])
+        assert_equal(client.get_reserved_addresses("host1", "v4"),
+                     [(IPAddress("192.168.0.3"), network)])
+        assert_equal(client.get_reserved_addresses("host2", "v4"), [])
+        assert_equal(client.release_leaked_addresses(grace=0), [])
+
+    def test_release_leaked_addresses_grace(self):
+        self._leak_addresses()
+
+        def create_endpoint(grace):
+            # An endpoint is written for an address during the grace period.
+            endpoint = Endpoint("host1", "docker", "workload2", "ep2",
+                                "active", "11-22-33-44-55-66")
+            endpoint.ipv4_nets.add(IPNetwork("192.168.0.2/32"))
+            client.set_endpoint(endpoint)
+
+        with patch("pycalico.ipam.time.sleep", create_endpoint):
+            assert_equal(client.release_leaked_addresses(),
+                         [(network, IPAddress("192.168.0.4"))])
+        assert_equal(client.get_handle("ep2"),
+                     [(network, IPAddress("192.168.0.2"))])
+
+    def test_release_leaked_addresses_removed_host(self):
+        """
+        Test the blocks claimed by a removed host lose their affinity, so
+        other hosts can claim them, and are deleted if they are empty.
+        """
+        client.add_ip_pool("v4", pool)
+        client.create_host("host1", "10.0.0.1", "", None)
+        empty_block = client.claim_block("host2", network).cidr
+        used_block = client.claim_block("host2", network).cidr
+        address = IPAddress(used_block.first + 1)
+        endpoint = Endpoint("host1", "docker", "workload1", "ep1", "active",
+                            "11-22-33-44-55-66")
+        endpoint.ipv4_nets.add(IPNetwork(address))
+        client.set_endpoint(endpoint)
+        assert_true(client.assign_address(pool, address))
+
+        assert_equal(client.release_leaked_addresses(grace=0), [])
+        assert_equal(client.get_host_blocks("host2", network), [])
+        assert_raises(KeyError, client.read_block, network, empty_block)
+        block = client.read_block(network, used_block)
+        assert_equal(block.host_affinity, None)
+        assert_equal(list(block.allocated_addresses()), [address])
+        assert_equal(client.claim_block("host1", network).cidr, empty_block)
+        assert_equal(client.claim_block("host1", network).cidr, used_block)
+
+
+class TestDualStackAllocation:
+    def setup(self):
+        client.remove_all_data()
+        self.v6_network = IPNetwork("fd80::/64")
+        client.add_ip_pool("v4", pool)
+        client.add_ip_pool("v6", IPPool(self.v6_network))
+        client.create_host("host1", "10.0.0.1", "fd00::1", None)
+
+    def test_allocate_dual_stack(self):
+        allocation = client.allocate_dual_stack("host1", "ep1")
+        assert_equal(allocation.ipv4, IPAddress("192.168.0.1"))
+        assert_equal(allocation.ipv4_pool, network)
+        assert_equal(allocation.ipv4_gateway, IPAddress("10.0.0.1"))
+        assert_true(allocation.ipv6 in self.v6_network)
+        assert_equal(allocation.ipv6_pool, self.v6_network)
+        assert_equal(allocation.ipv6_gateway, IPAddress("fd00::1"))
+        assert_equal(sorted(client.get_handle("ep1")),
+                     [(network, allocation.ipv4),
+                      (self.v6_network, allocation.ipv6)])
+
+    def test_allocate_dual_stack_ipv4_only(self):
+        client.create_host("host1", "10.0.0.1", "", None)
+        allocation = client.allocate_dual_stack("host1", "ep1")
+        assert_equal(allocation.ipv4, IPAddress("192.168.0.1"))
+        assert_equal(allocation.ipv6, None)
+        assert_equal(client.get_assigned_addresses(self.v6_network), {})
+
+    def test_allocate_dual_stack_no_ipv4(self):
+        client.remove_ip_pool("v4", network)
+        assert_equal(client.allocate_dual_stack("host1", "ep1"), None)
+        # The IPv6 address is rolled back.
+        assert_equal(client.get_assigned_addresses(self.v6_network), {})
+        assert_equal(client.get_handle("ep1"), [])
+
+    def test_allocate_dual_stack_error(self):
+        allocate_for_host = IPAMClient._allocate_for_host
+
+        def fail_ipv6(self, hostname, version, handle, reserve):
+            if version == 6:
+                raise DataStoreError("Error accessing etcd")
+            return allocate_for_host(self, hostname, version, handle, reserve)
+
+        with patch.object(IPAMClient, "_allocate_for_host", fail_ipv6):
+            assert_raises(DataStoreError, client.allocate_dual_stack,
+                          "host1", "ep1")
+        # The IPv4 address is rolled back.
+        assert_equal(client.get_assigned_addresses(pool), {})
+        assert_equal(client.get_handle("ep1"), [])
+
+    def test_allocate_dual_stack_reserve(self):
+        reserve = AddressReserve("host1", "v4", 1, client)
+        reserve._start = lambda: None
+        reserve.refill()
+        client.remove_ip_pool("v6", self.v6_network)
+
+        allocation = client.allocate_dual_stack("host1", "ep1",
+                                                reserves={"v4": reserve})
+        assert_equal(allocation.ipv4, IPAddress("192.168.0.1"))
+        assert_equal(allocation.ipv6, None)
+        assert_equal(client.get_reserved_addresses("host1", "v4"), [])
+        assert_equal(client.get_handle("ep1"),
+                     [(network, IPAddress("192.168.0.1"))])
+
+        # The reserve is empty, so the next address is allocated from the
+        # pool.
+        allocation = client.allocate_dual_stack("host1", "ep2",
+                                                reserves={"v4": reserve})
+        assert_equal(allocation.ipv4, IPAddress("192.168.0.2"))
+
+
+class TestAllocationBlock:
+    def test_json(self):
+        block = AllocationBlock("192.168.0.64/26", network,
+                                host_affinity="host1")
+        block.auto_assign()
+        block2 = AllocationBlock.from_json(block.to_json(), network)
+        assert_equal(block2.cidr, IPNetwork("192.168.0.64/26"))
+        assert_equal(block2.host_affinity, "host1")
+        assert_equal(block2.allocations, 1)
+
+    def test_auto_assign(self):
+        # The pool's network address is never handed out.
+        block = AllocationBlock("192.168.0.0/26", network)
+        assert_equal(block.auto_assign(), IPAddress("192.168.0.1"))
+        assert_equal(block.auto_assign(), IPAddress("192.168.0.2"))
+        assert_true(block.release(IPAddress("192.168.0.1")))
+        assert_false(block.release(IPAddress("192.168.0.1")))
+        assert_equal(block.auto_assign(), IPAddress("192.168.0.1"))
+
+    def test_assign(self):
+        block = AllocationBlock("192.168.0.64/26", network)
+        assert_true(block.assign(IPAddress("192.168.0.127")))
+        assert_false(block.assign(IPAddress("192.168.0.127")))
+        assert_true(block.assign(IPAddress("192.168.0.65")))
+        assert_equal(list(block.allocated_addresses()),
+                     [IPAddress("192.168.0.65"), IPAddress("192.168.0.127")])
+
+    def test_free_count(self):
+        block = AllocationBlock("192.168.0.0/26", network)
+        # The pool's network address can't be allocated.
+        assert_equal(block.free_count(), 63)
+        block.assign(IPAddress("192.168.0.5"))
+        assert_equal(block.free_count(), 62)
+
+    def test_auto_assign_full(self):
+        block = AllocationBlock("192.168.0.0/30", IPNetwork("192.168.0.0/30"))
+        assert_equal(block.auto_assign(), IPAddress("192.168.0.1"))
+        assert_equal(block.auto_assign(), IPAddress("192.168.0.2"))
+        assert_equal(block.auto_assign(), None)
+
+
+class TestBlockAssignment:
+    def setup(self):
+        client.remove_all_data()
+
+    def test_block_assignment(self):
+        assigner = BlockAssignment("host1")
+        assert_equal("192.168.0.1", assigner.allocate(pool))
+        assert_equal("192.168.0.2", assigner.allocate(network))
+        assert_equal(client.get_assigned_addresses(pool),
+                     {"192.168.0.1": "", "192.168.0.2": ""})
+
+    def test_block_assignment_per_host(self):
+        assert_equal("192.168.0.1", BlockAssignment("host1").allocate(pool))
+        assert_equal("192.168.0.64", BlockAssignment("host2").allocate(pool))
+        assert_equal("192.168.0.2", BlockAssignment("host1").allocate(pool))
+        assert_equal(client.get_host_blocks("host2", network),
+                     [IPNetwork("192.168.0.64/26")])
+
+    def test_block_assignment_skips_assigned(self):
+        assert_true(client.assign_address(pool, IPAddress("192.168.0.1")))
+        assigner = BlockAssignment("host1")
+        assert_equal("192.168.0.2", assigner.allocate(pool))
+        # The block created by assigning 192.168.0.1 is claimed by host1.
+        assert_equal(client.get_host_blocks("host1", network),
+                     [IPNetwork("192.168.0.0/26")])
+
+    def test_block_assignment_unassign(self):
+        assigner = BlockAssignment("host1")
+        assert_equal("192.168.0.1", assigner.allocate(pool))
+        assert_true(client.unassign_address(pool, IPAddress("192.168.0.1")))
+        assert_equal("192.168.0.1", assigner.allocate(pool))
+
+    def test_block_assignment_handle(self):
+        assert_equal("192.168.0.1",
+                     BlockAssignment("host1").allocate(pool, handle="ep1"))
+        assert_equal(client.get_handle("ep1"),
+                     [(network, IPAddress("192.168.0.1"))])
+
+    def test_block_assignment_usage(self):
+        assigner = BlockAssignment("host1")
+        assert_equal("192.168.0.1", assigner.allocate(pool))
+        assert_equal("192.168.0.64", BlockAssignment("host2").allocate(pool))
+        assert_equal("192.168.0.2", assigner.allocate(pool))
+        assert_equal(client.get_pool_usage(pool), (3, 65531))
+
+    def test_block_assignment_full_pool(self):
+        four_pool = IPNetwork("192.168.0.0/30")
+        assert_equal("192.168.0.1", BlockAssignment("host1").allocate(four_pool))
+        # host2 has to borrow from host1's block.
+        assert_equal("192.168.0.2", BlockAssignment("host2").allocate(four_pool))
+        assert_equal(None, BlockAssignment("host1").allocate(four_pool))
+
+
+class TestRandomAssignment:
+    def setup(self):
+        client.remove_all_data()
+
+    @patch("pycalico.ipam._random.randrange", autospec=True)
+    def test_random_assignment(self, m_randrange):
+        v6_pool = IPNetwork("fd80::/64")
+        m_randrange.side_effect = iter([0x1234, 0x1234, 0x5678])
+        assigner = RandomAssignment("host1")
+        assert_equal("fd80::1234", assigner.allocate(v6_pool))
+        # The second pick is taken, so the allocator tries again.
+        assert_equal("fd80::5678", assigner.allocate(v6_pool))
+        assert_equal(client.get_assigned_addresses(v6_pool),
+                     {"fd80::1234": "", "fd80::5678": ""})
+        # The addresses aren't in blocks claimed by the host.
+        assert_equal(client.get_host_blocks("host1", v6_pool), [])
+
+    @patch("pycalico.ipam._random.randrange", autospec=True)
+    def test_random_assignment_probes_exhausted(self, m_randrange):
+        v6_pool = IPNetwork("fd80::/64")
+        m_randrange.return_value = 0
+        # Only the unusable first address is picked, so the allocator falls
+        # back to the host's blocks.
+        assert_equal("fd80::1", RandomAssignment("host1").allocate(v6_pool))
+        assert_equal(client.get_host_blocks("host1", v6_pool),
+                     [IPNetwork("fd80::/122")])
+
+    def test_random_assignment_small_pool(self):
+        assert_equal("192.168.0.1", RandomAssignment("host1").allocate(pool))
+
+
+class TestAddressReserve:
+    def setup(self):
+        client.remove_all_data()
+        client.add_ip_pool("v4", pool)
+        self.reserve = AddressReserve("host1", "v4", 2, client)
+        # Refill synchronously, rather than from the background thread.
+        self.reserve._start = lambda: None
+
+    def test_refill(self):
+        self.reserve.refill()
+        assert_equal(client.get_reserved_addresses("host1", "v4"),
+                     [(IPAddress("192.168.0.1"), network),
+                      (IPAddress("192.168.0.2"), network)])
+        assert_equal(client.get_assigned_addresses(pool),
+                     {"192.168.0.1": "", "192.168.0.2": ""})
+
+    def test_pop(self):
+        self.reserve.refill()
+        assert_equal(self.reserve.pop(), (IPAddress("192.168.0.1"), network))
+        assert_equal(client.get_reserved_addresses("host1", "v4"),
+                     [(IPAddress("192.168.0.2"), network)])
+        # The address is still assigned once it leaves the reserve.
+        assert_true("192.168.0.1" in client.get_assigned_addresses(pool))
+
+    def test_put(self):
+        self.reserve.refill()
+        address, _ = self.reserve.pop()
+        assert_true(self.reserve.put(address, network))
+        # The reserve is full.
+        assert_false(self.reserve.put(IPAddress("192.168.0.3"), network))
+
+    def test_reload(self):
+        self.reserve.refill()
+        reserve = AddressReserve("host1", "v4", 2, client)
+        reserve._start = lambda: None
+        # A new reserve starts with the stored addresses.
+        assert_equal(reserve.pop(), (IPAddress("192.168.0.1"), network))
+
+    def test_refill_drops_removed_pools(self):
+        self.reserve.refill()
+        client.remove_ip_pool("v4", network)
+        client.add_ip_pool("v4", IPPool("10.0.0.0/24"))
+        self.reserve.refill()
+        assert_equal(client.get_reserved_addresses("host1", "v4"),
+                     [(IPAddress("10.0.0.1"), IPNetwork("10.0.0.0/24")),
+                      (IPAddress("10.0.0.2"), IPNetwork("10.0.0.0/24"))])
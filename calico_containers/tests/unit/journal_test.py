@@ -0,0 +1,140 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import Mock, patch
+from nose.tools import *
+
+from pycalico.journal import Journal
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.directory = os.path.join(self.root, "journal")
+        self.handler = Mock(return_value=True)
+        # Entries are done by calling do_batch(), not by the background
+        # thread.
+        self.patcher = patch("pycalico.journal.Journal.start", autospec=True)
+        self.m_start = self.patcher.start()
+        self.journal = Journal(self.directory, self.handler, batch_size=2,
+                               retry_delay=5)
+
+    def tearDown(self):
+        self.patcher.stop()
+        shutil.rmtree(self.root)
+
+    def read_entry(self, name):
+        with open(os.path.join(self.directory, name + ".json")) as f:
+            return json.load(f)
+
+    def test_record(self):
+        """
+        Test an entry is written to disk and done by the next batch.
+        """
+        self.journal.record("ep1", {"stage": "one"})
+        assert_equal(self.read_entry("ep1"), {"stage": "one"})
+        assert_true(self.m_start.called)
+        assert_equal(self.journal.pending(), 1)
+
+        assert_equal(self.journal.do_batch(), 1)
+        self.handler.assert_called_once_with("ep1", {"stage": "one"})
+        assert_equal(self.journal.pending(), 0)
+        assert_equal(os.listdir(self.directory), [])
+        assert_equal(self.journal.do_batch(), 0)
+
+    def test_batches(self):
+        """
+        Test entries are done in batches of batch_size, oldest first.
+        """
+        for name in ("ep1", "ep2", "ep3"):
+            self.journal.record(name, {})
+        assert_equal(self.journal.do_batch(), 2)
+        assert_equal(sorted(call[0][0] for call in
+                            self.handler.call_args_list), ["ep1", "ep2"])
+        assert_equal(self.journal.do_batch(), 1)
+        assert_equal(self.handler.call_args[0][0], "ep3")
+
+    @patch("pycalico.journal.time.time", autospec=True)
+    def test_retry(self, m_time):
+        """
+        Test an entry that fails is kept and retried after the retry delay.
+        """
+        m_time.return_value = 100
+        self.handler.side_effect = iter([False, Exception(), True])
+        self.journal.record("ep1", {})
+        assert_equal(self.journal.do_batch(), 1)
+        assert_equal(self.journal.do_batch(), 0)
+        m_time.return_value = 105
+        assert_equal(self.journal.do_batch(), 1)
+        m_time.return_value = 110
+        assert_equal(self.journal.do_batch(), 1)
+        assert_equal(self.handler.call_count, 3)
+        assert_equal(self.journal.pending(), 0)
+
+    def test_update(self):
+        """
+        Test the progress recorded by the handler is written to disk.
+        """
+        def handler(name, data):
+            data["stage"] = "two"
+            self.journal.update(name, data)
+            return False
+        self.journal.handler = handler
+        self.journal.record("ep1", {"stage": "one"})
+        self.journal.do_batch()
+        assert_equal(self.read_entry("ep1"), {"stage": "two"})
+
+    def test_recorded_again(self):
+        """
+        Test an entry that is recorded again while it is being done is kept.
+        """
+        def handler(name, data):
+            self.journal.record(name, {"stage": "again"})
+            return True
+        self.journal.handler = handler
+        self.journal.record("ep1", {"stage": "one"})
+        self.journal.do_batch()
+        assert_equal(self.journal.pending(), 1)
+        assert_equal(self.read_entry("ep1"), {"stage": "again"})
+
+    def test_recover(self):
+        """
+        Test the entries left by another journal are recovered, and temporary
+        files are ignored.
+        """
+        self.journal.record("ep1", {"stage": "one"})
+        self.journal.record("ep2", {"stage": "two"})
+        open(os.path.join(self.directory, ".ep3.tmp"), "w").close()
+
+        journal = Journal(self.directory, self.handler)
+        self.m_start.reset_mock()
+        assert_equal(journal.recover(), 2)
+        assert_true(self.m_start.called)
+        journal.do_batch()
+        assert_equal(sorted(call[0] for call in self.handler.call_args_list),
+                     [("ep1", {"stage": "one"}), ("ep2", {"stage": "two"})])
+
+    def test_recover_no_directory(self):
+        """
+        Test recovering a journal whose directory doesn't exist yet.
+        """
+        assert_equal(self.journal.recover(), 0)
+        assert_false(self.m_start.called)
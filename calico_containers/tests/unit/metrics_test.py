@@ -0,0 +1,99 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from mock import patch
+from nose.tools import *
+
+from pycalico.datastore_stats import LATENCY_BUCKETS
+from pycalico.metrics import Counter, DatastoreMetrics, Gauge, Histogram, \
+    format_metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_counter(self):
+        """
+        Test a counter is formatted with a sample for each set of labels.
+        """
+        counter = Counter("requests_total", "Requests.", ("route", "status"))
+        counter.inc("/a", "200")
+        counter.inc("/a", "200")
+        counter.inc("/b", "500", amount=3)
+        assert_equal(counter.format(),
+                     '# HELP requests_total Requests.\n'
+                     '# TYPE requests_total counter\n'
+                     'requests_total{route="/a",status="200"} 2.0\n'
+                     'requests_total{route="/b",status="500"} 3.0\n')
+
+    def test_gauge(self):
+        """
+        Test a gauge goes up and down, and label values are escaped.
+        """
+        gauge = Gauge("in_flight", "In flight.", ("route",))
+        gauge.inc('a"b')
+        gauge.inc('a"b')
+        gauge.dec('a"b')
+        assert_equal(gauge.format().splitlines()[2],
+                     'in_flight{route="a\\"b"} 1.0')
+
+    def test_histogram(self):
+        """
+        Test a histogram has cumulative buckets, a count and a sum.
+        """
+        histogram = Histogram("latency", "Latency.", buckets=(0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        assert_equal(histogram.format().splitlines()[2:],
+                     ['latency_bucket{le="0.1"} 1.0',
+                      'latency_bucket{le="1.0"} 2.0',
+                      'latency_bucket{le="+Inf"} 3.0',
+                      'latency_count 3.0',
+                      'latency_sum 5.55'])
+
+    @patch("pycalico.metrics.time.time", autospec=True)
+    def test_histogram_time(self, m_time):
+        """
+        Test time() observes how long its block took, even if it raises.
+        """
+        m_time.side_effect = iter([10, 10.5])
+        histogram = Histogram("phase", "Phase.", ("phase",), buckets=(1,))
+        with assert_raises(ValueError):
+            with histogram.time("write"):
+                raise ValueError()
+        assert_equal(histogram.samples()[-1],
+                     ("phase_sum", ("phase",), ("write",), 0.5))
+
+    @patch("pycalico.metrics.datastore_stats.get_stats", autospec=True)
+    def test_datastore_metrics(self, m_get_stats):
+        """
+        Test the datastore statistics are reported for each method.
+        """
+        histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+        histogram[0] = 2
+        m_get_stats.return_value = {
+            "get_endpoint": {"calls": 2, "errors": 1, "total_time": 0.001,
+                             "max_time": 0.0006, "etcd_requests": 2,
+                             "cas_failures": 0, "histogram": histogram}}
+        lines = format_metrics([DatastoreMetrics()]).splitlines()
+        assert_in('calico_datastore_calls_total{method="get_endpoint"} 2.0',
+                  lines)
+        assert_in('calico_datastore_errors_total{method="get_endpoint"} 1.0',
+                  lines)
+        assert_in('calico_datastore_call_duration_seconds_bucket'
+                  '{method="get_endpoint",le="+Inf"} 2.0', lines)
+        assert_in('calico_datastore_call_duration_seconds_sum'
+                  '{method="get_endpoint"} 0.001', lines)
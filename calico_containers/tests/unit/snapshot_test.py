@@ -0,0 +1,169 @@
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from etcd import Client as EtcdClient
+from etcd import EtcdKeyNotFound, EtcdResult
+from mock import Mock
+from netaddr import IPAddress, IPNetwork
+from nose.tools import *
+
+from pycalico.datastore_datatypes import BGPPeer, Endpoint, IPPool, Rules
+from pycalico.ipam import AllocationBlock
+from pycalico.snapshot import Snapshot
+
+ROOT = "/calico/v1"
+HOST_PATH = ROOT + "/host/TEST_HOST"
+POOL = IPNetwork("192.168.0.0/16")
+BLOCK = IPNetwork("192.168.3.0/26")
+
+EP_12 = Endpoint("TEST_HOST", "docker", "1234", "1234567890ab",
+                 "active", "11-22-33-44-55-66")
+EP_12.profile_ids = ["TEST", "UNIT"]
+EP_78 = Endpoint("TEST_HOST2", "docker", "5678", "7890abcdef12",
+                 "active", "11-AA-33-BB-55-CC")
+EP_78.profile_ids = ["TEST"]
+
+
+def node(key, value=None):
+    return {"key": key, "value": value, "modifiedIndex": 5, "createdIndex": 5}
+
+
+def dir_node(key, nodes=None):
+    return {"key": key, "dir": True, "nodes": nodes or [],
+            "modifiedIndex": 5, "createdIndex": 5}
+
+
+def calico_tree():
+    """
+    Build the response to a recursive read of /calico/v1 containing two
+    hosts, two profiles (one without keys), a pool with one block, and
+    BGP peers.
+    """
+    block = AllocationBlock(BLOCK, POOL, host_affinity="TEST_HOST")
+    block.assign(IPAddress("192.168.3.5"))
+    rules = Rules("TEST", [], [])
+    return dir_node(ROOT, [
+        dir_node(ROOT + "/host", [
+            dir_node(HOST_PATH, [
+                node(HOST_PATH + "/bird_ip", "10.0.0.1"),
+                node(HOST_PATH + "/bird6_ip", ""),
+                dir_node(HOST_PATH + "/config", [
+                    node(HOST_PATH + "/config/marker", "created")]),
+                dir_node(HOST_PATH + "/bgp_peer_v4", [
+                    node(HOST_PATH + "/bgp_peer_v4/10.0.0.5",
+                         BGPPeer("10.0.0.5", 64512).to_json())]),
+                node(HOST_PATH + "/workload/docker/1234/endpoint/"
+                                 "1234567890ab", EP_12.to_json())]),
+            dir_node(ROOT + "/host/TEST_HOST2", [
+                node(ROOT + "/host/TEST_HOST2/workload/docker/5678/endpoint/"
+                            "7890abcdef12", EP_78.to_json())])]),
+        dir_node(ROOT + "/config", [
+            node(ROOT + "/config/bgp_as", "64511"),
+            dir_node(ROOT + "/config/bgp_peer_v6", [
+                node(ROOT + "/config/bgp_peer_v6/fd00::1",
+                     BGPPeer("fd00::1", 64513).to_json())])]),
+        dir_node(ROOT + "/policy/profile", [
+            dir_node(ROOT + "/policy/profile/TEST", [
+                node(ROOT + "/policy/profile/TEST/tags", '["TEST", "A"]'),
+                node(ROOT + "/policy/profile/TEST/rules", rules.to_json())]),
+            dir_node(ROOT + "/policy/profile/EMPTY")]),
+        dir_node(ROOT + "/ipam/v4", [
+            node(ROOT + "/ipam/v4/pool/192.168.0.0-16",
+                 IPPool(POOL).to_json()),
+            node(ROOT + "/ipam/v4/block/192.168.0.0-16/192.168.3.0-26",
+                 block.to_json())])])
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.client = Mock()
+        self.client.etcd_client = Mock(spec=EtcdClient)
+        result = EtcdResult("get", calico_tree())
+        result.etcd_index = 42
+        self.client.etcd_client.read.return_value = result
+        self.snapshot = Snapshot.load(self.client)
+
+    def test_load(self):
+        """
+        Test the snapshot is loaded with a single recursive read.
+        """
+        self.client.etcd_client.read.assert_called_once_with(ROOT,
+                                                             recursive=True)
+        assert_equal(self.snapshot.etcd_index, 42)
+
+    def test_load_empty(self):
+        """
+        Test loading a snapshot when there is no Calico data.
+        """
+        self.client.etcd_client.read.side_effect = EtcdKeyNotFound
+        snapshot = Snapshot.load(self.client)
+        assert_equal(snapshot.endpoints, [])
+        assert_equal(snapshot.get_profile_names(), set())
+        assert_equal(snapshot.get_ip_pools("v4"), [])
+
+    def test_hosts(self):
+        """
+        Test host IPs and host BGP peers are parsed.
+        """
+        assert_equal(self.snapshot.get_host_ips("TEST_HOST"),
+                     ("10.0.0.1", ""))
+        assert_raises(KeyError, self.snapshot.get_host_ips, "TEST_HOST2")
+        assert_equal(self.snapshot.get_bgp_peers("v4", hostname="TEST_HOST"),
+                     [BGPPeer("10.0.0.5", 64512)])
+        assert_equal(self.snapshot.get_bgp_peers("v6", hostname="TEST_HOST"),
+                     [])
+        assert_equal(self.snapshot.get_bgp_peers("v6"),
+                     [BGPPeer("fd00::1", 64513)])
+
+    def test_endpoints(self):
+        """
+        Test endpoints are parsed and can be filtered.
+        """
+        assert_equal(self.snapshot.get_endpoints(), [EP_12, EP_78])
+        assert_equal(self.snapshot.get_endpoints(hostname="TEST_HOST2"),
+                     [EP_78])
+        assert_equal(self.snapshot.get_endpoints(workload_id="1234"),
+                     [EP_12])
+        assert_equal(self.snapshot.get_endpoints(endpoint_id="missing"), [])
+
+    def test_profiles(self):
+        """
+        Test profiles, including ones without tags or rules, and their
+        members.
+        """
+        assert_equal(self.snapshot.get_profile_names(), set(["TEST", "EMPTY"]))
+        assert_equal(self.snapshot.get_profile("TEST").tags,
+                     set(["TEST", "A"]))
+        assert_equal(self.snapshot.get_profile("EMPTY").tags, set())
+        assert_raises(KeyError, self.snapshot.get_profile, "UNIT")
+
+        assert_equal(self.snapshot.get_profile_members("TEST"),
+                     [EP_12, EP_78])
+        assert_equal(self.snapshot.get_all_profile_members(),
+                     {"TEST": [EP_12, EP_78], "UNIT": [EP_12]})
+
+    def test_ipam(self):
+        """
+        Test pools and allocation blocks are parsed.
+        """
+        assert_equal(self.snapshot.get_ip_pools("v4"), [IPPool(POOL)])
+        assert_equal(self.snapshot.get_ip_pools("v6"), [])
+        blocks = self.snapshot.get_allocation_blocks(IPPool(POOL))
+        assert_equal([block.cidr for block in blocks], [BLOCK])
+        assert_equal(blocks[0].host_affinity, "TEST_HOST")
+        assert_equal(self.snapshot.get_assigned_addresses(POOL),
+                     {"192.168.3.5": ""})